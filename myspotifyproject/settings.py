@@ -1,4 +1,5 @@
 import os
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -27,6 +28,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so everything after it (sessions, auth, the view) is measured
+    'spotifyapp.metrics.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -104,4 +107,30 @@ STATICFILES_DIRS = [
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # Login URL for redirecting unauthenticated users
-LOGIN_URL = '/login_view/'
\ No newline at end of file
+LOGIN_URL = '/login_view/'
+
+# Most Spotify requests a single page view will have in flight at once
+SPOTIFY_MAX_CONCURRENCY = 8
+
+# Size bounds for the in-process Spotify response caches (see spotifyapp/spotify_client.py)
+SPOTIFY_CATALOG_CACHE_ENTRIES = 5000
+SPOTIFY_USER_CACHE_ENTRIES = 1000
+# How many per-user Spotify clients each process keeps around (see spotifyapp/spotify_auth.py)
+SPOTIFY_CLIENT_POOL_SIZE = 1000
+
+# Shared Spotify request budget for every worker process on this machine
+SPOTIFY_RATE_LIMIT_PER_SECOND = 10
+SPOTIFY_RATE_LIMIT_BURST = 20
+SPOTIFY_RATE_LIMIT_FILE = os.path.join(tempfile.gettempdir(), 'myspotifyproject-spotify-ratelimit.json')
+# A 429 asking us to wait longer than this (seconds) fails the request instead of blocking the worker
+SPOTIFY_MAX_RETRY_AFTER = 30
+
+# Where Spotify API and OAuth requests go. Point both at `manage.py run_fake_spotify` to load test without Spotify,
+# e.g. SPOTIFY_API_URL=http://127.0.0.1:8900/v1/ SPOTIFY_ACCOUNTS_URL=http://127.0.0.1:8900
+SPOTIFY_API_URL = os.environ.get('SPOTIFY_API_URL', 'https://api.spotify.com/v1/')
+SPOTIFY_ACCOUNTS_URL = os.environ.get('SPOTIFY_ACCOUNTS_URL', 'https://accounts.spotify.com')
+
+# Who may read /metrics (Prometheus text, see spotifyapp/metrics.py), None lets everyone in
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+# Add a Server-Timing header (SQL, Spotify and cache time) to every response, shown in the browser's dev tools
+METRICS_SERVER_TIMING = DEBUG
@@ -0,0 +1,217 @@
+import base64
+import json
+from datetime import datetime
+from functools import wraps
+
+from django.db.models import Q, Sum
+from django.http import JsonResponse
+from django.views.decorators.http import require_GET
+
+from .genre_graph import neighboring_genres
+from .genres import build_genre_collage_index
+from .models import ListeningHistory, Song, UserGenreProfile
+from .rollups import WINDOWS, window_rollups
+
+# Rows per page when the client doesn't ask for a size, and the most it can ask for
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 200
+
+# What each endpoint can return: API field name -> database column
+GENRE_FIELDS = {
+    'genre': 'genre__name',
+    'song_count': 'song_count',
+}
+SONG_FIELDS = {
+    'track_id': 'track_id',
+    'track_name': 'track_name',
+    'artist_names': 'artist_names',
+    'album_art': 'album_art',
+    'popularity': 'popularity',
+    'genres': 'genres',
+}
+TOP_SONG_FIELDS = {
+    'plays': 'total_plays',
+    'track_id': 'song__track_id',
+    'track_name': 'song__track_name',
+    'artist_names': 'song__artist_names',
+    'album_art': 'song__album_art',
+    'popularity': 'song__popularity',
+}
+HISTORY_FIELDS = {
+    'played_at': 'played_at',
+    'track_id': 'song__track_id',
+    'track_name': 'song__track_name',
+    'artist_names': 'song__artist_names',
+    'album_art': 'song__album_art',
+}
+
+
+class BadRequest(Exception):
+    pass
+
+
+#Decorator for the API views: GET only, JSON 401 instead of a login redirect, JSON 400 for bad parameters
+def api_view(view):
+    @require_GET
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return JsonResponse({'error': 'Authentication required.'}, status=401)
+        try:
+            return view(request, *args, **kwargs)
+        except BadRequest as e:
+            return JsonResponse({'error': str(e)}, status=400)
+    return wrapper
+
+
+def encode_cursor(values):
+    # Full isoformat, DjangoJSONEncoder would cut datetimes to milliseconds and the cursor would skip rows
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+#Function that reads a cursor back into one value per key, checked against the key's type (int, str or datetime)
+#so a tampered cursor is a 400 rather than an error in the query
+def decode_cursor(cursor, keys):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise BadRequest("Invalid cursor.")
+    if not isinstance(values, list) or len(values) != len(keys):
+        raise BadRequest("Invalid cursor.")
+    return [_cursor_value(value, kind) for value, (column, descending, kind) in zip(values, keys)]
+
+
+def _cursor_value(value, kind):
+    if kind is int and type(value) is int and -2 ** 63 <= value < 2 ** 63:
+        return value
+    if kind is str and isinstance(value, str):
+        return value
+    if kind is datetime and isinstance(value, str):
+        try:
+            parsed = datetime.fromisoformat(value)
+        except ValueError:
+            raise BadRequest("Invalid cursor.")
+        if parsed.tzinfo is not None:
+            return parsed
+    raise BadRequest("Invalid cursor.")
+
+
+#Function that reads the ?fields= list, defaulting to every field the endpoint has
+def requested_fields(request, available, extra=()):
+    fields = request.GET.get('fields')
+    if not fields:
+        return list(available)
+    fields = [field.strip() for field in fields.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in available and field not in extra]
+    if unknown:
+        raise BadRequest(f"Unknown fields: {', '.join(unknown)}. Available: {', '.join([*available, *extra])}.")
+    return fields
+
+
+def requested_limit(request):
+    try:
+        limit = int(request.GET.get('limit', API_PAGE_SIZE))
+    except ValueError:
+        raise BadRequest("limit must be a number.")
+    return max(1, min(limit, API_MAX_PAGE_SIZE))
+
+
+#Function that builds the WHERE (or HAVING) for "rows after this cursor" for an ordering of (column, descending, type)
+#keys, e.g. (count desc, name asc) -> count < c OR (count = c AND name > n)
+def keyset_filter(keys, values):
+    condition = Q()
+    for i, (column, descending, _) in enumerate(keys):
+        step = Q(**{f"{column}__{'lt' if descending else 'gt'}": values[i]})
+        for (previous, _, _), value in zip(keys[:i], values[:i]):
+            step &= Q(**{previous: value})
+        condition |= step
+    return condition
+
+
+#Function that returns one page of a queryset with keyset pagination, as (results, next cursor).
+#keys is the ordering as (column, descending, type) triples and must end in a unique column. Only the requested fields
+#(plus the key columns) are selected, and one extra row is read to tell whether there is a next page.
+#annotations are aggregates grouped by the selected columns, their keys filter in HAVING.
+def keyset_page(request, rows, available, fields, keys, annotations=None):
+    limit = requested_limit(request)
+    annotations = annotations or {}
+    columns = list(dict.fromkeys([available[field] for field in fields if field in available] + [column for column, _, _ in keys]))
+    rows = rows.values(*[column for column in columns if column not in annotations]).annotate(**annotations)
+
+    cursor = request.GET.get('cursor')
+    if cursor:
+        rows = rows.filter(keyset_filter(keys, decode_cursor(cursor, keys)))
+    ordering = [f"-{column}" if descending else column for column, descending, _ in keys]
+    page = list(rows.order_by(*ordering)[:limit + 1])
+
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = encode_cursor([page[-1][column] for column, _, _ in keys])
+    results = [{field: row[available[field]] for field in fields if field in available} for row in page]
+    return results, next_cursor
+
+
+#Function that returns the user's genres, most songs first.
+#fields can include 'collage' for each genre's album covers and artists, which costs a walk over the user's songs.
+@api_view
+def top_genres(request):
+    fields = requested_fields(request, GENRE_FIELDS, extra=['collage'])
+    rows = UserGenreProfile.objects.filter(user=request.user, song_count__gt=0)
+    results, next_cursor = keyset_page(
+        request, rows, GENRE_FIELDS, fields + ['genre'], [('song_count', True, int), ('genre__name', False, str)]
+    )
+
+    if 'collage' in fields:
+        collages = build_genre_collage_index(request.user, [result['genre'] for result in results])
+        for result in results:
+            images, artists = collages[result['genre']]
+            result['collage'] = {'images': images, 'artists': artists}
+    if 'genre' not in fields:
+        for result in results:
+            del result['genre']
+    return JsonResponse({'results': results, 'next_cursor': next_cursor})
+
+
+#Function that returns the genres closest to ?genre= in the genre graph, strongest first
+@api_view
+def genre_neighbors(request):
+    genre = request.GET.get('genre', '').strip()
+    if not genre:
+        raise BadRequest("genre is required.")
+    results = [{'genre': name, 'weight': weight} for name, weight in neighboring_genres(genre, requested_limit(request))]
+    return JsonResponse({'genre': genre, 'results': results})
+
+
+#Function that returns the user's most played songs over ?window= (short_term, medium_term or long_term),
+#summed from the listening rollups
+@api_view
+def top_songs(request):
+    window = request.GET.get('window', 'short_term')
+    if window not in WINDOWS:
+        raise BadRequest(f"window must be one of {', '.join(WINDOWS)}.")
+    fields = requested_fields(request, TOP_SONG_FIELDS)
+    rows = window_rollups(request.user, 'song', window)
+    results, next_cursor = keyset_page(
+        request, rows, TOP_SONG_FIELDS, fields, [('total_plays', True, int), ('song_id', False, int)], annotations={'total_plays': Sum('plays')}
+    )
+    return JsonResponse({'results': results, 'next_cursor': next_cursor})
+
+
+#Function that returns the songs in the user's library, in the order they were added to our catalog
+@api_view
+def library_songs(request):
+    fields = requested_fields(request, SONG_FIELDS)
+    rows = Song.objects.filter(users=request.user)
+    results, next_cursor = keyset_page(request, rows, SONG_FIELDS, fields, [('id', False, int)])
+    return JsonResponse({'results': results, 'next_cursor': next_cursor})
+
+
+#Function that returns the user's listening history, most recent first
+@api_view
+def listening_history(request):
+    fields = requested_fields(request, HISTORY_FIELDS)
+    rows = ListeningHistory.objects.filter(user=request.user)
+    results, next_cursor = keyset_page(request, rows, HISTORY_FIELDS, fields, [('played_at', True, datetime), ('id', True, int)])
+    return JsonResponse({'results': results, 'next_cursor': next_cursor})
@@ -0,0 +1,106 @@
+import logging
+import threading
+from datetime import timedelta
+from functools import partial
+
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .models import Artist
+
+logger = logging.getLogger(__name__)
+
+# The several-artists endpoint takes at most 50 IDs per call
+ARTISTS_PER_REQUEST = 50
+# Cached artists older than this get refreshed in the background
+ARTIST_TTL = timedelta(days=7)
+
+# Artist IDs that already have a background refresh running, so we don't start the same refresh twice
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+#Function that copies the fields we keep from Spotify's artist JSON onto an Artist
+def update_artist_from_json(artist, data):
+    images = data.get('images') or [{}]
+    artist.name = data.get('name', 'Unknown')
+    artist.genres = ', '.join(data.get('genres', []))
+    artist.image_url = images[0].get('url', '')
+    artist.popularity = data.get('popularity')
+    artist.fetched_at = timezone.now()
+    return artist
+
+
+#Function that fetches full artist objects from Spotify, 50 at a time
+def fetch_artists(artist_ids, sp):
+    fetched = []
+    for start in range(0, len(artist_ids), ARTISTS_PER_REQUEST):
+        chunk = artist_ids[start:start + ARTISTS_PER_REQUEST]
+        try:
+            results = sp.artists(chunk).get('artists', [])
+        except Exception as e:
+            logger.warning(f"Failed to fetch artists {chunk[0]}..{chunk[-1]}: {e}")
+            continue
+        fetched.extend([data for data in results if data and data.get('id')])
+    return fetched
+
+
+#Function that re-downloads artists we already have and saves the fresh copies
+def refresh_artists(artist_ids, sp):
+    artists = Artist.objects.in_bulk(artist_ids, field_name='artist_id')
+    updated = []
+    for data in fetch_artists(list(artists), sp):
+        updated.append(update_artist_from_json(artists[data['id']], data))
+    Artist.objects.bulk_update(updated, ['name', 'genres', 'image_url', 'popularity', 'fetched_at'], batch_size=500)
+    logger.info(f"Refreshed {len(updated)} stale artists.")
+
+
+def _refresh_worker(artist_ids, sp):
+    try:
+        refresh_artists(artist_ids, sp)
+    except Exception as e:
+        logger.error(f"Background artist refresh failed: {e}")
+    finally:
+        with _refreshing_lock:
+            _refreshing.difference_update(artist_ids)
+        close_old_connections()
+
+
+#Function that refreshes stale artists on a background thread, the caller keeps using the stale copies meanwhile
+def refresh_artists_in_background(artist_ids, sp):
+    with _refreshing_lock:
+        artist_ids = [artist_id for artist_id in artist_ids if artist_id not in _refreshing]
+        _refreshing.update(artist_ids)
+    if not artist_ids:
+        return None
+    thread = threading.Thread(target=_refresh_worker, args=(artist_ids, sp), daemon=True)
+    thread.start()
+    return thread
+
+
+#Function that turns a batch of artist IDs into Artist rows.
+#Artists we already know come from the database, only the unknown ones are fetched from Spotify.
+#Returns a dict of artist_id -> Artist, artists Spotify couldn't give us are left out.
+def resolve_artists(artist_ids, sp):
+    artist_ids = list(dict.fromkeys(artist_id for artist_id in artist_ids if artist_id))
+    if not artist_ids:
+        return {}
+
+    artists = Artist.objects.in_bulk(artist_ids, field_name='artist_id')
+
+    missing = [artist_id for artist_id in artist_ids if artist_id not in artists]
+    if missing:
+        new_artists = [update_artist_from_json(Artist(artist_id=data['id']), data) for data in fetch_artists(missing, sp)]
+        Artist.objects.bulk_create(new_artists, ignore_conflicts=True, batch_size=500)
+        artists.update(Artist.objects.in_bulk(missing, field_name='artist_id'))
+        logger.info(f"Fetched {len(new_artists)} new artists from Spotify.")
+
+    stale_before = timezone.now() - ARTIST_TTL
+    stale = [artist.artist_id for artist in artists.values() if artist.fetched_at < stale_before]
+    if stale:
+        # The refresh writes on its own connection, started inside the caller's write transaction (ingest_tracks) it
+        # would wait on that transaction's lock, or fail with "database is locked" on SQLite. So it starts once the
+        # caller commits, or right away outside a transaction.
+        transaction.on_commit(partial(refresh_artists_in_background, stale, sp))
+
+    return artists
@@ -0,0 +1,4 @@
+from .collage import benchmark_genre_collage
+from .data import SyntheticCatalog, populate_database, synthetic_library
+from .fake_spotify import FakeSpotify
+from .runner import BENCHMARKS, compare_results, run_benchmarks, test_database
@@ -0,0 +1,94 @@
+import time
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from ..genres import build_genre_collage_index, primary_artist, top_genres_for_user
+from ..models import Song
+from .data import synthetic_library
+
+
+class _Rollback(Exception):
+    pass
+
+
+#The per-genre two-pass collage code view_top_genres used before build_genre_collage_index, kept as the baseline
+def legacy_genre_collages(user, genres):
+    user_songs = Song.objects.filter(users=user)
+    index = {}
+    for genre in genres:
+        songs_with_art = user_songs.filter(album_art__isnull=False).exclude(album_art__exact='').order_by('-popularity')
+        seen_artists = set()
+        seen_album_arts = set()
+        unique_images = []
+        unique_artists = []
+
+        def process_song(song, exact=True):
+            song_genres = [g.strip() for g in song.genres.split(',') if g.strip()]
+            if not song_genres:
+                return False
+            if exact and song_genres[0].lower() != genre.lower():
+                return False
+            if not exact and genre.lower() not in [g.lower() for g in song_genres]:
+                return False
+            if not song.artist_names:
+                return False
+            artist = primary_artist(song.artist_names)
+            album_art = song.album_art.strip()
+            if not album_art or album_art in seen_album_arts or artist in seen_artists:
+                return False
+            unique_images.append(album_art)
+            unique_artists.append(artist)
+            seen_artists.add(artist)
+            seen_album_arts.add(album_art)
+            return True
+
+        for song in songs_with_art:
+            if len(unique_images) >= 4:
+                break
+            process_song(song, exact=True)
+        if len(unique_images) < 4:
+            for song in songs_with_art:
+                if len(unique_images) >= 4:
+                    break
+                process_song(song, exact=False)
+        index[genre] = (unique_images, unique_artists)
+    return index
+
+
+def _measure(func, *args):
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+    return result, elapsed, len(queries.captured_queries)
+
+
+#Function that times the old and new genre collage builders on a synthetic library.
+#Everything runs inside a transaction that is rolled back, so the database is left untouched.
+def benchmark_genre_collage(n_songs=10000, seed=0):
+    results = {}
+    try:
+        with transaction.atomic():
+            user = User.objects.create(username=f"benchmark-user-{seed}")
+            synthetic_library(user, n_songs, seed=seed)
+            genres = [genre for genre, count in top_genres_for_user(user)]
+
+            legacy, legacy_time, legacy_queries = _measure(legacy_genre_collages, user, genres)
+            index, index_time, index_queries = _measure(build_genre_collage_index, user, genres)
+
+            results = {
+                'songs': n_songs,
+                'genres': len(genres),
+                'legacy_seconds': legacy_time,
+                'legacy_queries': legacy_queries,
+                'index_seconds': index_time,
+                'index_queries': index_queries,
+                'speedup': legacy_time / index_time if index_time else float('inf'),
+                'matching_genres': sum(1 for genre in genres if legacy[genre] == index[genre]),
+            }
+            raise _Rollback()
+    except _Rollback:
+        pass
+    return results
@@ -0,0 +1,174 @@
+import random
+from itertools import accumulate
+
+from django.contrib.auth.models import User
+
+from ..genres import link_song_genres, rebuild_genre_profile
+from ..ingestion import BATCH_SIZE, link_songs_to_user
+from ..models import Artist, Song
+
+
+#Function that fills the database with a made up library for one user.
+#Genres and artists are drawn with a skew so a few are very common and most are rare, like a real library.
+def synthetic_library(user, n_songs, n_genres=400, n_artists=2000, seed=0):
+    rng = random.Random(seed)
+    genres = [f"genre {i}" for i in range(n_genres)]
+    artists = [f"artist {i}" for i in range(n_artists)]
+    artist_genres = {artist: rng.sample(genres[:max(1, n_genres // (1 + i % 7))], k=rng.randint(1, 4)) for i, artist in enumerate(artists)}
+
+    songs = []
+    for i in range(n_songs):
+        artist = artists[min(int(rng.paretovariate(1.2)) - 1, n_artists - 1) if rng.random() < 0.5 else rng.randrange(n_artists)]
+        songs.append(Song(
+            track_id=f"synthetic{seed}x{i}",
+            track_name=f"Song {i}",
+            artist_names=artist,
+            album_art=f"https://example.com/art/{artist.replace(' ', '')}/{i % 5}.jpg",
+            genres=', '.join(artist_genres[artist]),
+            popularity=rng.randint(0, 100),
+        ))
+    Song.objects.bulk_create(songs, batch_size=500)
+    songs = list(Song.objects.filter(track_id__startswith=f"synthetic{seed}x"))
+    link_song_genres(songs)
+    link_songs_to_user([song.id for song in songs], user)
+    rebuild_genre_profile(user)
+    return songs
+
+
+class SkewedChoice:
+    """Draws items with a Zipf-like skew: the item at rank r is picked in proportion to 1 / (r + 1) ** skew.
+
+    A skew of 0 is uniform, around 1 looks like real listening data (a few huge genres and artists, a long tail).
+    """
+
+    def __init__(self, items, skew, rng):
+        self.items = items
+        self.rng = rng
+        self.cum_weights = list(accumulate(1 / (rank + 1) ** skew for rank in range(len(items))))
+
+    def _ranks(self, k):
+        return self.rng.choices(range(len(self.items)), cum_weights=self.cum_weights, k=k)
+
+    def __call__(self, k=1):
+        return [self.items[rank] for rank in self._ranks(k)]
+
+    def distinct(self, k):
+        # Redraw for the duplicates, with a strong skew the head items keep coming back so give up eventually
+        picked = {}
+        for attempt in range(20):
+            if len(picked) >= k:
+                break
+            picked.update(dict.fromkeys(self._ranks((k - len(picked)) * 2)))
+        return [self.items[rank] for rank in list(picked)[:k]]
+
+
+class SyntheticCatalog:
+    """A made up Spotify catalog, the same JSON shapes the Web API returns.
+
+    Artists get 1-4 genres and tracks get 1-2 artists, both drawn with the given skews. Tracks are grouped
+    into albums of up to 12 by their first artist. Everything is derived from seed, so two runs with the same
+    arguments get the same catalog.
+    """
+
+    def __init__(self, n_tracks, n_genres=400, n_artists=2000, genre_skew=1.0, artist_skew=1.0, seed=0):
+        rng = random.Random(seed)
+        self.seed = seed
+        self.genres = [f"genre {i}" for i in range(n_genres)]
+        pick_genres = SkewedChoice(self.genres, genre_skew, rng)
+
+        self.artists = []
+        for i in range(n_artists):
+            artist_id = f"bench{seed}artist{i}"
+            self.artists.append({
+                'id': artist_id,
+                'name': f"Artist {i}",
+                'genres': pick_genres.distinct(rng.randint(1, 4)),
+                'popularity': rng.randint(0, 100),
+                'images': [{'url': f"https://example.com/artists/{artist_id}.jpg"}],
+                'type': 'artist',
+            })
+        pick_artists = SkewedChoice(self.artists, artist_skew, rng)
+
+        self.tracks = []
+        self.albums = {}
+        for i in range(n_tracks):
+            artists = pick_artists.distinct(1 if rng.random() < 0.8 else 2)
+            album_id = f"bench{seed}album{artists[0]['id']}x{len(self.albums.get(artists[0]['id'], [])) // 12}"
+            album = {
+                'id': album_id,
+                'name': f"Album {album_id}",
+                'images': [{'url': f"https://example.com/albums/{album_id}.jpg"}],
+                'release_date': str(1960 + rng.randrange(65)),
+            }
+            track = {
+                'id': f"bench{seed}track{i}",
+                'name': f"Track {i}",
+                'popularity': rng.randint(0, 100),
+                'artists': [{'id': artist['id'], 'name': artist['name']} for artist in artists],
+                'album': album,
+                'is_local': False,
+                'type': 'track',
+            }
+            self.tracks.append(track)
+            self.albums.setdefault(artists[0]['id'], []).append(track)
+
+        self.artists_by_id = {artist['id']: artist for artist in self.artists}
+        self.tracks_by_id = {track['id']: track for track in self.tracks}
+        self.tracks_by_album = {}
+        self.tracks_by_genre = {}
+        self.tracks_by_artist_name = {}
+        for track in self.tracks:
+            self.tracks_by_album.setdefault(track['album']['id'], []).append(track)
+            for artist in track['artists']:
+                self.tracks_by_artist_name.setdefault(artist['name'].lower(), []).append(track)
+                for genre in self.artists_by_id[artist['id']]['genres']:
+                    self.tracks_by_genre.setdefault(genre, []).append(track)
+        # Search results come back most popular first, like Spotify's
+        for index in (self.tracks_by_genre, self.tracks_by_artist_name):
+            for tracks in index.values():
+                tracks.sort(key=lambda track: -track['popularity'])
+
+    def track_genres(self, track):
+        return list(dict.fromkeys(genre for artist in track['artists'] for genre in self.artists_by_id[artist['id']]['genres']))
+
+
+#Function that loads part of a catalog into the database as our users' libraries: the first n_songs tracks become
+#Songs (with their Artists, artist links and genre tags), and each of n_users users gets songs_per_user of them,
+#drawn with a popularity skew so libraries overlap like real ones. Returns the users.
+def populate_database(catalog, n_users, n_songs, songs_per_user, library_skew=1.0, seed=0):
+    rng = random.Random(seed)
+    tracks = catalog.tracks[:n_songs]
+
+    used_artists = {artist['id'] for track in tracks for artist in track['artists']}
+    Artist.objects.bulk_create(
+        [
+            Artist(artist_id=artist['id'], name=artist['name'], genres=', '.join(artist['genres']),
+                   image_url=artist['images'][0]['url'], popularity=artist['popularity'])
+            for artist in catalog.artists if artist['id'] in used_artists
+        ],
+        batch_size=BATCH_SIZE,
+    )
+    Song.objects.bulk_create(
+        [
+            Song(track_id=track['id'], track_name=track['name'], artist_names=', '.join(artist['name'] for artist in track['artists']),
+                 album_art=track['album']['images'][0]['url'], genres=', '.join(catalog.track_genres(track)), popularity=track['popularity'])
+            for track in tracks
+        ],
+        batch_size=BATCH_SIZE,
+    )
+    songs = Song.objects.in_bulk([track['id'] for track in tracks], field_name='track_id')
+    artists = dict(Artist.objects.filter(artist_id__startswith=f"bench{catalog.seed}artist").values_list('artist_id', 'id'))
+    Link = Song.artists.through
+    Link.objects.bulk_create(
+        [Link(song_id=songs[track['id']].id, artist_id=artists[artist['id']]) for track in tracks for artist in track['artists']],
+        batch_size=BATCH_SIZE, ignore_conflicts=True,
+    )
+    link_song_genres(list(songs.values()))
+
+    pick_songs = SkewedChoice(sorted(songs.values(), key=lambda song: -song.popularity), library_skew, rng)
+    User.objects.bulk_create([User(username=f"bench{seed}user{i}") for i in range(n_users)])
+    users = list(User.objects.filter(username__startswith=f"bench{seed}user").order_by('id'))
+    for user in users:
+        link_songs_to_user([song.id for song in pick_songs.distinct(songs_per_user)], user)
+        rebuild_genre_profile(user)
+    return users
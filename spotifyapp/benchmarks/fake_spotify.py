@@ -0,0 +1,180 @@
+import copy
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+# Search filters spotipy callers put in q, e.g. genre:"rock" or year:1990-2000
+SEARCH_FILTER = re.compile(r'(\w+):(?:"([^"]*)"|(\S+))')
+# Liked songs are "added" one minute apart going back from here, newest first
+SAVED_FROM = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def _timestamp(moment):
+    return moment.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class FakeSpotify:
+    """Stands in for spotipy.Spotify, answering from a SyntheticCatalog without touching the network.
+
+    Every call sleeps for ``latency`` seconds first, like a round trip to the Web API would, and is counted per
+    endpoint in ``calls``. Method signatures match spotipy's, so the response cache keys them the same way.
+    Responses are fresh copies, callers are free to mutate them like they would a parsed JSON body.
+    """
+
+    def __init__(self, catalog, latency=0.0, user_id='benchmark', saved_tracks=500, playlists=5, playlist_size=100):
+        self.catalog = catalog
+        self.latency = latency
+        self.user_id = user_id
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._created_playlists = 0
+        # The signed in user's library: their liked songs and playlists, cut from the front of the catalog
+        self.saved_tracks = [
+            {'added_at': _timestamp(SAVED_FROM - timedelta(minutes=i)), 'track': track}
+            for i, track in enumerate(catalog.tracks[:saved_tracks])
+        ]
+        self.playlists = {}
+        for i in range(playlists):
+            tracks = catalog.tracks[i * playlist_size:(i + 1) * playlist_size]
+            self.playlists[f"bench{catalog.seed}playlist{i}"] = (
+                {
+                    'id': f"bench{catalog.seed}playlist{i}",
+                    'name': f"Playlist {i}",
+                    'owner': {'id': user_id},
+                    'snapshot_id': f"bench{catalog.seed}snapshot{i}",
+                    'tracks': {'total': len(tracks)},
+                },
+                [{'added_at': _timestamp(SAVED_FROM), 'track': track} for track in tracks],
+            )
+
+    def _call(self, endpoint):
+        with self._lock:
+            self.calls[endpoint] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def total_calls(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    @staticmethod
+    def _page(items, limit, offset):
+        page = items[offset:offset + limit]
+        return {
+            'items': copy.deepcopy(page),
+            'limit': limit,
+            'offset': offset,
+            'total': len(items),
+            'next': None if offset + limit >= len(items) else f"offset={offset + limit}",
+        }
+
+    def _album(self, album):
+        album = copy.deepcopy(album)
+        album['artists'] = copy.deepcopy(self.catalog.tracks_by_album[album['id']][0]['artists'])
+        return album
+
+    def search(self, q, limit=10, offset=0, type='track', market=None):
+        self._call('search')
+        filters = {name.lower(): quoted or bare for name, quoted, bare in SEARCH_FILTER.findall(q.lower())}
+        if 'genre' in filters:
+            tracks = self.catalog.tracks_by_genre.get(filters['genre'], [])
+        elif 'artist' in filters:
+            tracks = self.catalog.tracks_by_artist_name.get(filters['artist'], [])
+        elif 'album' in filters:
+            # Album names are made up, so an album search for a word (hipster mode's genre names) matches the albums
+            # of artists in that genre
+            tracks = self.catalog.tracks_by_genre.get(filters['album'], [])
+        else:
+            tracks = []
+        if 'year' in filters:
+            low, _, high = filters['year'].partition('-')
+            high = high or low
+            tracks = [track for track in tracks if low <= track['album']['release_date'] <= high]
+
+        if type == 'album':
+            albums = list({track['album']['id']: track['album'] for track in tracks}.values())
+            page = self._page(albums, limit, offset)
+            page['items'] = [self._album(album) for album in page['items']]
+            return {'albums': page}
+        return {'tracks': self._page(tracks, limit, offset)}
+
+    def current_user_top_artists(self, limit=20, offset=0, time_range='medium_term'):
+        self._call('current_user_top_artists')
+        return self._page(self.catalog.artists, limit, offset)
+
+    def current_user_top_tracks(self, limit=20, offset=0, time_range='medium_term'):
+        self._call('current_user_top_tracks')
+        return self._page(self.catalog.tracks, limit, offset)
+
+    def current_user_recently_played(self, limit=50, after=None, before=None):
+        self._call('current_user_recently_played')
+        page = self._page(self.catalog.tracks, limit, 0)
+        page['items'] = [{'track': track, 'played_at': f"2024-01-01T00:{i // 60:02d}:{i % 60:02d}.000Z"} for i, track in enumerate(page['items'])]
+        page['next'] = None
+        return page
+
+    def current_user_saved_tracks(self, limit=20, offset=0, market=None):
+        self._call('current_user_saved_tracks')
+        return self._page(self.saved_tracks, limit, offset)
+
+    def current_user_playlists(self, limit=50, offset=0):
+        self._call('current_user_playlists')
+        return self._page([playlist for playlist, items in self.playlists.values()], limit, offset)
+
+    def playlist(self, playlist_id, fields=None, market=None, additional_types=('track',)):
+        self._call('playlist')
+        playlist, items = self.playlists.get(playlist_id, (None, []))
+        return copy.deepcopy(playlist)
+
+    def playlist_items(self, playlist_id, fields=None, limit=100, offset=0, market=None, additional_types=('track', 'episode')):
+        self._call('playlist_items')
+        playlist, items = self.playlists.get(playlist_id, (None, []))
+        return self._page(items, limit, offset)
+
+    def playlist_tracks(self, playlist_id, fields=None, limit=100, offset=0, market=None, additional_types=('track',)):
+        return self.playlist_items(playlist_id, fields, limit, offset, market, additional_types)
+
+    def artist(self, artist_id):
+        self._call('artist')
+        return copy.deepcopy(self.catalog.artists_by_id.get(artist_id))
+
+    def artists(self, artists):
+        self._call('artists')
+        return {'artists': [copy.deepcopy(self.catalog.artists_by_id.get(artist_id)) for artist_id in artists]}
+
+    def track(self, track_id, market=None):
+        self._call('track')
+        return copy.deepcopy(self.catalog.tracks_by_id.get(track_id))
+
+    def tracks(self, tracks, market=None):
+        self._call('tracks')
+        return {'tracks': [copy.deepcopy(self.catalog.tracks_by_id.get(track_id)) for track_id in tracks]}
+
+    def album_tracks(self, album_id, limit=50, offset=0, market=None):
+        self._call('album_tracks')
+        page = self._page(self.catalog.tracks_by_album.get(album_id, []), limit, offset)
+        # The album listing leaves out popularity and the album itself, like Spotify's simplified tracks
+        for track in page['items']:
+            track.pop('popularity', None)
+            track.pop('album', None)
+        return page
+
+    def current_user(self):
+        self._call('current_user')
+        return {'id': self.user_id, 'display_name': self.user_id}
+
+    def user_playlist_create(self, user, name, public=True, collaborative=False, description=''):
+        self._call('user_playlist_create')
+        with self._lock:
+            self._created_playlists += 1
+            return {'id': f"benchplaylist{self._created_playlists}", 'name': name}
+
+    def playlist_add_items(self, playlist_id, items, position=None):
+        self._call('playlist_add_items')
+        return {'snapshot_id': f"{playlist_id}-{len(items)}"}
+
+    def next(self, result):
+        self._call('next')
+        return None
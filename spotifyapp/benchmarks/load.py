@@ -0,0 +1,132 @@
+import random
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.contrib.auth.models import User
+from django.urls import reverse
+
+# What a virtual user does: name -> (method, URL name, form data, relative weight)
+SCENARIOS = {
+    'top_artists': ('get', 'view_top_artists', None, 3),
+    'top_songs': ('get', 'view_top_songs', None, 3),
+    'top_genres': ('get', 'view_top_genres', None, 2),
+    'last_50': ('get', 'view_last_50_songs', None, 1),
+    'api_genres': ('get', 'api_top_genres', None, 2),
+    'api_library': ('get', 'api_library_songs', None, 1),
+    'recommendations': ('post', 'get_recommendations', {'num_songs': 20, 'playlist_name': 'Load test'}, 1),
+    'genre_playlist': ('post', 'create_genre_playlist', {'explore_a_genre': 'genre 0', 'num_songs': 20}, 1),
+}
+
+
+#Function that makes sure the load test accounts exist, returns their usernames
+def ensure_users(count, password, prefix='loadtest'):
+    usernames = [f"{prefix}{i}" for i in range(count)]
+    existing = set(User.objects.filter(username__in=usernames).values_list('username', flat=True))
+    for username in usernames:
+        if username not in existing:
+            User.objects.create_user(username=username, password=password)
+    return usernames
+
+
+class VirtualUser:
+    """One simulated visitor with their own cookies, driving the site over HTTP like a browser would."""
+
+    def __init__(self, base_url, username, password):
+        self.base_url = base_url.rstrip('/')
+        self.username = username
+        self.password = password
+        self.http = requests.Session()
+
+    def url(self, name):
+        return self.base_url + reverse(name)
+
+    def _csrf(self):
+        return {'X-CSRFToken': self.http.cookies.get('csrftoken', ''), 'Referer': self.base_url + '/'}
+
+    #Method that logs in to the site and connects Spotify, following the OAuth redirects through whatever
+    #SPOTIFY_ACCOUNTS_URL the site uses (the fake server answers them instantly)
+    def sign_in(self):
+        self.http.get(self.url('login_view')).raise_for_status()
+        response = self.http.post(
+            self.url('login_view'),
+            data={'username': self.username, 'password': self.password, 'csrfmiddlewaretoken': self.http.cookies.get('csrftoken', '')},
+            headers=self._csrf(),
+        )
+        response.raise_for_status()
+        if 'sessionid' not in self.http.cookies:
+            raise RuntimeError(f"Couldn't log in as {self.username}.")
+        self.http.get(self.url('spotify_login')).raise_for_status()
+
+    def run(self, scenario):
+        method, name, data, weight = SCENARIOS[scenario]
+        if method == 'post':
+            return self.http.post(self.url(name), data=data, headers=self._csrf())
+        return self.http.get(self.url(name))
+
+
+class LoadResults:
+    """Latency and status of every request a load test made, per scenario."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timings = {}
+        self.errors = {}
+
+    def add(self, scenario, seconds, ok):
+        with self._lock:
+            self.timings.setdefault(scenario, []).append(seconds)
+            if not ok:
+                self.errors[scenario] = self.errors.get(scenario, 0) + 1
+
+    def summary(self, duration):
+        def percentile(values, share):
+            return values[min(len(values) - 1, int(share * len(values)))]
+
+        rows = {}
+        for scenario, timings in sorted(self.timings.items()):
+            timings = sorted(timings)
+            rows[scenario] = {
+                'requests': len(timings),
+                'errors': self.errors.get(scenario, 0),
+                'per_second': len(timings) / duration,
+                'mean': statistics.fmean(timings),
+                'p50': percentile(timings, 0.50),
+                'p95': percentile(timings, 0.95),
+                'p99': percentile(timings, 0.99),
+                'max': timings[-1],
+            }
+        return rows
+
+
+#Function that runs a load test: concurrency virtual users, signed in as the usernames round robin, keep picking
+#weighted scenarios and requesting them until duration seconds are up. Returns a summary per scenario.
+def run_load(base_url, usernames, password, concurrency=10, duration=60, scenarios=None, seed=0):
+    scenarios = scenarios or list(SCENARIOS)
+    weights = [SCENARIOS[scenario][3] for scenario in scenarios]
+    results = LoadResults()
+
+    # Sign everyone in one at a time before the clock starts, logins aren't what's being measured
+    users = [VirtualUser(base_url, usernames[number % len(usernames)], password) for number in range(concurrency)]
+    for user in users:
+        user.sign_in()
+
+    def worker(number):
+        rng = random.Random(seed + number)
+        while time.monotonic() < deadline:
+            scenario = rng.choices(scenarios, weights)[0]
+            start = time.perf_counter()
+            try:
+                ok = users[number].run(scenario).status_code < 400
+            except requests.RequestException:
+                ok = False
+            results.add(scenario, time.perf_counter() - start, ok)
+
+    started = time.monotonic()
+    deadline = started + duration
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(worker, number) for number in range(concurrency)]:
+            future.result()
+    return results.summary(time.monotonic() - started)
@@ -0,0 +1,244 @@
+import statistics
+import subprocess
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.http import HttpResponse
+from django.test import Client, RequestFactory
+from django.test.runner import DiscoverRunner
+from django.urls import reverse
+
+from ..genre_graph import build_genre_graph
+from ..metrics import RequestMetricsMiddleware
+from ..neighbors import build_track_neighbors
+from ..spotify_auth import use_client
+from ..spotify_client import CachedSpotify, catalog_cache, user_cache
+from ..views import get_or_create_song
+from .data import SyntheticCatalog, populate_database
+from .fake_spotify import FakeSpotify
+
+# How many tracks the get_or_create_song benchmarks feed through it
+SONG_BATCH = 100
+# How many requests the metrics benchmarks push through a bare view, with and without the middleware
+METRICS_REQUESTS = 1000
+
+
+class _Rollback(Exception):
+    pass
+
+
+class BenchmarkEnvironment:
+    """What the benchmarks run against: the synthetic catalog, the fake Spotify and a signed in test client.
+
+    The fake sits in the user's pooled client behind the real response cache, so views reach it the same way
+    they reach Spotify.
+    """
+
+    def __init__(self, catalog, users, spotify):
+        self.catalog = catalog
+        self.users = users
+        self.user = users[0]
+        self.spotify = spotify
+        self.sp = CachedSpotify(spotify, scope=self.user.id)
+        use_client(self.user.id, self.sp)
+        self.http = Client()
+        self.http.force_login(self.user)
+
+    def request(self, method, name, data=None):
+        response = getattr(self.http, method)(reverse(name), data or {})
+        if response.status_code >= 400:
+            raise RuntimeError(f"{method.upper()} {name} returned {response.status_code}")
+        return response
+
+
+# name -> (function taking a BenchmarkEnvironment, whether it's measured with warm caches)
+BENCHMARKS = {}
+
+
+def benchmark(name, warm=False):
+    def register(func):
+        BENCHMARKS[name] = (func, warm)
+        return func
+    return register
+
+
+@benchmark('view_top_genres')
+def view_top_genres(env):
+    env.request('get', 'view_top_genres')
+
+
+@benchmark('view_top_genres_warm', warm=True)
+def view_top_genres_warm(env):
+    env.request('get', 'view_top_genres')
+
+
+@benchmark('get_recommendations')
+def get_recommendations(env):
+    env.request('post', 'get_recommendations', {'num_songs': 20, 'playlist_name': 'Benchmark'})
+
+
+@benchmark('get_recommendations_hipster')
+def get_recommendations_hipster(env):
+    env.request('post', 'get_recommendations', {'num_songs': 20, 'playlist_name': 'Benchmark', 'hipster_mode': 'on'})
+
+
+@benchmark('create_genre_playlist')
+def create_genre_playlist(env):
+    env.request('post', 'create_genre_playlist', {'explore_a_genre': env.catalog.genres[0], 'num_songs': 50})
+
+
+@benchmark('get_or_create_song_existing')
+def get_or_create_song_existing(env):
+    for track in env.catalog.tracks[:SONG_BATCH]:
+        get_or_create_song(track, env.user, env.sp)
+
+
+@benchmark('get_or_create_song_new')
+def get_or_create_song_new(env):
+    # Tracks past the ones loaded into the database, so each one is ingested
+    for track in env.catalog.tracks[-SONG_BATCH:]:
+        get_or_create_song(track, env.user, env.sp)
+
+
+def _probe_view(request):
+    # A couple of queries, about what a cached page costs, so the difference between the two is the instrumentation
+    User.objects.filter(pk=1).exists()
+    User.objects.filter(pk=2).exists()
+    return HttpResponse()
+
+
+@benchmark('metrics_baseline')
+def metrics_baseline(env):
+    request = RequestFactory().get('/')
+    for _ in range(METRICS_REQUESTS):
+        _probe_view(request)
+
+
+@benchmark('metrics_middleware')
+def metrics_middleware(env):
+    request = RequestFactory().get('/')
+    middleware = RequestMetricsMiddleware(_probe_view)
+    for _ in range(METRICS_REQUESTS):
+        middleware(request)
+
+
+@contextmanager
+def count_queries():
+    counter = {'queries': 0}
+
+    def count(execute, sql, params, many, context):
+        counter['queries'] += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(count):
+        yield counter
+
+
+def reset_caches():
+    cache.clear()
+    catalog_cache.clear()
+    user_cache.clear()
+
+
+#Function that runs one benchmark repeat times and returns its timings, SQL query count and Spotify call count.
+#Every run starts from empty caches (warm benchmarks run once unmeasured first) and is rolled back afterwards,
+#so runs don't see each other's writes.
+def measure(env, func, repeat=3, warm=False):
+    seconds, queries, calls = [], [], []
+    for _ in range(repeat):
+        reset_caches()
+        try:
+            with transaction.atomic():
+                if warm:
+                    func(env)
+                before = env.spotify.total_calls()
+                with count_queries() as counter:
+                    start = time.perf_counter()
+                    func(env)
+                    seconds.append(time.perf_counter() - start)
+                queries.append(counter['queries'])
+                calls.append(env.spotify.total_calls() - before)
+                raise _Rollback()
+        except _Rollback:
+            pass
+    return {
+        'seconds': statistics.median(seconds),
+        'min_seconds': min(seconds),
+        'max_seconds': max(seconds),
+        'queries': max(queries),
+        'spotify_calls': max(calls),
+        'repeat': repeat,
+    }
+
+
+def git_commit():
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True, timeout=5)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return result.stdout.strip() or None
+
+
+#Context manager that runs the block against a fresh test database (created and destroyed like the test runner does),
+#so benchmarks never touch the real one
+@contextmanager
+def test_database():
+    runner = DiscoverRunner(verbosity=0, interactive=False)
+    runner.setup_test_environment()
+    old_config = runner.setup_databases()
+    try:
+        yield
+    finally:
+        runner.teardown_databases(old_config)
+        runner.teardown_test_environment()
+
+
+#Function that builds the synthetic data, runs the benchmarks (all of them, or the names in only) and returns the
+#results as a dict ready to be written out as JSON. Must run inside test_database().
+def run_benchmarks(users=20, songs=5000, catalog_tracks=20000, songs_per_user=500, genres=400, artists=2000,
+                   genre_skew=1.0, artist_skew=1.0, latency=0.02, repeat=3, only=None, seed=0):
+    parameters = {
+        'users': users, 'songs': songs, 'catalog_tracks': catalog_tracks, 'songs_per_user': songs_per_user,
+        'genres': genres, 'artists': artists, 'genre_skew': genre_skew, 'artist_skew': artist_skew,
+        'latency': latency, 'repeat': repeat, 'seed': seed,
+    }
+    started = time.perf_counter()
+    # The get_or_create_song_new tracks come from past the songs, make sure the catalog has them
+    catalog = SyntheticCatalog(max(catalog_tracks, songs + SONG_BATCH), genres, artists, genre_skew, artist_skew, seed)
+    synthetic_users = populate_database(catalog, users, songs, songs_per_user, seed=seed)
+    build_track_neighbors()
+    build_genre_graph()
+    env = BenchmarkEnvironment(catalog, synthetic_users, FakeSpotify(catalog, latency))
+    setup_seconds = time.perf_counter() - started
+
+    results = {}
+    for name, (func, warm) in BENCHMARKS.items():
+        if only and name not in only:
+            continue
+        results[name] = measure(env, func, repeat, warm)
+    return {
+        'commit': git_commit(),
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'parameters': parameters,
+        'setup_seconds': setup_seconds,
+        'benchmarks': results,
+    }
+
+
+#Function that lines up two result files benchmark by benchmark, returns rows of
+#(name, old seconds, new seconds, new/old, old queries, new queries, old Spotify calls, new Spotify calls)
+def compare_results(old, new):
+    rows = []
+    for name, result in new['benchmarks'].items():
+        before = old['benchmarks'].get(name)
+        if before is None:
+            continue
+        ratio = result['seconds'] / before['seconds'] if before['seconds'] else float('inf')
+        rows.append((name, before['seconds'], result['seconds'], ratio, before['queries'], result['queries'],
+                     before['spotify_calls'], result['spotify_calls']))
+    return rows
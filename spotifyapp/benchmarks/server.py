@@ -0,0 +1,256 @@
+import hashlib
+import itertools
+import json
+import logging
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Stands in for the server's own address inside response bodies (paging links), swapped for the address the client
+# used when a response goes out, so recordings replay on any host and port
+BASE_PLACEHOLDER = 'http://fake-spotify.invalid/'
+SPOTIFY_API = 'https://api.spotify.com'
+
+
+def _ints(query, **defaults):
+    return {name: int(query.get(name, default)) for name, default in defaults.items()}
+
+
+def _ids(query):
+    return [item for item in query.get('ids', '').split(',') if item]
+
+
+def _json(body):
+    return json.loads(body or b'null')
+
+
+# (method, path pattern, handler). Handlers get the FakeSpotify, the path's groups, the query dict and the body,
+# and return (status, payload). Paths are the ones spotipy requests, trailing slashes included where it sends them.
+ROUTES = [
+    ('GET', r'/v1/search/?', lambda sp, groups, query, body: (200, sp.search(
+        query.get('q', ''), type=query.get('type', 'track'), **_ints(query, limit=10, offset=0)))),
+    ('GET', r'/v1/artists/?', lambda sp, groups, query, body: (200, sp.artists(_ids(query)))),
+    ('GET', r'/v1/artists/([^/]+)', lambda sp, groups, query, body: (200, sp.artist(groups[0]))),
+    ('GET', r'/v1/tracks/?', lambda sp, groups, query, body: (200, sp.tracks(_ids(query)))),
+    ('GET', r'/v1/tracks/([^/]+)', lambda sp, groups, query, body: (200, sp.track(groups[0]))),
+    ('GET', r'/v1/albums/([^/]+)/tracks/?', lambda sp, groups, query, body: (200, sp.album_tracks(
+        groups[0], **_ints(query, limit=50, offset=0)))),
+    ('GET', r'/v1/me/?', lambda sp, groups, query, body: (200, sp.current_user())),
+    ('GET', r'/v1/me/top/artists/?', lambda sp, groups, query, body: (200, sp.current_user_top_artists(
+        time_range=query.get('time_range', 'medium_term'), **_ints(query, limit=20, offset=0)))),
+    ('GET', r'/v1/me/top/tracks/?', lambda sp, groups, query, body: (200, sp.current_user_top_tracks(
+        time_range=query.get('time_range', 'medium_term'), **_ints(query, limit=20, offset=0)))),
+    ('GET', r'/v1/me/player/recently-played/?', lambda sp, groups, query, body: (200, sp.current_user_recently_played(
+        **_ints(query, limit=50)))),
+    ('GET', r'/v1/me/tracks/?', lambda sp, groups, query, body: (200, sp.current_user_saved_tracks(
+        **_ints(query, limit=20, offset=0)))),
+    ('GET', r'/v1/me/playlists/?', lambda sp, groups, query, body: (200, sp.current_user_playlists(
+        **_ints(query, limit=50, offset=0)))),
+    ('GET', r'/v1/playlists/([^/]+)/tracks/?', lambda sp, groups, query, body: (200, sp.playlist_items(
+        groups[0], **_ints(query, limit=100, offset=0)))),
+    ('GET', r'/v1/playlists/([^/]+)/?', lambda sp, groups, query, body: (200, sp.playlist(groups[0]))),
+    ('POST', r'/v1/users/([^/]+)/playlists/?', lambda sp, groups, query, body: (201, sp.user_playlist_create(
+        groups[0], **{key: value for key, value in _json(body).items() if key in ('name', 'public', 'collaborative', 'description')}))),
+    ('POST', r'/v1/playlists/([^/]+)/tracks/?', lambda sp, groups, query, body: (201, sp.playlist_add_items(
+        groups[0], _json(body) or []))),
+]
+ROUTES = [(method, re.compile(pattern + '$'), handler) for method, pattern, handler in ROUTES]
+
+
+def _error(status, message):
+    return {'error': {'status': status, 'message': message}}
+
+
+#Function that points every paging link in a response at the server: a page's next becomes the same request with the
+#offset moved along. Pages are the dicts with items/limit/offset, at the top or one level down (search results).
+def _link_pages(payload, path, query):
+    if not isinstance(payload, dict):
+        return payload
+    for page in [payload, *[value for value in payload.values() if isinstance(value, dict)]]:
+        if page.get('next') and 'offset' in page and 'limit' in page:
+            next_query = {**query, 'offset': page['offset'] + page['limit'], 'limit': page['limit']}
+            page['next'] = f"{BASE_PLACEHOLDER}{path.lstrip('/')}?{urlencode(next_query)}"
+    return payload
+
+
+class Recording:
+    """Spotify responses keyed by request, in a JSON file: recorded once from the real API, replayed after.
+
+    A request's key is its method, path, sorted query and a hash of its body, so replays are deterministic.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self.responses = json.loads(self.path.read_text()) if self.path.exists() else {}
+
+    @staticmethod
+    def key(method, path, query, body):
+        key = f"{method} {path}?{urlencode(sorted(query.items()))}"
+        if body:
+            key += f" {hashlib.sha256(body).hexdigest()[:16]}"
+        return key
+
+    def get(self, key):
+        return self.responses.get(key)
+
+    def add(self, key, status, text):
+        with self._lock:
+            self.responses[key] = {'status': status, 'body': text}
+            self.path.write_text(json.dumps(self.responses, indent=1, sort_keys=True))
+
+
+class FakeSpotifyServer(ThreadingHTTPServer):
+    """A local stand-in for the Spotify Web API and accounts service.
+
+    Answers the API from a FakeSpotify (synthetic catalog), from a Recording (replay), or by forwarding to the
+    real API and recording what comes back (record). Every request waits ``latency`` seconds plus up to
+    ``jitter``, and a ``throttle_rate`` share of API requests get a 429 with a Retry-After of ``retry_after``.
+    /authorize and /api/token always answer locally, handing out made up codes and tokens.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, spotify=None, recording=None, upstream=None, latency=0.0, jitter=0.0,
+                 throttle_rate=0.0, retry_after=1, verbose=False):
+        super().__init__(address, FakeSpotifyHandler)
+        self.spotify = spotify
+        self.recording = recording
+        self.upstream = upstream.rstrip('/') + '/' if upstream else None
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.verbose = verbose
+        self.statuses = Counter()
+        self._lock = threading.Lock()
+        self._tokens = itertools.count(1)
+        self._random = random.Random()
+        self._session = requests.Session()
+
+    def count(self, status):
+        with self._lock:
+            self.statuses[status] += 1
+
+    def wait(self):
+        delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+
+    def throttled(self):
+        with self._lock:
+            return self._random.random() < self.throttle_rate
+
+    def new_token(self):
+        return next(self._tokens)
+
+    #Method that answers an API request, returns (status, JSON text)
+    def answer(self, method, path, query, body, headers):
+        if self.upstream:
+            return self.forward(method, path, query, body, headers)
+        if self.recording is not None:
+            recorded = self.recording.get(Recording.key(method, path, query, body))
+            if recorded is None:
+                return 404, json.dumps(_error(404, f"No recorded response for {method} {path}"))
+            return recorded['status'], recorded['body']
+
+        for route_method, pattern, handler in ROUTES:
+            match = pattern.match(path)
+            if match and route_method == method:
+                status, payload = handler(self.spotify, match.groups(), query, body)
+                if payload is None:
+                    return 404, json.dumps(_error(404, "Non existing id"))
+                return status, json.dumps(_link_pages(payload, path, query))
+        return 404, json.dumps(_error(404, "Service not found"))
+
+    #Method that sends an API request on to Spotify and records the answer (throttling and server errors aren't kept)
+    def forward(self, method, path, query, body, headers):
+        response = self._session.request(
+            method, self.upstream + path.lstrip('/'), params=query, data=body or None, timeout=10,
+            headers={name: headers[name] for name in ('Authorization', 'Content-Type') if headers.get(name)},
+        )
+        text = response.text.replace(self.upstream, BASE_PLACEHOLDER)
+        if self.recording is not None and response.status_code != 429 and response.status_code < 500:
+            self.recording.add(Recording.key(method, path, query, body), response.status_code, text)
+        return response.status_code, text
+
+
+class FakeSpotifyHandler(BaseHTTPRequestHandler):
+    server_version = 'FakeSpotify/1.0'
+    # Keep-alive, like the real API, so the app's pooled connections get reused
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send(self, status, text, headers=None):
+        data = text.replace(BASE_PLACEHOLDER, f"http://{self.headers.get('Host', 'localhost')}/").encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.count(status)
+
+    def _handle(self, method):
+        url = urlsplit(self.path)
+        query = dict(parse_qsl(url.query, keep_blank_values=True))
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        self.server.wait()
+
+        if url.path == '/authorize':
+            return self._authorize(query)
+        if url.path == '/api/token':
+            return self._token(dict(parse_qsl(body.decode())))
+        if self.server.throttled():
+            return self._send(429, json.dumps(_error(429, "API rate limit exceeded")), {'Retry-After': str(self.server.retry_after)})
+        try:
+            status, text = self.server.answer(method, url.path, query, body, self.headers)
+        except Exception as e:
+            logger.exception(f"Fake Spotify failed on {method} {self.path}")
+            status, text = 500, json.dumps(_error(500, str(e)))
+        self._send(status, text)
+
+    def _authorize(self, query):
+        # Consent is instant: straight back to the app with a code
+        location = f"{query.get('redirect_uri', '/')}?{urlencode({'code': f'fake-code-{self.server.new_token()}', 'state': query.get('state', '')})}"
+        self.send_response(302)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        self.server.count(302)
+
+    def _token(self, form):
+        number = self.server.new_token()
+        self._send(200, json.dumps({
+            'access_token': f"fake-access-{number}",
+            'token_type': 'Bearer',
+            'expires_in': 3600,
+            'refresh_token': form.get('refresh_token') or f"fake-refresh-{number}",
+            'scope': form.get('scope', ''),
+        }))
@@ -0,0 +1,105 @@
+import hashlib
+import logging
+import time
+
+from django.core.cache import cache
+from django.db.models import F
+from django.http import HttpResponse
+from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+
+from .metrics import record_cache
+from .models import UserSyncState
+
+logger = logging.getLogger(__name__)
+
+# How long a computed page is served before it gets rebuilt (seconds)
+DEFAULT_TIMEOUT = 15 * 60
+# How much longer an expired copy is kept, to be served while someone else rebuilds it
+STALE_GRACE = 60 * 60
+# A rebuild lock is given up after this long, in case the request holding it died
+LOCK_TIMEOUT = 60
+# How long a request with nothing to serve waits for another request's rebuild before building it itself
+REBUILD_WAIT = 10
+# How long the browser may reuse a cached page (back navigation, repeat visits) before asking us again
+BROWSER_MAX_AGE = 5 * 60
+
+
+#Function that returns the user's cache version, every cached page for the user is keyed by it.
+#It's kept on the user's sync state row rather than in the cache: the cache is per process, and most link changes
+#happen in the sync worker and poller processes, so only the database gets their bumps to the web processes. A row
+#also can't be evicted, so the version never falls back to one that old entries are still cached under.
+def user_cache_version(user_id):
+    return UserSyncState.objects.filter(user_id=user_id).values_list('cache_version', flat=True).first() or 0
+
+
+#Function that invalidates every cached page for the user at once, by moving them to a new version.
+#Called whenever the user's Song links change (see library.invalidate_library).
+def bump_user_cache_version(user_id):
+    if not UserSyncState.objects.filter(user_id=user_id).update(cache_version=F('cache_version') + 1):
+        state, created = UserSyncState.objects.get_or_create(user_id=user_id, defaults={'cache_version': 1})
+        if not created:
+            UserSyncState.objects.filter(user_id=user_id).update(cache_version=F('cache_version') + 1)
+
+
+#Function that returns a per-user computed value (usually a whole page's data), building it with build() when needed.
+#Only one request rebuilds a given value at a time (a lock taken with cache.add), the others get the previous
+#copy while it runs, even if that copy is expired or from before the last invalidation. A request with nothing at
+#all to serve waits for the rebuild. Values are keyed by name and the user's cache version, so
+#bump_user_cache_version makes the next request rebuild. Values that don't depend on the user's library (pages built
+#only from Spotify data) pass versioned=False and live out their timeout however often the library changes.
+def cached_for_user(user, name, build, timeout=DEFAULT_TIMEOUT, versioned=True):
+    key = f"user_page_{name}_{user.id}"
+    if versioned:
+        key += f"_v{user_cache_version(user.id)}"
+    latest_key = f"user_page_{name}_{user.id}_latest"
+
+    entry = cache.get(key)
+    if entry is not None and entry[0] > time.time():
+        record_cache('page', 'hit')
+        return entry[1]
+
+    lock_key = f"{key}_lock"
+    if cache.add(lock_key, 1, timeout=LOCK_TIMEOUT):
+        record_cache('page', 'miss')
+        try:
+            value = build()
+            entry = (time.time() + timeout, value)
+            cache.set_many({key: entry, latest_key: entry}, timeout=timeout + STALE_GRACE)
+            return value
+        finally:
+            cache.delete(lock_key)
+
+    # Someone else is rebuilding, serve what we had
+    stale = entry or cache.get(latest_key)
+    if stale is not None:
+        record_cache('page', 'stale')
+        return stale[1]
+
+    deadline = time.time() + REBUILD_WAIT
+    while time.time() < deadline:
+        time.sleep(0.05)
+        entry = cache.get(key)
+        if entry is not None:
+            record_cache('page', 'hit')
+            return entry[1]
+    record_cache('page', 'miss')
+    logger.warning(f"Gave up waiting on the {name} rebuild for user {user.id}, building it here.")
+    return build()
+
+
+#Function that serves a per-user page as HTML rendered once and kept with cached_for_user, with a strong ETag.
+#build() fetches the data and returns (template name, context, IDs of the ranked items on the page). The ETag is a
+#hash of those IDs, so a conditional GET for an unchanged page gets a 304 without calling Spotify or rendering.
+def cached_page_response(request, name, build, timeout=DEFAULT_TIMEOUT, versioned=True):
+    def render_page():
+        template_name, context, ids = build()
+        digest = hashlib.sha256('\n'.join([template_name, name, *ids]).encode()).hexdigest()
+        return f'"{digest}"', render_to_string(template_name, context)
+
+    etag, html = cached_for_user(request.user, name, render_page, timeout, versioned)
+    response = get_conditional_response(request, etag=etag) or HttpResponse(html)
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, max_age=BROWSER_MAX_AGE)
+    patch_vary_headers(response, ['Cookie'])
+    return response
@@ -0,0 +1,74 @@
+import contextvars
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+
+#Function that runs one call on a pool thread. The call can reach the ORM (a token refresh, the response cache),
+#which opens a connection for the thread, so it's closed before the thread goes back to the pool.
+def _pool_call(func, *args, **kwargs):
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+#Function that runs a list of zero-argument calls (usually functools.partial around a Spotify method) on a
+#bounded thread pool. Results come back in the same order as the calls, whatever order they finish in.
+#A call that raises is logged and gives None, so one failed request doesn't sink the rest.
+#Each call runs in a copy of the caller's context, so per-request metrics follow it onto the pool.
+def fetch_concurrently(calls, max_workers=None):
+    if not calls:
+        return []
+    max_workers = max_workers or settings.SPOTIFY_MAX_CONCURRENCY
+
+    def run(call):
+        try:
+            return call()
+        except Exception as e:
+            logger.warning(f"Spotify call {getattr(call, 'func', call).__name__} failed: {e}")
+            return None
+
+    if max_workers <= 1 or len(calls) == 1:
+        return [run(call) for call in calls]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(calls))) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, _pool_call, run, call) for call in calls]
+        return [future.result() for future in futures]
+
+
+#Function that pages through a Spotify listing, keeping the next few pages in flight while the caller works.
+#fetch_page(offset=...) gets one page and the first page's 'total' says how many follow. Yields (offset, page)
+#in order, with never more than `depth` pages fetched ahead, so memory stays flat however long the listing is.
+def iter_pages(fetch_page, page_size, start=0, depth=None):
+    depth = settings.SPOTIFY_MAX_CONCURRENCY if depth is None else depth
+    first = fetch_page(offset=start)
+    yield start, first
+    offsets = iter(range(start + page_size, first.get('total') or 0, page_size))
+
+    if depth < 1:
+        for offset in offsets:
+            yield offset, fetch_page(offset=offset)
+        return
+
+    executor = ThreadPoolExecutor(max_workers=depth)
+    pending = deque()
+    try:
+        for offset in offsets:
+            pending.append((offset, executor.submit(contextvars.copy_context().run, _pool_call, fetch_page, offset=offset)))
+            if len(pending) >= depth:
+                break
+        while pending:
+            offset, future = pending.popleft()
+            page = future.result()
+            following = next(offsets, None)
+            if following is not None:
+                pending.append((following, executor.submit(contextvars.copy_context().run, _pool_call, fetch_page, offset=following)))
+            yield offset, page
+    finally:
+        # The caller may stop early (or a page may fail), don't wait on pages nobody will read
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,124 @@
+import logging
+import threading
+import time
+
+import numpy as np
+from django.db import transaction
+from django.db.models import Case, FloatField, Max, Value, When
+from scipy import sparse
+
+from .genres import split_genres
+from .ingestion import BATCH_SIZE
+from .models import Artist, Genre, GenreEdge, Song
+from .neighbors import LINK_CHUNK, block_neighbors, link_matrix, similarity_blocks
+
+logger = logging.getLogger(__name__)
+
+# How many edges each genre keeps
+EDGES_PER_GENRE = 20
+# Running processes reload the graph this often (seconds), which is how they pick up a rebuild
+GRAPH_RELOAD_INTERVAL = 60 * 60
+
+
+#Function that reads the genres text of every artist into a sparse artist x genre matrix.
+#columns maps genre name -> column, artist genres no song of ours has (so not in Genre) are left out.
+def artist_genre_matrix(columns, chunk_size=LINK_CHUNK):
+    indptr, indices = [0], []
+    for genres in Artist.objects.exclude(genres='').values_list('genres', flat=True).iterator(chunk_size=chunk_size):
+        indices.extend(sorted({columns[name] for name in split_genres(genres) if name in columns}))
+        indptr.append(len(indices))
+    return sparse.csr_matrix(
+        (np.ones(len(indices), dtype=np.float32), np.array(indices, dtype=np.int32), np.array(indptr)),
+        shape=(len(indptr) - 1, len(columns)),
+    )
+
+
+#Function that rebuilds GenreEdge, returns how many edges were written.
+#Every song and every artist is a set of genres, two genres' weight is how many of those sets have both, normalized
+#by how common each genre is (cosine). Uses the same blocked top-k as the track neighbor index.
+def build_genre_graph(k=EDGES_PER_GENRE, chunk_size=LINK_CHUNK):
+    genres = list(Genre.objects.order_by('id').values_list('id', 'name'))
+    genre_ids = np.array([genre_id for genre_id, name in genres], dtype=np.int64)
+    songs, _ = link_matrix(Song.genre_tags.through, 'song_id', 'genre_id', columns=genre_ids, chunk_size=chunk_size)
+    artists = artist_genre_matrix({name: column for column, (genre_id, name) in enumerate(genres)}, chunk_size)
+    logger.info(f"Genre graph from {len(genres)} genres on {songs.shape[0]} songs and {artists.shape[0]} artists.")
+
+    matrix = sparse.vstack([songs, artists]).T.tocsr()
+    transposed = matrix.T.tocsr()
+    norms = np.sqrt(np.diff(matrix.indptr)).astype(np.float64)
+    genre_ids = genre_ids.tolist()
+
+    edges = []
+    for start, end in similarity_blocks(matrix):
+        rows, columns, weights = block_neighbors(matrix, transposed, norms, start, end, k)
+        edges += [
+            GenreEdge(genre_id=genre_ids[row], neighbor_id=genre_ids[column], weight=weight)
+            for row, column, weight in zip(rows.tolist(), columns.tolist(), weights.tolist())
+        ]
+    with transaction.atomic():
+        GenreEdge.objects.all().delete()
+        GenreEdge.objects.bulk_create(edges, batch_size=BATCH_SIZE)
+    load_genre_graph()
+    return len(edges)
+
+
+class GenreGraph:
+    """The genre edges in memory: genre name -> tuple of (neighbor name, weight), strongest first."""
+
+    def __init__(self, edges):
+        self.edges = edges
+        self.loaded_at = time.monotonic()
+
+    def neighbors(self, genre, limit):
+        return list(self.edges.get(genre, ())[:limit])
+
+
+_graph = None
+_graph_lock = threading.Lock()
+
+
+#Function that reads every GenreEdge into this process' GenreGraph, one query
+def load_genre_graph():
+    global _graph
+    edges = {}
+    rows = GenreEdge.objects.order_by('genre_id', '-weight', 'neighbor__name').values_list('genre__name', 'neighbor__name', 'weight')
+    for genre, neighbor, weight in rows:
+        edges.setdefault(genre, []).append((neighbor, weight))
+    _graph = GenreGraph({genre: tuple(neighbors) for genre, neighbors in edges.items()})
+    return _graph
+
+
+#Function that returns the process' genre graph, loading it the first time and again every GRAPH_RELOAD_INTERVAL
+def genre_graph():
+    graph = _graph
+    if graph is None or time.monotonic() - graph.loaded_at > GRAPH_RELOAD_INTERVAL:
+        with _graph_lock:
+            if _graph is graph:
+                graph = load_genre_graph()
+            else:
+                graph = _graph
+    return graph
+
+
+#Function that returns the genres closest to a genre as a list of (name, weight), strongest first
+def neighboring_genres(genre, limit=10):
+    return genre_graph().neighbors(genre, limit)
+
+
+#Function that returns songs from our catalog in some genres (a dict of genre name -> weight) that aren't in the
+#user's library, in one query. Songs in the highest weighted genres come first, then by popularity (lowest first
+#with least_popular_first). Returns dicts with the song's track_id, popularity, genres and affinity.
+def songs_in_genres(user, genre_weights, limit, least_popular_first=False):
+    if not genre_weights:
+        return []
+    affinity = Max(Case(
+        *[When(genre_tags__name=name, then=Value(weight)) for name, weight in genre_weights.items()],
+        output_field=FloatField(),
+    ))
+    return list(
+        Song.objects.filter(genre_tags__name__in=list(genre_weights))
+        .exclude(users=user)
+        .values('track_id', 'popularity', 'genres')
+        .annotate(affinity=affinity)
+        .order_by('-affinity', 'popularity' if least_popular_first else '-popularity', 'track_id')[:limit]
+    )
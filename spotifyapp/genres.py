@@ -0,0 +1,201 @@
+from django.db import transaction
+from django.db.models import Count, F
+
+from .models import Genre, Song, UserGenreProfile
+
+
+#Function that splits the comma-joined genres text on a Song or Artist into a clean list
+def split_genres(genres):
+    return [genre.strip() for genre in (genres or '').split(',') if genre.strip()]
+
+
+#Function that mirrors the genres text of some songs into the Genre table and the Song.genre_tags links
+def link_song_genres(songs):
+    song_genres = {song.id: set(split_genres(song.genres)) for song in songs}
+    names = set().union(*song_genres.values()) if song_genres else set()
+    if not names:
+        return
+
+    Genre.objects.bulk_create([Genre(name=name) for name in names], ignore_conflicts=True, batch_size=500)
+    genre_ids = dict(Genre.objects.filter(name__in=names).values_list('name', 'id'))
+
+    Link = Song.genre_tags.through
+    links = [
+        Link(song_id=song_id, genre_id=genre_ids[name])
+        for song_id, genres in song_genres.items()
+        for name in genres
+    ]
+    Link.objects.bulk_create(links, ignore_conflicts=True, batch_size=500)
+
+
+#Function that counts how many of the user's songs are in each genre straight from the song links.
+#This is a single GROUP BY in the database, returns a list of (genre, count).
+#The views read the precomputed UserGenreProfile instead, this is the source of truth used to build and check it.
+def count_user_genres(user, limit=None):
+    genres = (
+        Genre.objects.filter(songs__users=user)
+        .annotate(count=Count('songs'))
+        .order_by('-count', 'name')
+        .values_list('name', 'count')
+    )
+    if limit is not None:
+        genres = genres[:limit]
+    return list(genres)
+
+
+#Function that returns the user's genres with how many of their songs are in each, most common first
+def top_genres_for_user(user, limit=None):
+    genres = (
+        UserGenreProfile.objects.filter(user=user, song_count__gt=0)
+        .order_by('-song_count', 'genre__name')
+        .values_list('genre__name', 'song_count')
+    )
+    if limit is not None:
+        genres = genres[:limit]
+    return list(genres)
+
+
+#Function that adjusts a user's genre profile after songs were linked to (sign=1) or unlinked from (sign=-1) them.
+#Callers must only pass songs whose link really changed, otherwise the counts drift.
+def update_genre_profile(user_id, song_ids, sign=1):
+    song_ids = list(song_ids)
+    if not song_ids:
+        return
+
+    deltas = dict(
+        Song.genre_tags.through.objects.filter(song_id__in=song_ids)
+        .values('genre_id')
+        .annotate(songs=Count('song_id'))
+        .values_list('genre_id', 'songs')
+    )
+    if not deltas:
+        return
+
+    with transaction.atomic():
+        if sign > 0:
+            UserGenreProfile.objects.bulk_create(
+                [UserGenreProfile(user_id=user_id, genre_id=genre_id) for genre_id in deltas],
+                ignore_conflicts=True,
+                batch_size=500,
+            )
+
+        # Genres that moved by the same amount share one UPDATE, so this is a handful of statements, not one per genre
+        by_delta = {}
+        for genre_id, songs in deltas.items():
+            by_delta.setdefault(songs * sign, []).append(genre_id)
+        for delta, genre_ids in by_delta.items():
+            UserGenreProfile.objects.filter(user_id=user_id, genre_id__in=genre_ids).update(
+                song_count=F('song_count') + delta
+            )
+
+
+#Function that throws away a user's genre profile and recomputes it from their songs
+def rebuild_genre_profile(user):
+    counts = (
+        Song.genre_tags.through.objects.filter(song__users=user)
+        .values('genre_id')
+        .annotate(songs=Count('song_id'))
+        .values_list('genre_id', 'songs')
+    )
+    with transaction.atomic():
+        UserGenreProfile.objects.filter(user=user).delete()
+        UserGenreProfile.objects.bulk_create(
+            [UserGenreProfile(user=user, genre_id=genre_id, song_count=songs) for genre_id, songs in counts],
+            batch_size=500,
+        )
+
+
+#Function that compares a user's stored genre profile with a fresh count.
+#Returns a dict of genre -> (stored count, actual count) for every genre that disagrees, empty means consistent.
+def check_genre_profile(user):
+    stored = dict(top_genres_for_user(user))
+    actual = dict(count_user_genres(user))
+    return {
+        genre: (stored.get(genre, 0), actual.get(genre, 0))
+        for genre in set(stored) | set(actual)
+        if stored.get(genre, 0) != actual.get(genre, 0)
+    }
+
+
+# How many album covers (and artists) make up a genre collage
+COLLAGE_SIZE = 4
+
+
+#Function that picks the artist shown for a song, the first artist in the comma-joined names
+def primary_artist(artist_names):
+    if artist_names.startswith("Tyler, The Creator"):
+        return "Tyler, The Creator"
+    return artist_names.split(',')[0].strip()
+
+
+class _Collage:
+    def __init__(self):
+        self.images = []
+        self.artists = []
+        self.seen_artists = set()
+        self.seen_album_arts = set()
+        # Songs that have the genre but not as their first genre, held back for the second pass
+        self.candidates = []
+        self.candidate_arts = {}
+
+    def full(self):
+        return len(self.images) >= COLLAGE_SIZE
+
+    def add(self, artist, album_art):
+        if self.full() or album_art in self.seen_album_arts or artist in self.seen_artists:
+            return
+        self.images.append(album_art)
+        self.artists.append(artist)
+        self.seen_artists.add(artist)
+        self.seen_album_arts.add(album_art)
+
+    def hold(self, artist, album_art):
+        # Only songs the second pass could still pick are kept. An artist or cover already in the collage stays there,
+        # and an artist never needs more than COLLAGE_SIZE + 1 different covers held: at most COLLAGE_SIZE covers can
+        # be taken before their turn, so one of them is always free. The list stays small without changing the result.
+        if artist in self.seen_artists or album_art in self.seen_album_arts:
+            return
+        arts = self.candidate_arts.setdefault(artist, set())
+        if len(arts) > COLLAGE_SIZE or album_art in arts:
+            return
+        arts.add(album_art)
+        self.candidates.append((artist, album_art))
+
+
+#Function that builds the genre collages for a user in one walk over their songs, most popular first.
+#Each genre first takes songs where it is the song's first genre, then tops up with songs that have it anywhere,
+#never repeating an artist or album cover. Returns a dict of genre -> (images, artists), up to 4 of each.
+def build_genre_collage_index(user, genres):
+    collages = {genre.lower(): _Collage() for genre in genres}
+
+    songs = (
+        Song.objects.filter(users=user, album_art__isnull=False)
+        .exclude(album_art__exact='')
+        .order_by('-popularity')
+        .values_list('genres', 'artist_names', 'album_art')
+    )
+    for song_genres, artist_names, album_art in songs.iterator(chunk_size=2000):
+        song_genres = [genre.lower() for genre in split_genres(song_genres)]
+        album_art = album_art.strip()
+        if not song_genres or not artist_names or not album_art:
+            continue
+        artist = primary_artist(artist_names)
+
+        for genre in set(song_genres):
+            collage = collages.get(genre)
+            if collage is None or collage.full():
+                continue
+            if genre == song_genres[0]:
+                collage.add(artist, album_art)
+            else:
+                collage.hold(artist, album_art)
+
+    index = {}
+    for genre in genres:
+        collage = collages[genre.lower()]
+        for artist, album_art in collage.candidates:
+            if collage.full():
+                break
+            collage.add(artist, album_art)
+        index[genre] = (collage.images, collage.artists)
+    return index
@@ -0,0 +1,72 @@
+import logging
+
+from django.contrib.auth.models import User
+from django.utils.dateparse import parse_datetime
+
+from .ingestion import BATCH_SIZE, ingest_tracks
+from .models import ListeningHistory, UserSyncState
+from .rollups import update_listening_rollups
+from .spotify_auth import client_for_user
+
+logger = logging.getLogger(__name__)
+
+# Spotify only keeps a user's last 50 plays, so one request per poll gets everything
+RECENTLY_PLAYED_LIMIT = 50
+
+
+#Function that stores the plays Spotify has for the user since the last poll in ListeningHistory.
+#Uses the per-user 'after' cursor so only new plays come back, and a play seen twice is only stored once.
+#Returns how many plays were new.
+def ingest_recently_played(user, sp):
+    state, created = UserSyncState.objects.get_or_create(user=user)
+    results = sp.current_user_recently_played(limit=RECENTLY_PLAYED_LIMIT, after=state.recently_played_after)
+    items = [item for item in results.get('items', []) if item.get('track') and item.get('played_at')]
+    if not items:
+        return 0
+
+    songs = ingest_tracks([item['track'] for item in items], user, sp)
+    plays = {}
+    for item in items:
+        if item['track'].get('id') in songs:
+            song = songs[item['track']['id']]
+            played_at = parse_datetime(item['played_at'])
+            plays[(song.id, played_at)] = ListeningHistory(user=user, song=song, played_at=played_at)
+
+    # Only the plays in this batch are looked up, not the user's whole history
+    stored = set(
+        ListeningHistory.objects.filter(user=user, played_at__in={played_at for song_id, played_at in plays})
+        .values_list('song_id', 'played_at')
+    )
+    new_plays = [play for key, play in plays.items() if key not in stored]
+    # A poll running at the same time may still store some of these first, the unique constraint settles that
+    ListeningHistory.objects.bulk_create(new_plays, ignore_conflicts=True, batch_size=BATCH_SIZE)
+    added = len(new_plays)
+
+    cursor = (results.get('cursors') or {}).get('after')
+    if cursor is None:
+        cursor = max(int(played_at.timestamp() * 1000) for song_id, played_at in plays) if plays else None
+    if cursor is not None:
+        state.recently_played_after = int(cursor)
+        state.save(update_fields=['recently_played_after'])
+
+    logger.info(f"Stored {added} new plays for user {user.username}.")
+    return added
+
+
+#Function that polls recently played for every active user with Spotify connected and folds the new plays into
+#their listening rollups. One failing user doesn't stop the others.
+#Returns a dict of username -> new plays (None where the poll failed).
+def poll_recently_played(users=None):
+    users = User.objects.filter(is_active=True, spotify_token__isnull=False) if users is None else users
+    results = {}
+    for user in users:
+        try:
+            sp = client_for_user(user)
+            if sp is None:
+                continue
+            results[user.username] = ingest_recently_played(user, sp)
+            update_listening_rollups(user)
+        except Exception as e:
+            logger.error(f"Could not poll recently played for {user.username}: {e}")
+            results[user.username] = None
+    return results
@@ -0,0 +1,192 @@
+import logging
+from functools import partial
+from itertools import islice
+
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from .artists import resolve_artists
+from .concurrency import fetch_concurrently
+from .genres import link_song_genres, update_genre_profile
+from .library import invalidate_library
+from .models import Song
+
+logger = logging.getLogger(__name__)
+
+# How many tracks get written per bulk statement
+BATCH_SIZE = 500
+# The several-tracks endpoint takes at most 50 IDs per call
+TRACKS_PER_REQUEST = 50
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+#Function that dedupes a page of track dicts by track_id, keeping the first copy of each track
+def dedupe_tracks(tracks):
+    unique = {}
+    for track in tracks:
+        if not track or track.get('is_local'):
+            continue
+        track_id = track.get('id')
+        if track_id and track_id not in unique:
+            unique[track_id] = track
+    return unique
+
+
+#Function that builds an unsaved Song from the track JSON Spotify gives us
+def song_from_track(track, genres):
+    images = track.get('album', {}).get('images') or [{}]
+    return Song(
+        track_id=track['id'],
+        track_name=track.get('name', 'Unknown'),
+        artist_names=', '.join([artist.get('name', 'Unknown') for artist in track.get('artists', [])]),
+        album_art=images[0].get('url', ''),
+        genres=', '.join(genres),
+        popularity=track.get('popularity'),
+    )
+
+
+#Function that links a set of songs (by primary key) to a user in one statement, skipping links that already exist.
+#Returns the IDs of the songs that were newly linked.
+def link_songs_to_user(song_ids, user):
+    Link = Song.users.through
+    song_ids = list(song_ids)
+    # Most calls re-link songs the user already has, those are settled by this one read without taking the lock
+    if set(Link.objects.filter(user_id=user.id, song_id__in=song_ids).values_list('song_id', flat=True)) >= set(song_ids):
+        return []
+
+    with transaction.atomic():
+        # Linkers for the same user queue up on their user row, so nobody else can add links between the two reads
+        # below and the difference is exactly what this insert added (a sync worker and a page view often link
+        # the same top tracks at once, both counting them would push the genre profile up twice)
+        User.objects.select_for_update().filter(pk=user.id).values_list('pk', flat=True).first()
+        links = Link.objects.filter(user_id=user.id, song_id__in=song_ids)
+        before = set(links.values_list('song_id', flat=True))
+        Link.objects.bulk_create(
+            [Link(song_id=song_id, user_id=user.id) for song_id in song_ids if song_id not in before],
+            ignore_conflicts=True,
+            batch_size=BATCH_SIZE,
+        )
+        new_ids = [song_id for song_id in links.values_list('song_id', flat=True) if song_id not in before]
+
+        # Bulk inserts skip the m2m_changed signal, so the genre profile and library set are updated here instead
+        update_genre_profile(user.id, new_ids, sign=1)
+    if new_ids:
+        invalidate_library(user.id)
+    return new_ids
+
+
+#Function that removes the links between a user and some songs in one statement.
+#Returns the IDs of the songs that were actually unlinked.
+def unlink_songs_from_user(song_ids, user):
+    Link = Song.users.through
+    with transaction.atomic():
+        links = Link.objects.filter(user_id=user.id, song_id__in=list(song_ids))
+        removed_ids = list(links.values_list('song_id', flat=True))
+        links.delete()
+        update_genre_profile(user.id, removed_ids, sign=-1)
+    if removed_ids:
+        invalidate_library(user.id)
+        logger.info(f"Unlinked {len(removed_ids)} songs from user {user.username}.")
+    return removed_ids
+
+
+#Function that fills in the Song.artists links for freshly created songs
+def link_song_artists(songs_and_tracks, artists):
+    Link = Song.artists.through
+    links = []
+    for song, track in songs_and_tracks:
+        for artist in track.get('artists', []):
+            if artist.get('id') in artists:
+                links.append(Link(song_id=song.id, artist_id=artists[artist['id']].id))
+    Link.objects.bulk_create(links, ignore_conflicts=True, batch_size=BATCH_SIZE)
+
+
+def _ingest_batch(batch, user, sp):
+    track_ids = list(batch)
+    songs = Song.objects.in_bulk(track_ids, field_name='track_id')
+
+    # Tracks we already have are done after that read (and the link check), only new ones open a write transaction
+    new_tracks = [batch[track_id] for track_id in track_ids if track_id not in songs]
+    if new_tracks:
+        with transaction.atomic():
+            songs = _create_songs(track_ids, new_tracks, sp)
+    if user is not None:
+        link_songs_to_user([song.id for song in songs.values()], user)
+    return songs
+
+
+#Function that saves Songs (with their artist and genre links) for tracks we don't have yet.
+#Returns a dict of track_id -> Song for every track in track_ids that is in the database now.
+def _create_songs(track_ids, new_tracks, sp):
+    # Every unknown artist in the batch is resolved together, so an artist on 300 tracks is fetched once
+    artists = resolve_artists([artist.get('id') for track in new_tracks for artist in track.get('artists', [])], sp)
+    new_songs = []
+    for track in new_tracks:
+        genres = []
+        for artist in track.get('artists', []):
+            if artist.get('id') in artists:
+                genres.extend(artists[artist['id']].genre_list())
+        new_songs.append(song_from_track(track, genres))
+
+    # Another worker may insert the same track between our check and this insert,
+    # ignore_conflicts lets the unique track_id constraint settle that race for us
+    Song.objects.bulk_create(new_songs, ignore_conflicts=True, batch_size=BATCH_SIZE)
+
+    # bulk_create doesn't hand back primary keys when conflicts are ignored, so read them back
+    songs = Song.objects.in_bulk(track_ids, field_name='track_id')
+    created = [(songs[track['id']], track) for track in new_tracks if track['id'] in songs]
+    link_song_artists(created, artists)
+    link_song_genres([song for song, track in created])
+    return songs
+
+
+#Function that adds a whole page of tracks to the database and links them to the user.
+#Returns a dict of track_id -> Song for every track that made it in.
+def ingest_tracks(tracks, user, sp, batch_size=BATCH_SIZE):
+    unique = dedupe_tracks(tracks)
+    track_ids = list(unique)
+
+    songs = {}
+    for chunk in _chunks(track_ids, batch_size):
+        songs.update(_ingest_batch({track_id: unique[track_id] for track_id in chunk}, user, sp))
+
+    if user is not None:
+        logger.info(f"Ingested {len(songs)} songs for user {user.username}.")
+    return songs
+
+
+#Function that writes a stream of (tag, track) pairs to the database batch_size tracks at a time.
+#Only one batch is held in memory. Yields (tag of the batch's last track, dict of track_id -> Song) after each write.
+def ingest_in_batches(items, user, sp, batch_size=BATCH_SIZE):
+    items = iter(items)
+    while True:
+        batch = list(islice(items, batch_size))
+        if not batch:
+            return
+        yield batch[-1][0], ingest_tracks([track for tag, track in batch], user, sp, batch_size)
+
+
+#Function that turns a list of track IDs into Songs linked to the user, using as few Spotify calls as possible.
+#Tracks already in our catalog come from the database, only the rest are fetched, 50 per request,
+#and saved through the bulk path. Returns the Songs in the same order as track_ids, skipping any that failed.
+def hydrate_tracks(track_ids, user, sp):
+    track_ids = list(dict.fromkeys(track_id for track_id in track_ids if track_id))
+    songs = Song.objects.in_bulk(track_ids, field_name='track_id')
+    if user is not None and songs:
+        link_songs_to_user([song.id for song in songs.values()], user)
+
+    missing = [track_id for track_id in track_ids if track_id not in songs]
+    chunks = list(_chunks(missing, TRACKS_PER_REQUEST))
+    fetched = []
+    for results in fetch_concurrently([partial(sp.tracks, chunk) for chunk in chunks]):
+        if results:
+            fetched.extend([track for track in results.get('tracks', []) if track])
+    if fetched:
+        songs.update(ingest_tracks(fetched, user, sp))
+
+    logger.info(f"Hydrated {len(track_ids)} tracks, {len(missing)} fetched from Spotify in {len(chunks)} requests.")
+    return [songs[track_id] for track_id in track_ids if track_id in songs]
@@ -0,0 +1,36 @@
+from functools import partial
+
+from django.core.cache import cache
+from django.db import transaction
+
+from .caching import bump_user_cache_version, user_cache_version
+from .metrics import record_cache
+from .models import Song
+
+# Library sets move to a new key whenever songs are linked or unlinked, this only bounds how long old ones are kept
+LIBRARY_CACHE_TIMEOUT = 60 * 60
+
+
+def _library_cache_key(user_id, version):
+    return f"user_library_track_ids_{user_id}_v{version}"
+
+
+#Function that returns the set of track IDs in the user's library, loaded with one query and cached across requests.
+#Load it once per request and check candidates against it in memory instead of one exists() query per track.
+#It's keyed by the user's cache version, so links changed by any process (a sync worker, the poller) are seen here.
+def library_track_ids(user):
+    cache_key = _library_cache_key(user.id, user_cache_version(user.id))
+    track_ids = cache.get(cache_key)
+    record_cache('library', 'miss' if track_ids is None else 'hit')
+    if track_ids is None:
+        track_ids = frozenset(Song.objects.filter(users=user).values_list('track_id', flat=True))
+        cache.set(cache_key, track_ids, timeout=LIBRARY_CACHE_TIMEOUT)
+    return track_ids
+
+
+#Function that retires the cached library set and the user's cached pages (by bumping their cache version), called
+#whenever the user's Song links change. It waits for the surrounding transaction to commit (or runs straight away
+#outside one): a request rebuilding before then would read the links from before the change and cache them under
+#the new version. Rolled back changes drop nothing.
+def invalidate_library(user_id):
+    transaction.on_commit(partial(bump_user_cache_version, user_id))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from spotifyapp.benchmarks import benchmark_genre_collage
+
+
+class Command(BaseCommand):
+    help = "Compare the old per-genre collage passes with the one-pass collage index on a synthetic library."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--songs", type=int, default=10000)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        results = benchmark_genre_collage(options["songs"], options["seed"])
+        self.stdout.write(f"{results['songs']} songs, {results['genres']} genres")
+        self.stdout.write(f"  per-genre passes: {results['legacy_seconds']:.3f}s, {results['legacy_queries']} queries")
+        self.stdout.write(f"  one-pass index:   {results['index_seconds']:.3f}s, {results['index_queries']} queries")
+        self.stdout.write(f"  speedup: {results['speedup']:.1f}x, identical collages for {results['matching_genres']}/{results['genres']} genres")
@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from spotifyapp.genre_graph import EDGES_PER_GENRE, build_genre_graph, neighboring_genres
+from spotifyapp.neighbors import LINK_CHUNK
+
+
+class Command(BaseCommand):
+    help = "Rebuild the genre graph (which genres show up together on songs and artists) used to explore genres."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--edges", type=int, default=EDGES_PER_GENRE, help="Edges kept per genre.")
+        parser.add_argument("--chunk-size", type=int, default=LINK_CHUNK, help="Links read per query.")
+        parser.add_argument("--show", help="Print this genre's neighbors once the graph is built.")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        written = build_genre_graph(k=options["edges"], chunk_size=options["chunk_size"])
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {written} genre edges in {time.perf_counter() - started:.1f}s."
+        ))
+        if options["show"]:
+            for name, weight in neighboring_genres(options["show"], options["edges"]):
+                self.stdout.write(f"  {name}: {weight:.3f}")
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from spotifyapp.neighbors import BLOCK_PRODUCTS, LINK_CHUNK, MIN_SHARED_USERS, NEIGHBORS_PER_TRACK, build_track_neighbors
+
+
+class Command(BaseCommand):
+    help = "Rebuild the item-item neighbor index the recommender reads, from which users have which songs."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--neighbors", type=int, default=NEIGHBORS_PER_TRACK, help="Neighbors kept per song.")
+        parser.add_argument("--min-shared-users", type=int, default=MIN_SHARED_USERS,
+                            help="Users two songs need in common to be neighbors.")
+        parser.add_argument("--block-products", type=int, default=BLOCK_PRODUCTS,
+                            help="Co-occurrence products computed at once, lower it to use less memory.")
+        parser.add_argument("--chunk-size", type=int, default=LINK_CHUNK, help="Song.users links read per query.")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        written = build_track_neighbors(
+            k=options["neighbors"],
+            min_shared=options["min_shared_users"],
+            max_products=options["block_products"],
+            chunk_size=options["chunk_size"],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {written} track neighbors in {time.perf_counter() - started:.1f}s."
+        ))
@@ -0,0 +1,45 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from spotifyapp.benchmarks.load import SCENARIOS, ensure_users, run_load
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive a running site with concurrent signed in users over HTTP and report latency per page. "
+        "Run the site against `manage.py run_fake_spotify` so no Spotify quota is used."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="http://127.0.0.1:8000", help="Where the site is running.")
+        parser.add_argument("--users", type=int, default=10, help="Accounts to spread the load over.")
+        parser.add_argument("--password", default="load-test-password")
+        parser.add_argument("--concurrency", type=int, default=10, help="Requests in flight at once.")
+        parser.add_argument("--duration", type=float, default=60, help="Seconds to keep the load up.")
+        parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), help="Only these pages.")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", help="Also write the summary to this JSON file.")
+
+    def handle(self, *args, **options):
+        usernames = ensure_users(options["users"], options["password"])
+        summary = run_load(
+            options["url"],
+            usernames,
+            options["password"],
+            concurrency=options["concurrency"],
+            duration=options["duration"],
+            scenarios=options["scenarios"],
+            seed=options["seed"],
+        )
+
+        self.stdout.write(f"{'scenario':16} {'requests':>8} {'errors':>6} {'req/s':>7} {'p50':>7} {'p95':>7} {'p99':>7} {'max':>7}")
+        for scenario, row in summary.items():
+            self.stdout.write(
+                f"{scenario:16} {row['requests']:8} {row['errors']:6} {row['per_second']:7.2f} "
+                f"{row['p50']:7.3f} {row['p95']:7.3f} {row['p99']:7.3f} {row['max']:7.3f}"
+            )
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(summary, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Summary written to {options['output']}."))
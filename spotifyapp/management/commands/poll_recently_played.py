@@ -0,0 +1,30 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from spotifyapp.history import poll_recently_played
+
+
+class Command(BaseCommand):
+    help = "Keep every user's listening history current by polling Spotify's recently played tracks."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", help="Only poll this username.")
+        parser.add_argument("--once", action="store_true", help="Poll once and exit instead of looping.")
+        # Spotify only remembers the last 50 plays, poll often enough that nobody gets through more than that in between
+        parser.add_argument("--interval", type=float, default=15 * 60, help="Seconds between polls.")
+
+    def handle(self, *args, **options):
+        while True:
+            users = User.objects.filter(is_active=True, spotify_token__isnull=False)
+            if options["user"]:
+                users = users.filter(username=options["user"])
+            for username, added in poll_recently_played(users).items():
+                if added is None:
+                    self.stderr.write(f"{username}: poll failed")
+                else:
+                    self.stdout.write(f"{username}: {added} new plays")
+            if options["once"]:
+                return
+            time.sleep(options["interval"])
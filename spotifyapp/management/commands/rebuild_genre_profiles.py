@@ -0,0 +1,37 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from spotifyapp.genres import check_genre_profile, rebuild_genre_profile
+
+
+class Command(BaseCommand):
+    help = "Rebuild (or with --check, verify) the per-user genre profiles from the Song links."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", help="Only this username, defaults to every user.")
+        parser.add_argument("--check", action="store_true", help="Report drift instead of rebuilding.")
+
+    def handle(self, *args, **options):
+        users = User.objects.order_by("id")
+        if options["user"]:
+            users = users.filter(username=options["user"])
+            if not users.exists():
+                raise CommandError(f"No user named {options['user']}.")
+
+        drifted = 0
+        for user in users:
+            if options["check"]:
+                mismatches = check_genre_profile(user)
+                if mismatches:
+                    drifted += 1
+                    self.stdout.write(f"{user.username}: {len(mismatches)} genres out of sync")
+                    for genre, (stored, actual) in sorted(mismatches.items()):
+                        self.stdout.write(f"  {genre}: stored {stored}, actual {actual}")
+            else:
+                rebuild_genre_profile(user)
+                self.stdout.write(f"Rebuilt genre profile for {user.username}.")
+
+        if drifted:
+            raise CommandError(f"{drifted} user(s) have a genre profile out of sync, run without --check to repair.")
+        if options["check"]:
+            self.stdout.write(self.style.SUCCESS("All genre profiles are consistent."))
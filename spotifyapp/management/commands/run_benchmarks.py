@@ -0,0 +1,71 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from spotifyapp.benchmarks import BENCHMARKS, compare_results, run_benchmarks, test_database
+
+
+class Command(BaseCommand):
+    help = (
+        "Time the views and hot helpers on synthetic users against a fake Spotify, offline and in a throwaway "
+        "test database. Reports wall time, SQL queries and Spotify calls per benchmark and writes them to a JSON file."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=20)
+        parser.add_argument("--songs", type=int, default=5000, help="Songs in our database, spread over the users' libraries.")
+        parser.add_argument("--catalog-tracks", type=int, default=20000, help="Tracks the fake Spotify knows about.")
+        parser.add_argument("--songs-per-user", type=int, default=500)
+        parser.add_argument("--genres", type=int, default=400)
+        parser.add_argument("--artists", type=int, default=2000)
+        parser.add_argument("--genre-skew", type=float, default=1.0, help="0 is uniform, higher makes a few genres dominate.")
+        parser.add_argument("--artist-skew", type=float, default=1.0, help="0 is uniform, higher makes a few artists dominate.")
+        parser.add_argument("--latency", type=float, default=20, help="Milliseconds every fake Spotify call takes.")
+        parser.add_argument("--repeat", type=int, default=3)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), help="Run just these benchmarks.")
+        parser.add_argument("--output", help="Where to write the JSON results, defaults to benchmark-<commit>.json.")
+        parser.add_argument("--compare", help="An earlier results file to compare against.")
+
+    def handle(self, *args, **options):
+        previous = None
+        if options["compare"]:
+            try:
+                with open(options["compare"]) as f:
+                    previous = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Can't read {options['compare']}: {e}")
+
+        with test_database():
+            results = run_benchmarks(
+                users=options["users"],
+                songs=options["songs"],
+                catalog_tracks=options["catalog_tracks"],
+                songs_per_user=options["songs_per_user"],
+                genres=options["genres"],
+                artists=options["artists"],
+                genre_skew=options["genre_skew"],
+                artist_skew=options["artist_skew"],
+                latency=options["latency"] / 1000,
+                repeat=options["repeat"],
+                only=options["only"],
+                seed=options["seed"],
+            )
+
+        self.stdout.write(f"Synthetic data built in {results['setup_seconds']:.1f}s.")
+        self.stdout.write(f"{'benchmark':32} {'seconds':>9} {'queries':>8} {'spotify':>8}")
+        for name, result in results["benchmarks"].items():
+            self.stdout.write(f"{name:32} {result['seconds']:9.3f} {result['queries']:8} {result['spotify_calls']:8}")
+
+        if previous:
+            self.stdout.write(f"\nCompared with {previous.get('commit') or options['compare']}:")
+            for name, old_seconds, new_seconds, ratio, old_queries, new_queries, old_calls, new_calls in compare_results(previous, results):
+                self.stdout.write(
+                    f"{name:32} {old_seconds:.3f}s -> {new_seconds:.3f}s ({ratio:.2f}x), "
+                    f"queries {old_queries} -> {new_queries}, spotify {old_calls} -> {new_calls}"
+                )
+
+        output = options["output"] or f"benchmark-{results['commit'] or 'results'}.json"
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+        self.stdout.write(self.style.SUCCESS(f"Results written to {output}."))
@@ -0,0 +1,72 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from spotifyapp.benchmarks import FakeSpotify, SyntheticCatalog
+from spotifyapp.benchmarks.server import SPOTIFY_API, FakeSpotifyServer, Recording
+
+
+class Command(BaseCommand):
+    help = (
+        "Serve a local stand-in for the Spotify Web API and accounts service, for load testing without Spotify. "
+        "Answers from a synthetic catalog, or with --record/--replay from real responses recorded once."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8900)
+        parser.add_argument("--latency", type=float, default=50, help="Milliseconds every request takes.")
+        parser.add_argument("--jitter", type=float, default=0, help="Up to this many extra milliseconds, at random.")
+        parser.add_argument("--throttle-rate", type=float, default=0, help="Share of API requests (0-1) answered with a 429.")
+        parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with injected 429s.")
+        parser.add_argument("--tracks", type=int, default=20000, help="Tracks in the synthetic catalog.")
+        parser.add_argument("--genres", type=int, default=400)
+        parser.add_argument("--artists", type=int, default=2000)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--record", metavar="FILE", help="Forward to the real API and record its responses here.")
+        parser.add_argument("--upstream", default=SPOTIFY_API, help="The API --record forwards to.")
+        parser.add_argument("--replay", metavar="FILE", help="Answer only with responses recorded in this file.")
+        parser.add_argument("--verbose", action="store_true", help="Log every request.")
+
+    def handle(self, *args, **options):
+        if options["record"] and options["replay"]:
+            raise CommandError("Use either --record or --replay, not both.")
+
+        spotify, recording, upstream = None, None, None
+        if options["record"]:
+            recording, upstream = Recording(options["record"]), options["upstream"]
+            mode = f"recording {upstream} into {options['record']}"
+        elif options["replay"]:
+            try:
+                recording = Recording(options["replay"])
+            except ValueError as e:
+                raise CommandError(f"Can't read {options['replay']}: {e}")
+            if not recording.responses:
+                raise CommandError(f"{options['replay']} has no recorded responses.")
+            mode = f"replaying {len(recording.responses)} responses from {options['replay']}"
+        else:
+            catalog = SyntheticCatalog(options["tracks"], options["genres"], options["artists"], seed=options["seed"])
+            spotify = FakeSpotify(catalog)
+            mode = f"synthetic catalog of {len(catalog.tracks)} tracks"
+
+        server = FakeSpotifyServer(
+            (options["host"], options["port"]),
+            spotify=spotify,
+            recording=recording,
+            upstream=upstream,
+            latency=options["latency"] / 1000,
+            jitter=options["jitter"] / 1000,
+            throttle_rate=options["throttle_rate"],
+            retry_after=options["retry_after"],
+            verbose=options["verbose"],
+        )
+        address = f"http://{options['host']}:{options['port']}"
+        self.stdout.write(f"Fake Spotify on {address}, {mode}.")
+        self.stdout.write(f"Point the app at it with SPOTIFY_API_URL={address}/v1/ SPOTIFY_ACCOUNTS_URL={address}")
+        if options["record"]:
+            self.stdout.write("Keep the real SPOTIFY_ACCOUNTS_URL while recording, the tokens have to be real ones.")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(f"Responses sent: {dict(server.statuses)}")
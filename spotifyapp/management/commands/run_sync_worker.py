@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from spotifyapp.spotify_auth import client_for_user
+from spotifyapp.sync import claim_next_job, run_job
+
+
+class Command(BaseCommand):
+    help = "Run queued library sync jobs. Start as many of these as you like, each job is claimed by exactly one."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Exit once the queue is empty instead of polling.")
+        parser.add_argument("--poll-interval", type=float, default=2.0, help="Seconds to wait when the queue is empty.")
+
+    def handle(self, *args, **options):
+        while True:
+            job = claim_next_job()
+            if job is None:
+                if options["once"]:
+                    return
+                time.sleep(options["poll_interval"])
+                continue
+            job = run_job(job, client_for_user(job.user))
+            self.stdout.write(f"Sync {job.id} for {job.user.username}: {job.status}, {job.tracks_ingested} tracks, {job.errors} errors")
@@ -0,0 +1,27 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from spotifyapp.rollups import rebuild_listening_rollups, update_listening_rollups
+
+
+class Command(BaseCommand):
+    help = "Fold new listening history into the hourly/daily/weekly/all-time rollups (or with --rebuild, recount them)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", help="Only this username, defaults to every user.")
+        parser.add_argument("--rebuild", action="store_true", help="Drop the rollups and recount all history.")
+
+    def handle(self, *args, **options):
+        users = User.objects.order_by("id")
+        if options["user"]:
+            users = users.filter(username=options["user"])
+            if not users.exists():
+                raise CommandError(f"No user named {options['user']}.")
+
+        for user in users:
+            if options["rebuild"]:
+                folded = rebuild_listening_rollups(user)
+            else:
+                folded = update_listening_rollups(user)
+            if folded:
+                self.stdout.write(f"{user.username}: {folded} plays folded in.")
@@ -0,0 +1,260 @@
+import logging
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the request duration histogram buckets (seconds)
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Upper bounds of the instrumentation overhead histogram buckets (seconds), it should stay in the first few
+OVERHEAD_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001)
+# View label for work done outside a request (management commands, background sync threads)
+NO_VIEW = 'none'
+
+# The metrics of the request being served. fetch_concurrently and iter_pages copy the context into their threads,
+# so Spotify calls made there land on the request that asked for them.
+_current = ContextVar('request_metrics', default=None)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class CounterMetric:
+    """A Prometheus counter with labels, kept in this process only (like the locmem cache, every worker has its own)."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+
+    def inc(self, labels=(), amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield f"{self.name}{_labels(self.labelnames, labels)} {value}"
+
+
+class HistogramMetric:
+    """A Prometheus histogram with labels, kept in this process only."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, labels, value):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][i] += 1
+                break
+        entry[1] += value
+        entry[2] += 1
+
+    def samples(self):
+        for labels, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket{_labels(self.labelnames, labels, [('le', bound)])} {cumulative}"
+            yield f"{self.name}_bucket{_labels(self.labelnames, labels, [('le', '+Inf')])} {count}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {total}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {count}"
+
+
+# One lock for every metric, taken once per request when its totals are added in
+_lock = threading.Lock()
+
+REQUEST_SECONDS = HistogramMetric('django_request_duration_seconds', 'Wall time of requests.', ('view', 'method', 'status'))
+DB_QUERIES = CounterMetric('django_db_queries_total', 'SQL queries run.', ('view',))
+DB_SECONDS = CounterMetric('django_db_query_seconds_total', 'Time spent running SQL queries.', ('view',))
+SPOTIFY_CALLS = CounterMetric('spotify_requests_total', 'HTTP requests to Spotify, by response status.', ('view', 'status'))
+SPOTIFY_SECONDS = CounterMetric('spotify_request_seconds_total', 'Time spent waiting on Spotify responses.', ('view',))
+CACHE_REQUESTS = CounterMetric('cache_requests_total', 'Cache lookups, by cache and result (hit, stale or miss).', ('cache', 'result'))
+OVERHEAD_SECONDS = HistogramMetric(
+    'metrics_overhead_seconds', "Time the request middleware spends on its own bookkeeping.", (), OVERHEAD_BUCKETS,
+)
+METRICS = [REQUEST_SECONDS, DB_QUERIES, DB_SECONDS, SPOTIFY_CALLS, SPOTIFY_SECONDS, CACHE_REQUESTS, OVERHEAD_SECONDS]
+
+
+class RequestMetrics:
+    """What one request spent its time on: SQL, Spotify and cache lookups.
+
+    Shared with the threads the request fans Spotify calls out to, hence the lock.
+    """
+
+    def __init__(self):
+        self.view = NO_VIEW
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.spotify_calls = 0
+        self.spotify_seconds = 0.0
+        self.spotify_statuses = Counter()
+        self.cache_results = Counter()
+        self._lock = threading.Lock()
+
+    def add_query(self, seconds):
+        with self._lock:
+            self.db_queries += 1
+            self.db_seconds += seconds
+
+    def add_spotify_call(self, status, seconds):
+        with self._lock:
+            self.spotify_calls += 1
+            self.spotify_seconds += seconds
+            self.spotify_statuses[status] += 1
+
+    def add_cache_result(self, cache_name, result):
+        with self._lock:
+            self.cache_results[(cache_name, result)] += 1
+
+    #Method that adds this request's totals to the process wide metrics, in one go under the lock
+    def publish(self, method=None, status=None, seconds=None):
+        view = (self.view,)
+        with _lock:
+            if seconds is not None:
+                REQUEST_SECONDS.observe((self.view, method, status), seconds)
+            if self.db_queries:
+                DB_QUERIES.inc(view, self.db_queries)
+                DB_SECONDS.inc(view, self.db_seconds)
+            for spotify_status, count in self.spotify_statuses.items():
+                SPOTIFY_CALLS.inc((self.view, spotify_status), count)
+            if self.spotify_calls:
+                SPOTIFY_SECONDS.inc(view, self.spotify_seconds)
+            for labels, count in self.cache_results.items():
+                CACHE_REQUESTS.inc(labels, count)
+
+    def server_timing(self, total, overhead):
+        hits = sum(count for (cache_name, result), count in self.cache_results.items() if result == 'hit')
+        misses = sum(self.cache_results.values()) - hits
+        # Spotify calls overlap when fanned out, so the Python share is only an estimate
+        python = max(0.0, total - self.db_seconds - self.spotify_seconds)
+        return ', '.join([
+            f'db;dur={self.db_seconds * 1000:.1f};desc="{self.db_queries} queries"',
+            f'spotify;dur={self.spotify_seconds * 1000:.1f};desc="{self.spotify_calls} calls"',
+            f'cache;desc="{hits} hits, {misses} misses"',
+            f'app;dur={python * 1000:.1f}',
+            f'metrics;dur={overhead * 1000:.3f}',
+            f'total;dur={total * 1000:.1f}',
+        ])
+
+
+#Function that records one SQL query. Installed on every database connection as it opens (see signals.py),
+#it only times queries while a request is being measured.
+def record_query(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.add_query(time.perf_counter() - started)
+
+
+#Function that records one HTTP request to Spotify, status is the response code or 'error' when none came back.
+#Statuses are kept as text, the label tuples are sorted when rendered and ints don't sort against 'error'.
+def record_spotify_call(status, seconds):
+    status = str(status)
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.add_spotify_call(status, seconds)
+        return
+    with _lock:
+        SPOTIFY_CALLS.inc((NO_VIEW, status))
+        SPOTIFY_SECONDS.inc((NO_VIEW,), seconds)
+
+
+#Function that records every response on the shared Spotify session (a requests response hook), elapsed is the
+#time until the response headers arrived
+def record_spotify_response(response, *args, **kwargs):
+    record_spotify_call(response.status_code, response.elapsed.total_seconds())
+
+
+#Function that records a cache lookup, result is 'hit', 'stale' (an expired copy was served) or 'miss'
+def record_cache(cache_name, result):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.add_cache_result(cache_name, result)
+        return
+    with _lock:
+        CACHE_REQUESTS.inc((cache_name, result))
+
+
+class RequestMetricsMiddleware:
+    """Measures every request: wall time, SQL queries, Spotify calls and cache lookups, labelled by view.
+
+    Totals go to the process wide metrics served at /metrics, and with METRICS_SERVER_TIMING to a Server-Timing
+    header for the browser's dev tools. The middleware's own bookkeeping is timed into metrics_overhead_seconds.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        overhead = time.perf_counter() - started
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+
+        finished = time.perf_counter()
+        total = finished - started
+        metrics.publish(request.method, response.status_code, total)
+        if settings.METRICS_SERVER_TIMING:
+            response['Server-Timing'] = metrics.server_timing(total, overhead + time.perf_counter() - finished)
+        overhead += time.perf_counter() - finished
+        with _lock:
+            OVERHEAD_SECONDS.observe((), overhead)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        metrics = _current.get()
+        if metrics is not None and request.resolver_match is not None:
+            metrics.view = request.resolver_match.view_name
+        return None
+
+
+#Function that renders every metric in the Prometheus text format
+def render_metrics():
+    lines = []
+    with _lock:
+        for metric in METRICS:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
+
+
+#View that serves the metrics to Prometheus, only to the addresses in METRICS_ALLOWED_IPS (None lets everyone in)
+def metrics_view(request):
+    allowed = settings.METRICS_ALLOWED_IPS
+    if allowed is not None and request.META.get('REMOTE_ADDR') not in allowed:
+        return HttpResponseForbidden()
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
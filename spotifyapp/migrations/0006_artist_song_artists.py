@@ -0,0 +1,31 @@
+# Generated by Django 5.0.6 on 2026-10-18 19:30
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotifyapp', '0005_listeninghistory'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Artist',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('artist_id', models.CharField(max_length=255, unique=True)),
+                ('name', models.CharField(max_length=255)),
+                ('genres', models.TextField(blank=True)),
+                ('image_url', models.URLField(blank=True, null=True)),
+                ('popularity', models.IntegerField(blank=True, null=True)),
+                ('fetched_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='song',
+            name='artists',
+            field=models.ManyToManyField(blank=True, related_name='songs', to='spotifyapp.artist'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.0.6 on 2026-10-18 19:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotifyapp', '0006_artist_song_artists'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Genre',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='song',
+            name='genre_tags',
+            field=models.ManyToManyField(blank=True, related_name='songs', to='spotifyapp.genre'),
+        ),
+    ]
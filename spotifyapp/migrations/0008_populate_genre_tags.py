@@ -0,0 +1,42 @@
+# Generated by Django 5.0.6 on 2026-10-18 19:31
+
+from django.db import migrations
+
+
+def populate_genre_tags(apps, schema_editor):
+    Song = apps.get_model('spotifyapp', 'Song')
+    Genre = apps.get_model('spotifyapp', 'Genre')
+    Link = Song.genre_tags.through
+
+    song_genres = {}
+    for song_id, genres in Song.objects.exclude(genres='').values_list('id', 'genres').iterator(chunk_size=2000):
+        song_genres[song_id] = {genre.strip() for genre in genres.split(',') if genre.strip()}
+
+    names = set().union(*song_genres.values()) if song_genres else set()
+    Genre.objects.bulk_create([Genre(name=name) for name in names], ignore_conflicts=True, batch_size=500)
+    genre_ids = dict(Genre.objects.values_list('name', 'id'))
+
+    links = [
+        Link(song_id=song_id, genre_id=genre_ids[name])
+        for song_id, genres in song_genres.items()
+        for name in genres
+    ]
+    Link.objects.bulk_create(links, ignore_conflicts=True, batch_size=500)
+
+
+def clear_genre_tags(apps, schema_editor):
+    Song = apps.get_model('spotifyapp', 'Song')
+    Genre = apps.get_model('spotifyapp', 'Genre')
+    Song.genre_tags.through.objects.all().delete()
+    Genre.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotifyapp', '0007_genre_song_genre_tags'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_genre_tags, clear_genre_tags),
+    ]
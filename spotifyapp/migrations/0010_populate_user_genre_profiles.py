@@ -0,0 +1,38 @@
+# Generated by Django 5.0.6 on 2026-10-18 19:40
+
+from django.db import migrations
+
+
+def populate_user_genre_profiles(apps, schema_editor):
+    Song = apps.get_model('spotifyapp', 'Song')
+    UserGenreProfile = apps.get_model('spotifyapp', 'UserGenreProfile')
+    UserLink = Song.users.through
+    GenreLink = Song.genre_tags.through
+
+    counts = {}
+    song_genres = {}
+    for song_id, genre_id in GenreLink.objects.values_list('song_id', 'genre_id').iterator(chunk_size=2000):
+        song_genres.setdefault(song_id, []).append(genre_id)
+    for user_id, song_id in UserLink.objects.values_list('user_id', 'song_id').iterator(chunk_size=2000):
+        for genre_id in song_genres.get(song_id, []):
+            counts[(user_id, genre_id)] = counts.get((user_id, genre_id), 0) + 1
+
+    UserGenreProfile.objects.bulk_create(
+        [UserGenreProfile(user_id=user_id, genre_id=genre_id, song_count=songs) for (user_id, genre_id), songs in counts.items()],
+        batch_size=500,
+    )
+
+
+def clear_user_genre_profiles(apps, schema_editor):
+    apps.get_model('spotifyapp', 'UserGenreProfile').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotifyapp', '0009_usergenreprofile_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_user_genre_profiles, clear_user_genre_profiles),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 5.0.6 on 2026-10-18 19:38
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotifyapp', '0011_syncjob'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlaylistSyncState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('playlist_id', models.CharField(max_length=255)),
+                ('snapshot_id', models.CharField(max_length=255)),
+                ('synced_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='playlist_sync_states', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserSyncState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('saved_tracks_added_at', models.DateTimeField(blank=True, null=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='sync_state', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='LibraryTrackSource',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=255)),
+                ('song', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='library_sources', to='spotifyapp.song')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='library_sources', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'song'], name='library_source_user_song')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='librarytracksource',
+            constraint=models.UniqueConstraint(fields=('user', 'source', 'song'), name='unique_library_track_source'),
+        ),
+        migrations.AddConstraint(
+            model_name='playlistsyncstate',
+            constraint=models.UniqueConstraint(fields=('user', 'playlist_id'), name='unique_user_playlist_sync_state'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.0.6 on 2026-10-18 19:43
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+# Rows stored before this migration have played_at set to when the page was fetched (it was auto_now_add), not when
+# the song was played. They can't be matched up with Spotify's plays, so they are left as they are. Only rows that
+# are exact copies of each other are dropped, keeping the oldest, otherwise the unique constraint can't be added.
+def drop_duplicate_plays(apps, schema_editor):
+    ListeningHistory = apps.get_model('spotifyapp', 'ListeningHistory')
+    duplicates = (
+        ListeningHistory.objects.values('user_id', 'song_id', 'played_at')
+        .annotate(copies=Count('id'), keep=Min('id'))
+        .filter(copies__gt=1)
+    )
+    for row in duplicates.iterator(chunk_size=2000):
+        # Matched in Python, not on played_at in SQL, so how the timestamps happen to be stored doesn't matter
+        copies = ListeningHistory.objects.filter(user_id=row['user_id'], song_id=row['song_id']).values_list('id', 'played_at')
+        ListeningHistory.objects.filter(
+            id__in=[id for id, played_at in copies if played_at == row['played_at'] and id != row['keep']]
+        ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotifyapp', '0012_playlistsyncstate_usersyncstate_librarytracksource_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usersyncstate',
+            name='recently_played_after',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='listeninghistory',
+            name='played_at',
+            field=models.DateTimeField(),
+        ),
+        migrations.RunPython(drop_duplicate_plays, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='listeninghistory',
+            constraint=models.UniqueConstraint(fields=('user', 'song', 'played_at'), name='unique_listening_history_play'),
+        ),
+    ]
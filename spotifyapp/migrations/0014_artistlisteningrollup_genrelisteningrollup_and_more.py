@@ -0,0 +1,94 @@
+# Generated by Django 5.0.6 on 2026-10-18 19:44
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotifyapp', '0013_usersyncstate_recently_played_after_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArtistListeningRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day'), ('week', 'Week'), ('all', 'All time')], max_length=4)),
+                ('period_start', models.DateTimeField()),
+                ('plays', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GenreListeningRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day'), ('week', 'Week'), ('all', 'All time')], max_length=4)),
+                ('period_start', models.DateTimeField()),
+                ('plays', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SongListeningRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day'), ('week', 'Week'), ('all', 'All time')], max_length=4)),
+                ('period_start', models.DateTimeField()),
+                ('plays', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='usersyncstate',
+            name='rollup_history_id',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='listeninghistory',
+            index=models.Index(fields=['user', 'played_at'], name='listening_history_user_played'),
+        ),
+        migrations.AddField(
+            model_name='artistlisteningrollup',
+            name='artist',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='listening_rollups', to='spotifyapp.artist'),
+        ),
+        migrations.AddField(
+            model_name='artistlisteningrollup',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='genrelisteningrollup',
+            name='genre',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='listening_rollups', to='spotifyapp.genre'),
+        ),
+        migrations.AddField(
+            model_name='genrelisteningrollup',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='songlisteningrollup',
+            name='song',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='listening_rollups', to='spotifyapp.song'),
+        ),
+        migrations.AddField(
+            model_name='songlisteningrollup',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='artistlisteningrollup',
+            constraint=models.UniqueConstraint(fields=('user', 'granularity', 'period_start', 'artist'), name='unique_artist_listening_rollup'),
+        ),
+        migrations.AddConstraint(
+            model_name='genrelisteningrollup',
+            constraint=models.UniqueConstraint(fields=('user', 'granularity', 'period_start', 'genre'), name='unique_genre_listening_rollup'),
+        ),
+        migrations.AddConstraint(
+            model_name='songlisteningrollup',
+            constraint=models.UniqueConstraint(fields=('user', 'granularity', 'period_start', 'song'), name='unique_song_listening_rollup'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.0.6 on 2026-10-18 19:54
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotifyapp', '0015_spotifytoken'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrackNeighbor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField()),
+                ('neighbor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='spotifyapp.song')),
+                ('song', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='neighbors', to='spotifyapp.song')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='trackneighbor',
+            constraint=models.UniqueConstraint(fields=('song', 'neighbor'), name='unique_track_neighbor'),
+        ),
+    ]
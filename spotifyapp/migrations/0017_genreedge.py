@@ -0,0 +1,27 @@
+# Generated by Django 5.0.6 on 2026-10-18 19:58
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotifyapp', '0016_trackneighbor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GenreEdge',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('weight', models.FloatField()),
+                ('genre', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='edges', to='spotifyapp.genre')),
+                ('neighbor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='spotifyapp.genre')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='genreedge',
+            constraint=models.UniqueConstraint(fields=('genre', 'neighbor'), name='unique_genre_edge'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.0.6 on 2026-10-18 20:47
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+# Plays up to the old rollup watermark have been counted, the rest are left for the next update_listening_rollups
+def mark_rolled_up_plays(apps, schema_editor):
+    ListeningHistory = apps.get_model('spotifyapp', 'ListeningHistory')
+    UserSyncState = apps.get_model('spotifyapp', 'UserSyncState')
+    for user_id, rollup_history_id in UserSyncState.objects.filter(rollup_history_id__gt=0).values_list('user_id', 'rollup_history_id'):
+        ListeningHistory.objects.filter(user_id=user_id, id__lte=rollup_history_id).update(rolled_up=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotifyapp', '0017_genreedge'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='listeninghistory',
+            name='rolled_up',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(mark_rolled_up_plays, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='usersyncstate',
+            name='rollup_history_id',
+        ),
+        migrations.AddIndex(
+            model_name='listeninghistory',
+            index=models.Index(condition=models.Q(('rolled_up', False)), fields=['user', 'id'], name='listening_history_unrolled'),
+        ),
+    ]
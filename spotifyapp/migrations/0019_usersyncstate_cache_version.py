@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-18 20:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotifyapp', '0018_listeninghistory_rolled_up_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usersyncstate',
+            name='cache_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -1,5 +1,27 @@
 from django.contrib.auth.models import User
 from django.db import models
+from django.utils import timezone
+
+class Artist(models.Model):
+    artist_id = models.CharField(max_length=255, unique=True)
+    name = models.CharField(max_length=255)
+    genres = models.TextField(blank=True)
+    image_url = models.URLField(blank=True, null=True)
+    popularity = models.IntegerField(blank=True, null=True)
+    # When we last pulled this artist from Spotify, used to decide when the cached copy is stale
+    fetched_at = models.DateTimeField(default=timezone.now)
+
+    def genre_list(self):
+        return [genre.strip() for genre in self.genres.split(',') if genre.strip()]
+
+    def __str__(self):
+        return self.name
+
+class Genre(models.Model):
+    name = models.CharField(max_length=255, unique=True)
+
+    def __str__(self):
+        return self.name
 
 class Song(models.Model):
     track_id = models.CharField(max_length=255, unique=True)
@@ -11,15 +33,232 @@ class Song(models.Model):
     
     # Many-to-Many relationship with users
     users = models.ManyToManyField(User, related_name="songs")
+    artists = models.ManyToManyField(Artist, related_name="songs", blank=True)
+    # Normalized copy of the genres text above, this is what genre counts are computed from
+    genre_tags = models.ManyToManyField(Genre, related_name="songs", blank=True)
 
     def __str__(self):
         return self.track_name
 
+class UserGenreProfile(models.Model):
+    # How many of the user's songs carry this genre, kept up to date as songs are linked and unlinked
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="genre_profile")
+    genre = models.ForeignKey(Genre, on_delete=models.CASCADE)
+    song_count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "genre"], name="unique_user_genre_profile"),
+        ]
+        indexes = [
+            models.Index(fields=["user", "-song_count"], name="genre_profile_user_count"),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username}: {self.genre.name} ({self.song_count})"
+
+class SpotifyToken(models.Model):
+    # The user's Spotify OAuth token, kept in the database so every worker process and background job can use it
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="spotify_token")
+    access_token = models.TextField()
+    refresh_token = models.TextField()
+    # Unix time the access token stops working
+    expires_at = models.IntegerField()
+    scope = models.TextField(blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Spotify token for {self.user.username}"
+
+class SyncJob(models.Model):
+    # A library sync waiting for (or being run by) the run_sync_worker command
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="sync_jobs")
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # Bumped by the worker as it goes, a running job with an old heartbeat belongs to a worker that died
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+
+    pages_fetched = models.PositiveIntegerField(default=0)
+    pages_total = models.PositiveIntegerField(null=True, blank=True)  # estimate, filled in as the crawl learns sizes
+    tracks_ingested = models.PositiveIntegerField(default=0)
+    errors = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    # Where to pick the crawl back up after a crash
+    checkpoint = models.JSONField(default=dict, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "created_at"], name="sync_job_status_created"),
+        ]
+
+    def eta_seconds(self):
+        if self.status != self.RUNNING or not self.started_at or not self.pages_fetched or not self.pages_total:
+            return None
+        elapsed = (timezone.now() - self.started_at).total_seconds()
+        return max(0, round(elapsed / self.pages_fetched * (self.pages_total - self.pages_fetched)))
+
+    def __str__(self):
+        return f"Sync {self.id} for {self.user.username} ({self.status})"
+
+class UserSyncState(models.Model):
+    # Per-user cursors that let a library sync skip what it has already seen
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="sync_state")
+    # Newest added_at among the liked songs we have ingested, paging stops once it reaches older items
+    saved_tracks_added_at = models.DateTimeField(null=True, blank=True)
+    # Spotify's recently-played cursor (unix ms of the newest play we stored), the next poll asks only for plays after it
+    recently_played_after = models.BigIntegerField(null=True, blank=True)
+    # Bumped whenever the user's songs change, every process keys its cached pages and library set by it (see caching.py)
+    cache_version = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"Sync state for {self.user.username}"
+
+class PlaylistSyncState(models.Model):
+    # The playlist version we last crawled, an unchanged snapshot_id means the playlist can be skipped
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="playlist_sync_states")
+    playlist_id = models.CharField(max_length=255)
+    snapshot_id = models.CharField(max_length=255)
+    synced_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "playlist_id"], name="unique_user_playlist_sync_state"),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username}: {self.playlist_id} @ {self.snapshot_id}"
+
+class LibraryTrackSource(models.Model):
+    # Which playlist (or the liked songs, source "saved") put a song in a user's library.
+    # A song is unlinked from the user once the last of its sources goes away.
+    SAVED_TRACKS = "saved"
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="library_sources")
+    song = models.ForeignKey(Song, on_delete=models.CASCADE, related_name="library_sources")
+    source = models.CharField(max_length=255)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "source", "song"], name="unique_library_track_source"),
+        ]
+        indexes = [
+            models.Index(fields=["user", "song"], name="library_source_user_song"),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username}: {self.song.track_name} from {self.source}"
+
 class ListeningHistory(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     song = models.ForeignKey(Song, on_delete=models.CASCADE)
-    played_at = models.DateTimeField(auto_now_add=True)
+    # When Spotify says the play happened, not when we heard about it. Rows from before migration 0013 hold the time
+    # the last 50 page was fetched instead, and may repeat a play seen on several fetches, they are kept as they are.
+    played_at = models.DateTimeField()
     # Optional: How long the song was played, or if completed
     duration_listened = models.PositiveIntegerField(null=True, blank=True)  # in seconds
+    # Whether the play has been counted in the listening rollups yet (see spotifyapp.rollups)
+    rolled_up = models.BooleanField(default=False)
+
+    class Meta:
+        constraints = [
+            # The same play can show up in several polls, it is only stored once
+            models.UniqueConstraint(fields=["user", "song", "played_at"], name="unique_listening_history_play"),
+        ]
+        indexes = [
+            models.Index(fields=["user", "played_at"], name="listening_history_user_played"),
+            # Only the plays still waiting for the rollups, so it stays small however long the history gets
+            models.Index(fields=["user", "id"], condition=models.Q(rolled_up=False), name="listening_history_unrolled"),
+        ]
+
     def __str__(self):
-        return f"{self.user.username} listened to {self.song.track_name} on {self.timestamp}"
\ No newline at end of file
+        return f"{self.user.username} listened to {self.song.track_name} on {self.played_at}"
+
+
+class ListeningRollup(models.Model):
+    # Plays per user and item over one hour, day or week, or over all time. Kept up to date from ListeningHistory
+    # by spotifyapp.rollups, so stats over a time window read a handful of pre-summed periods instead of every raw play.
+    HOUR = "hour"
+    DAY = "day"
+    WEEK = "week"
+    ALL = "all"
+    GRANULARITY_CHOICES = [(HOUR, "Hour"), (DAY, "Day"), (WEEK, "Week"), (ALL, "All time")]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    granularity = models.CharField(max_length=4, choices=GRANULARITY_CHOICES)
+    # Start of the hour/day/week in the site's time zone, the same fixed date for every ALL row
+    period_start = models.DateTimeField()
+    plays = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        abstract = True
+        # Each concrete rollup's unique constraint leads with (user, granularity, period_start), which is also the
+        # index a window query scans, so no separate index is needed
+
+
+class SongListeningRollup(ListeningRollup):
+    song = models.ForeignKey(Song, on_delete=models.CASCADE, related_name="listening_rollups")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "granularity", "period_start", "song"], name="unique_song_listening_rollup"),
+        ]
+
+
+class ArtistListeningRollup(ListeningRollup):
+    artist = models.ForeignKey(Artist, on_delete=models.CASCADE, related_name="listening_rollups")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "granularity", "period_start", "artist"], name="unique_artist_listening_rollup"),
+        ]
+
+
+class GenreListeningRollup(ListeningRollup):
+    genre = models.ForeignKey(Genre, on_delete=models.CASCADE, related_name="listening_rollups")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "granularity", "period_start", "genre"], name="unique_genre_listening_rollup"),
+        ]
+
+
+class TrackNeighbor(models.Model):
+    # One of a song's most similar songs, by how many of our users have both in their library. Rebuilt offline by
+    # the build_track_neighbors command (see spotifyapp.neighbors), each song keeps at most its top few neighbors.
+    song = models.ForeignKey(Song, on_delete=models.CASCADE, related_name="neighbors")
+    neighbor = models.ForeignKey(Song, on_delete=models.CASCADE, related_name="+")
+    # Cosine similarity of the two songs' user sets, between 0 and 1
+    score = models.FloatField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["song", "neighbor"], name="unique_track_neighbor"),
+        ]
+
+
+class GenreEdge(models.Model):
+    # Two genres that show up together on the same songs or artists, from one genre to one of its closest. Rebuilt
+    # offline by the build_genre_graph command (see spotifyapp.genre_graph), each genre keeps its strongest few edges.
+    genre = models.ForeignKey(Genre, on_delete=models.CASCADE, related_name="edges")
+    neighbor = models.ForeignKey(Genre, on_delete=models.CASCADE, related_name="+")
+    # Co-occurrence normalized by how common each genre is (cosine), between 0 and 1
+    weight = models.FloatField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["genre", "neighbor"], name="unique_genre_edge"),
+        ]
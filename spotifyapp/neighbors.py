@@ -0,0 +1,144 @@
+import logging
+
+import numpy as np
+from django.db import transaction
+from django.db.models import Q, Sum
+from scipy import sparse
+
+from .ingestion import BATCH_SIZE
+from .models import Song, TrackNeighbor
+
+logger = logging.getLogger(__name__)
+
+# How many neighbors each song keeps
+NEIGHBORS_PER_TRACK = 50
+# How many Song.users links are read per query while building the matrix
+LINK_CHUNK = 100_000
+# Upper bound on the co-occurrence products computed at once, this is what bounds memory while scoring
+BLOCK_PRODUCTS = 5_000_000
+# Pairs of songs fewer users have in common than this aren't neighbors
+MIN_SHARED_USERS = 1
+
+
+#Function that reads a many-to-many through table into a sparse 0/1 matrix, chunk_size links per query.
+#Links are read in (row_field, column_field) order, which has to be the table's unique index, so the matrix's CSR
+#arrays are built straight from the chunks without ever holding a Python object per link.
+#columns is the sorted array of IDs the columns stand for (links to anything else are skipped), by default every
+#one the table links to. Returns (matrix, the ID of each row).
+def link_matrix(Link, row_field, column_field, columns=None, chunk_size=LINK_CHUNK):
+    if columns is None:
+        columns = np.array(sorted(Link.objects.values_list(column_field, flat=True).distinct()), dtype=np.int64)
+
+    row_chunks, column_chunks = [], []
+    last = None
+    while True:
+        links = Link.objects.order_by(row_field, column_field)
+        if last is not None:
+            links = links.filter(Q(**{f"{row_field}__gt": last[0]}) | Q(**{row_field: last[0], f"{column_field}__gt": last[1]}))
+        chunk = np.array(links.values_list(row_field, column_field)[:chunk_size], dtype=np.int64).reshape(-1, 2)
+        if not len(chunk):
+            break
+        last = chunk[-1]
+        # Anything linked since the columns were read has no column
+        positions = np.minimum(np.searchsorted(columns, chunk[:, 1]), max(len(columns) - 1, 0))
+        known = columns[positions] == chunk[:, 1] if len(columns) else np.zeros(len(chunk), dtype=bool)
+        row_chunks.append(chunk[known, 0])
+        column_chunks.append(positions[known].astype(np.int32))
+
+    rows = np.concatenate(row_chunks) if row_chunks else np.zeros(0, dtype=np.int64)
+    indices = np.concatenate(column_chunks) if column_chunks else np.zeros(0, dtype=np.int32)
+    # Links come in row order, so each row's links are one run
+    row_ids, counts = np.unique(rows, return_counts=True)
+    indptr = np.concatenate([[0], np.cumsum(counts)])
+    matrix = sparse.csr_matrix(
+        (np.ones(len(indices), dtype=np.float32), indices, indptr), shape=(len(row_ids), len(columns))
+    )
+    return matrix, row_ids
+
+
+#Function that reads every Song.users link into a sparse song x user matrix, returns (matrix, the song ID of each row)
+def library_matrix(chunk_size=LINK_CHUNK):
+    return link_matrix(Song.users.through, 'song_id', 'user_id', chunk_size=chunk_size)
+
+
+#Function that splits the rows (songs) into contiguous blocks whose co-occurrence products stay under max_products.
+#A song's products are the sizes of its users' libraries added up, an upper bound on its row of the similarity matrix.
+def similarity_blocks(matrix, max_products=BLOCK_PRODUCTS):
+    library_sizes = np.asarray(matrix.sum(axis=0)).ravel()
+    products = matrix @ library_sizes
+    start, total = 0, 0
+    for row, cost in enumerate(products):
+        if total and total + cost > max_products:
+            yield start, row
+            start, total = row, 0
+        total += cost
+    if start < matrix.shape[0]:
+        yield start, matrix.shape[0]
+
+
+#Function that returns the top k neighbors of the songs in rows [start, end) as (row, neighbor row, score) arrays.
+#Scores are the cosine similarity of the songs' user sets: users in common / sqrt(users of one * users of other).
+def block_neighbors(matrix, transposed, norms, start, end, k=NEIGHBORS_PER_TRACK, min_shared=MIN_SHARED_USERS):
+    shared = (matrix[start:end] @ transposed).tocoo()
+    rows, columns, counts = shared.row + start, shared.col, shared.data
+    keep = (rows != columns) & (counts >= min_shared)
+    rows, columns, counts = rows[keep], columns[keep], counts[keep]
+    scores = counts / (norms[rows] * norms[columns])
+
+    # Best first within each song (ties to the lower song ID, so rebuilds are stable), then keep the first k of each
+    order = np.lexsort((columns, -scores, rows))
+    rows, columns, scores = rows[order], columns[order], scores[order]
+    first = np.searchsorted(rows, rows, side='left')
+    keep = np.arange(len(rows)) - first < k
+    return rows[keep], columns[keep], scores[keep]
+
+
+#Function that rebuilds TrackNeighbor from the Song.users links, returns how many neighbor rows were written.
+#Works through the songs a block at a time, each block's old rows are replaced in one transaction so recommendations
+#keep reading a full neighbor list for every song while the job runs.
+def build_track_neighbors(k=NEIGHBORS_PER_TRACK, min_shared=MIN_SHARED_USERS, max_products=BLOCK_PRODUCTS, chunk_size=LINK_CHUNK):
+    matrix, song_ids = library_matrix(chunk_size)
+    logger.info(f"Library matrix: {matrix.shape[0]} songs x {matrix.shape[1]} users, {matrix.nnz} links.")
+    transposed = matrix.T.tocsr()
+    norms = np.sqrt(np.diff(matrix.indptr)).astype(np.float64)
+    song_ids = song_ids.tolist()
+
+    written = 0
+    previous_end = None
+    for start, end in similarity_blocks(matrix, max_products):
+        rows, columns, scores = block_neighbors(matrix, transposed, norms, start, end, k, min_shared)
+        # The block owns every song ID from just after the previous block up to its last song, songs that lost all
+        # their users in between lose their neighbors too
+        owned = Q(song_id__lte=song_ids[end - 1])
+        if previous_end is not None:
+            owned &= Q(song_id__gt=song_ids[previous_end - 1])
+        with transaction.atomic():
+            TrackNeighbor.objects.filter(owned).delete()
+            TrackNeighbor.objects.bulk_create(
+                [
+                    TrackNeighbor(song_id=song_ids[row], neighbor_id=song_ids[column], score=score)
+                    for row, column, score in zip(rows.tolist(), columns.tolist(), scores.tolist())
+                ],
+                batch_size=BATCH_SIZE,
+            )
+        written += len(rows)
+        previous_end = end
+
+    stale = TrackNeighbor.objects.all()
+    if previous_end is not None:
+        stale = stale.filter(song_id__gt=song_ids[previous_end - 1])
+    stale.delete()
+    return written
+
+
+#Function that returns the songs most similar to the user's library that aren't in it, in a single query.
+#Each song's score is its similarity to the user's songs added up, returns dicts with the song's track_id,
+#popularity, genres and similarity, best first.
+def similar_tracks(user, limit):
+    return list(
+        TrackNeighbor.objects.filter(song__users=user)
+        .exclude(neighbor__users=user)
+        .values('neighbor__track_id', 'neighbor__popularity', 'neighbor__genres')
+        .annotate(similarity=Sum('score'))
+        .order_by('-similarity', 'neighbor__track_id')[:limit]
+    )
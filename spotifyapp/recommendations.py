@@ -0,0 +1,128 @@
+from collections import Counter
+from functools import partial
+
+from .concurrency import fetch_concurrently
+from .genre_graph import neighboring_genres, songs_in_genres
+from .genres import split_genres
+from .neighbors import similar_tracks
+
+# How many tracks the local neighbor index adds to the candidates
+NEIGHBOR_CANDIDATES = 200
+# How many tracks the genre graph adds, and how many neighboring genres of each top genre they come from
+ADJACENT_CANDIDATES = 200
+ADJACENT_GENRES = 5
+
+
+class Candidate:
+    """A track the recommender's searches turned up, and which genre and artist searches found it."""
+
+    def __init__(self, track):
+        self.track_id = track['id']
+        # Album track listings (hipster mode) don't include popularity
+        self.popularity = track.get('popularity')
+        self.artist_ids = [artist['id'] for artist in track.get('artists', []) if artist.get('id')]
+        # The track's own genres, when it comes from our catalog
+        self.genres = []
+        self.genre_hits = Counter()
+        self.artist_hits = Counter()
+        # How similar the track is to the user's library by who else has it (see spotifyapp.neighbors)
+        self.neighbor_score = 0.0
+
+
+def _search_items(results, kind):
+    if not results:
+        return []
+    return results.get(kind, {}).get('items', [])
+
+
+#Function that runs every search the recommender needs, concurrently, and collects the tracks they return.
+#Genre searches and the top-artists lookup go out together, then one search per top artist.
+#In hipster mode each search returns albums and every album's tracks are fetched in a third wave.
+#Hits are merged in the same order the searches were listed (genres, then artists), so the result doesn't
+#depend on which request finished first. Returns (dict of track_id -> Candidate, the user's top artists).
+def gather_candidates(sp, top_genres, year_query='', hipster_mode=False, max_workers=None):
+    kind = 'albums' if hipster_mode else 'tracks'
+
+    def search(term, field, limit):
+        if hipster_mode:
+            return partial(sp.search, q=f'tag:hipster album:"{term}"{year_query}', type='album', limit=limit)
+        return partial(sp.search, q=f'{field}:"{term}"{year_query}', type='track', limit=limit)
+
+    first_wave = [partial(sp.current_user_top_artists, limit=30, time_range='medium_term')]
+    first_wave += [search(genre, 'genre', 20) for genre in top_genres]
+    top_artists_results, *genre_results = fetch_concurrently(first_wave, max_workers)
+
+    top_artists = (top_artists_results or {}).get('items', [])
+    artist_results = fetch_concurrently([search(artist.get('name'), 'artist', 10) for artist in top_artists], max_workers)
+
+    # (hit counter name, what was searched, list of track dicts) in the order the hits get merged
+    found = [('genre_hits', genre, _search_items(results, kind)) for genre, results in zip(top_genres, genre_results)]
+    found += [('artist_hits', artist.get('id'), _search_items(results, kind)) for artist, results in zip(top_artists, artist_results)]
+
+    if hipster_mode:
+        album_ids = [album.get('id') for hits, term, albums in found for album in albums if album.get('id')]
+        album_tracks = dict(zip(album_ids, fetch_concurrently([partial(sp.album_tracks, album_id) for album_id in album_ids], max_workers)))
+        found = [
+            (hits, term, [track for album in albums for track in (album_tracks.get(album.get('id')) or {}).get('items', [])])
+            for hits, term, albums in found
+        ]
+
+    candidates = {}
+    for hits, term, tracks in found:
+        for track in tracks:
+            if not track or not track.get('id'):
+                continue
+            candidate = candidates.get(track['id'])
+            if candidate is None:
+                candidate = candidates[track['id']] = Candidate(track)
+            getattr(candidate, hits)[term] += 1
+    return candidates, top_artists
+
+
+#Function that adds the tracks other users with a similar library have to the candidates, from the local
+#neighbor index in one query and without calling Spotify. Tracks the searches found too just get their score.
+def add_neighbor_candidates(candidates, user, limit=NEIGHBOR_CANDIDATES):
+    for row in similar_tracks(user, limit):
+        track_id = row['neighbor__track_id']
+        candidate = candidates.get(track_id)
+        if candidate is None:
+            candidate = candidates[track_id] = Candidate({'id': track_id, 'popularity': row['neighbor__popularity']})
+            candidate.genres = split_genres(row['neighbor__genres'])
+        candidate.neighbor_score = row['similarity']
+    return candidates
+
+
+#Function that finds candidates in our catalog from the genres next to the user's top genres in the genre graph,
+#in one query and without calling Spotify. Each track counts as a hit for the top genres it was found next to.
+#Returns (dict of track_id -> Candidate, the top genres that turned up at least one track).
+def adjacent_genre_candidates(user, top_genres, limit=ADJACENT_CANDIDATES, least_popular_first=False):
+    weights, sources = {}, {}
+    for genre in top_genres:
+        for neighbor, weight in neighboring_genres(genre, ADJACENT_GENRES):
+            if neighbor in top_genres:
+                continue
+            weights[neighbor] = max(weight, weights.get(neighbor, 0))
+            sources.setdefault(neighbor, []).append(genre)
+
+    candidates, covered = {}, set()
+    for row in songs_in_genres(user, weights, limit, least_popular_first=least_popular_first):
+        candidate = candidates[row['track_id']] = Candidate({'id': row['track_id'], 'popularity': row['popularity']})
+        candidate.genres = split_genres(row['genres'])
+        for genre in {source for genre in candidate.genres for source in sources.get(genre, [])}:
+            candidate.genre_hits[genre] += 1
+            covered.add(genre)
+    return candidates, covered
+
+
+#Function that adds candidates from another source to the candidates, tracks both found keep the hits of both
+def merge_candidates(candidates, others):
+    for track_id, other in others.items():
+        candidate = candidates.get(track_id)
+        if candidate is None:
+            candidates[track_id] = other
+            continue
+        candidate.genres = candidate.genres or other.genres
+        candidate.genre_hits.update(other.genre_hits)
+        candidate.artist_hits.update(other.artist_hits)
+        candidate.neighbor_score = max(candidate.neighbor_score, other.neighbor_score)
+    return candidates
@@ -0,0 +1,185 @@
+import logging
+from collections import Counter
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db import transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .ingestion import BATCH_SIZE
+from .models import (
+    ArtistListeningRollup,
+    GenreListeningRollup,
+    ListeningHistory,
+    ListeningRollup,
+    Song,
+    SongListeningRollup,
+    UserSyncState,
+)
+
+logger = logging.getLogger(__name__)
+
+# How many history rows are folded into the rollups per transaction
+ROLLUP_CHUNK = 5000
+# The period_start shared by every all-time rollup row
+ALL_TIME = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+GRANULARITIES = [ListeningRollup.HOUR, ListeningRollup.DAY, ListeningRollup.WEEK, ListeningRollup.ALL]
+
+# What top_listened can rank: dimension -> (rollup model, the field holding the item)
+DIMENSIONS = {
+    'song': (SongListeningRollup, 'song'),
+    'artist': (ArtistListeningRollup, 'artist'),
+    'genre': (GenreListeningRollup, 'genre'),
+}
+
+# Named windows, using the same names as Spotify's top items time ranges. None is all time.
+WINDOWS = {
+    'short_term': timedelta(weeks=4),
+    'medium_term': timedelta(days=183),
+    'long_term': None,
+}
+
+
+#Function that returns the start of the hour, day or week (Monday) a play falls in, in the site's time zone
+def period_start(played_at, granularity):
+    if granularity == ListeningRollup.ALL:
+        return ALL_TIME
+    local = timezone.localtime(played_at)
+    if granularity == ListeningRollup.HOUR:
+        return local.replace(minute=0, second=0, microsecond=0)
+    start = local.replace(hour=0, minute=0, second=0, microsecond=0)
+    if granularity == ListeningRollup.WEEK:
+        start -= timedelta(days=start.weekday())
+    return start
+
+
+#Function that picks the coarsest granularity that still lines up well with a window, so a query reads few periods
+def granularity_for(window):
+    if window is None:
+        return ListeningRollup.ALL
+    if window <= timedelta(days=2):
+        return ListeningRollup.HOUR
+    if window <= timedelta(weeks=8):
+        return ListeningRollup.DAY
+    return ListeningRollup.WEEK
+
+
+def _links(through, song_ids, field):
+    links = {}
+    for song_id, item_id in through.objects.filter(song_id__in=song_ids).values_list('song_id', field):
+        links.setdefault(song_id, []).append(item_id)
+    return links
+
+
+#Function that adds plays to one rollup table, counts is a Counter of (granularity, period_start, item id) -> plays.
+#Rows that don't exist yet are inserted with their count, only the ones already there need an UPDATE.
+def _apply_counts(user, model, field, counts):
+    existing = set()
+    for granularity in GRANULARITIES:
+        starts = [start for g, start, item_id in counts if g == granularity]
+        if starts:
+            existing.update(
+                model.objects.filter(
+                    user=user, granularity=granularity, period_start__range=(min(starts), max(starts))
+                ).values_list('granularity', 'period_start', f"{field}_id")
+            )
+
+    model.objects.bulk_create(
+        [
+            model(user=user, granularity=granularity, period_start=start, plays=plays, **{f"{field}_id": item_id})
+            for (granularity, start, item_id), plays in counts.items()
+            if (granularity, start, item_id) not in existing
+        ],
+        batch_size=BATCH_SIZE,
+    )
+    # Items in the same period that moved by the same amount share one UPDATE
+    by_delta = {}
+    for (granularity, start, item_id), plays in counts.items():
+        if (granularity, start, item_id) in existing:
+            by_delta.setdefault((granularity, start, plays), []).append(item_id)
+    for (granularity, start, plays), item_ids in by_delta.items():
+        model.objects.filter(
+            user=user, granularity=granularity, period_start=start, **{f"{field}_id__in": item_ids}
+        ).update(plays=F('plays') + plays)
+
+
+#Function that counts a chunk of plays, (id, song_id, played_at) tuples, into a Counter per dimension of
+#(granularity, period_start, item id) -> plays
+def _count_plays(plays):
+    song_ids = {song_id for play_id, song_id, played_at in plays}
+    song_artists = _links(Song.artists.through, song_ids, 'artist_id')
+    song_genres = _links(Song.genre_tags.through, song_ids, 'genre_id')
+    counts = {dimension: Counter() for dimension in DIMENSIONS}
+    for play_id, song_id, played_at in plays:
+        for granularity in GRANULARITIES:
+            start = period_start(played_at, granularity)
+            counts['song'][(granularity, start, song_id)] += 1
+            for artist_id in song_artists.get(song_id, []):
+                counts['artist'][(granularity, start, artist_id)] += 1
+            for genre_id in song_genres.get(song_id, []):
+                counts['genre'][(granularity, start, genre_id)] += 1
+    return counts
+
+
+#Function that folds the user's plays that aren't counted yet into the song, artist and genre rollups.
+#Plays are picked by their rolled_up flag, not an id watermark: the poller and a backfill can commit plays out of
+#id order, and a watermark would skip whichever committed last. Each chunk is counted, written and flagged in one
+#transaction, with jobs for the same user taking turns on their sync state row, so every play is counted exactly
+#once even if the job is interrupted or two run at the same time. Returns how many plays were folded in.
+def update_listening_rollups(user, chunk_size=ROLLUP_CHUNK):
+    state, created = UserSyncState.objects.get_or_create(user=user)
+    folded = 0
+    while True:
+        with transaction.atomic():
+            UserSyncState.objects.select_for_update().filter(id=state.id).values_list('id', flat=True).first()
+            plays = list(
+                ListeningHistory.objects.filter(user=user, rolled_up=False)
+                .order_by('id')
+                .values_list('id', 'song_id', 'played_at')[:chunk_size]
+            )
+            if not plays:
+                break
+
+            counts = _count_plays(plays)
+            for dimension, (model, field) in DIMENSIONS.items():
+                _apply_counts(user, model, field, counts[dimension])
+            ListeningHistory.objects.filter(id__in=[play_id for play_id, song_id, played_at in plays]).update(rolled_up=True)
+        folded += len(plays)
+
+    if folded:
+        logger.info(f"Folded {folded} plays into the listening rollups for user {user.username}.")
+    return folded
+
+
+#Function that throws away a user's rollups and recounts them from all of their listening history
+def rebuild_listening_rollups(user):
+    with transaction.atomic():
+        for model, field in DIMENSIONS.values():
+            model.objects.filter(user=user).delete()
+        ListeningHistory.objects.filter(user=user, rolled_up=True).update(rolled_up=False)
+    return update_listening_rollups(user)
+
+
+#Function that returns the user's rollup rows for a dimension that together cover a window.
+#window is one of WINDOWS ('short_term' is 4 weeks, 'medium_term' 6 months, 'long_term' all time) or a timedelta.
+#The first period may reach a little before the window starts.
+def window_rollups(user, dimension, window='short_term'):
+    model, field = DIMENSIONS[dimension]
+    window = WINDOWS[window] if isinstance(window, str) else window
+    granularity = granularity_for(window)
+
+    rows = model.objects.filter(user=user, granularity=granularity)
+    if window is not None:
+        rows = rows.filter(period_start__gte=period_start(timezone.now() - window, granularity))
+    return rows
+
+
+#Function that returns the user's most played songs, artists or genres over a window, as a list of (item, plays).
+#Reads pre-summed rollup periods (see window_rollups), never the raw history.
+def top_listened(user, dimension, window='short_term', limit=10):
+    model, field = DIMENSIONS[dimension]
+    rows = window_rollups(user, dimension, window)
+    top = list(rows.values(field).annotate(total=Sum('plays')).order_by('-total', field)[:limit])
+
+    items = model._meta.get_field(field).related_model.objects.in_bulk([row[field] for row in top])
+    return [(items[row[field]], row['total']) for row in top if row[field] in items]
@@ -0,0 +1,162 @@
+from collections import Counter
+
+import numpy as np
+from django.db.models import Count
+from scipy import sparse
+
+from .genres import split_genres
+from .models import Artist, Song, UserGenreProfile
+
+# Default weights of the score terms, all of them can be changed on the recommendations form.
+# The popularity term is flipped in hipster mode so less known tracks come first.
+WEIGHT_GENRES = 25
+WEIGHT_ARTISTS = 25
+WEIGHT_POPULARITY = 5
+WEIGHT_NEIGHBORS = 25
+# Stand-in popularity (0-100) for candidates Spotify didn't give one for
+DEFAULT_POPULARITY = 50
+
+
+class Vocabulary:
+    """Maps names (genres, artist IDs) to column numbers, adding new ones as they are seen."""
+
+    def __init__(self):
+        self.index = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, name):
+        return self.index.setdefault(name, len(self.index))
+
+
+class Affinity:
+    """A user's taste as weights over genres and artists, turned into vectors once the candidates are known."""
+
+    def __init__(self, genre_weights, artist_weights):
+        self.genre_weights = genre_weights
+        self.artist_weights = artist_weights
+
+
+def _dense(weights, vocabulary):
+    columns = [vocabulary[name] for name in weights]
+    vector = np.zeros(len(vocabulary))
+    vector[columns] = list(weights.values())
+    return vector
+
+
+#Function that builds the user's affinity. Genres are weighted by how many of the user's songs have them,
+#artists by their share of the user's library plus their rank in the user's Spotify top artists.
+def user_affinity(user, top_artists=()):
+    genre_weights = dict(
+        UserGenreProfile.objects.filter(user=user, song_count__gt=0).values_list('genre__name', 'song_count')
+    )
+
+    library_artists = dict(
+        Song.artists.through.objects.filter(song__users=user)
+        .values('artist__artist_id')
+        .annotate(songs=Count('song_id'))
+        .values_list('artist__artist_id', 'songs')
+    )
+    most = max(library_artists.values(), default=1)
+    artist_weights = {artist_id: songs / most for artist_id, songs in library_artists.items()}
+    for rank, artist in enumerate(top_artists):
+        if artist.get('id'):
+            artist_weights[artist['id']] = artist_weights.get(artist['id'], 0) + (len(top_artists) - rank) / len(top_artists)
+    return Affinity(genre_weights, artist_weights)
+
+
+def _cosine(matrix, vector):
+    # Row-wise cosine similarity of a sparse matrix against a dense vector, 0 where either side is empty
+    row_norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    vector_norm = np.linalg.norm(vector)
+    dots = matrix @ vector
+    with np.errstate(divide='ignore', invalid='ignore'):
+        similarity = dots / (row_norms * vector_norm)
+    return np.nan_to_num(similarity, nan=0.0, posinf=0.0, neginf=0.0)
+
+
+def _add_row(entries, row, weights, vocabulary):
+    rows, columns, values = entries
+    for name, weight in weights.items():
+        rows.append(row)
+        columns.append(vocabulary[name])
+        values.append(weight)
+
+
+#Function that turns candidates into sparse genre and artist matrices (one row per candidate) and a popularity vector.
+#A candidate's genres are its own, the genre searches that found it and the genres of its artists we have in the catalog,
+#its artists are its own plus the top artists whose searches found it.
+def candidate_matrices(candidates, genres, artists):
+    artist_ids = {artist_id for candidate in candidates for artist_id in candidate.artist_ids}
+    artist_genres = {
+        artist_id: split_genres(artist_genres)
+        for artist_id, artist_genres in Artist.objects.filter(artist_id__in=artist_ids).values_list('artist_id', 'genres')
+    }
+
+    genre_entries, artist_entries = ([], [], []), ([], [], [])
+    popularity = np.empty(len(candidates))
+    for row, candidate in enumerate(candidates):
+        genre_weights = Counter(candidate.genre_hits)
+        genre_weights.update(candidate.genres)
+        artist_weights = Counter(candidate.artist_hits)
+        for artist_id in candidate.artist_ids:
+            genre_weights.update(artist_genres.get(artist_id, []))
+            artist_weights[artist_id] += 1
+        _add_row(genre_entries, row, genre_weights, genres)
+        _add_row(artist_entries, row, artist_weights, artists)
+        popularity[row] = DEFAULT_POPULARITY if candidate.popularity is None else candidate.popularity
+
+    def matrix(entries, vocabulary):
+        rows, columns, values = entries
+        return sparse.csr_matrix((values, (rows, columns)), shape=(len(candidates), len(vocabulary)))
+    return matrix(genre_entries, genres), matrix(artist_entries, artists), popularity / 100
+
+
+#Function that scores every candidate in one batch: weighted cosine similarity between the candidate's genres and
+#the user's, the same for artists, plus popularity and neighbor index terms. Returns a numpy array in the same order as candidates.
+def score_candidates(candidates, affinity, weight_genres=WEIGHT_GENRES, weight_artists=WEIGHT_ARTISTS, weight_popularity=WEIGHT_POPULARITY,
+                     weight_neighbors=WEIGHT_NEIGHBORS):
+    if not candidates:
+        return np.zeros(0)
+    genres, artists = Vocabulary(), Vocabulary()
+    # The user's genres and artists get the first columns, so their full weight counts in the vector norms
+    genre_vector = _dense(affinity.genre_weights, genres)
+    artist_vector = _dense(affinity.artist_weights, artists)
+    genre_matrix, artist_matrix, popularity = candidate_matrices(candidates, genres, artists)
+    # Columns the candidates added are 0 on the user's side
+    genre_vector = np.pad(genre_vector, (0, len(genres) - len(genre_vector)))
+    artist_vector = np.pad(artist_vector, (0, len(artists) - len(artist_vector)))
+    # Neighbor scores are sums of similarities, scaled so the best candidate gets 1
+    neighbors = np.array([candidate.neighbor_score for candidate in candidates])
+    if neighbors.max() > 0:
+        neighbors /= neighbors.max()
+
+    return (
+        weight_genres * _cosine(genre_matrix, genre_vector)
+        + weight_artists * _cosine(artist_matrix, artist_vector)
+        + weight_popularity * popularity
+        + weight_neighbors * neighbors
+    )
+
+
+#Function that returns the positions of the k highest scores, best first.
+#argpartition finds the k-th best score in linear time, only the k positions at or above it get sorted (ties go to the
+#earlier candidate, argpartition picks arbitrary ones among the scores tied with the k-th).
+def top_k(scores, k):
+    if k <= 0 or not len(scores):
+        return np.zeros(0, dtype=int)
+    if k < len(scores):
+        kth = scores[np.argpartition(-scores, k - 1)[k - 1]]
+        above = np.flatnonzero(scores > kth)
+        positions = np.concatenate([above, np.flatnonzero(scores == kth)[:k - len(above)]])
+    else:
+        positions = np.arange(len(scores))
+    return positions[np.lexsort((positions, -scores[positions]))]
+
+
+#Function that picks the k best candidates for the user, returns their track IDs best first
+def rank_candidates(user, candidates, top_artists, k, **weights):
+    candidates = list(candidates)
+    scores = score_candidates(candidates, user_affinity(user, top_artists), **weights)
+    return [candidates[position].track_id for position in top_k(scores, k)]
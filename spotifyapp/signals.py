@@ -0,0 +1,56 @@
+from django.db.backends.signals import connection_created
+from django.db.models.signals import m2m_changed, pre_delete
+from django.dispatch import receiver
+
+from .genres import update_genre_profile
+from .library import invalidate_library
+from .metrics import record_query
+from .models import Song
+
+
+#Function that turns an m2m_changed call on Song.users into {user_id: [song_ids]} for the links that are changing
+def _changed_links(instance, reverse, pk_set, action):
+    Link = Song.users.through
+    if reverse:
+        # user.songs.add/remove/clear, pk_set holds song IDs
+        links = Link.objects.filter(user_id=instance.pk)
+        if action != 'pre_clear':
+            links = links.filter(song_id__in=pk_set)
+    else:
+        # song.users.add/remove/clear, pk_set holds user IDs
+        links = Link.objects.filter(song_id=instance.pk)
+        if action != 'pre_clear':
+            links = links.filter(user_id__in=pk_set)
+
+    changed = {}
+    for user_id, song_id in links.values_list('user_id', 'song_id'):
+        changed.setdefault(user_id, []).append(song_id)
+    return changed
+
+
+@receiver(m2m_changed, sender=Song.users.through)
+def song_users_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # Removals are counted before they happen so we only count links that really existed,
+    # additions after, where Django has already dropped the ones that were there before
+    if action in ('pre_remove', 'pre_clear'):
+        for user_id, song_ids in _changed_links(instance, reverse, pk_set, action).items():
+            update_genre_profile(user_id, song_ids, sign=-1)
+            invalidate_library(user_id)
+    elif action == 'post_add':
+        for user_id, song_ids in _changed_links(instance, reverse, pk_set, action).items():
+            update_genre_profile(user_id, song_ids, sign=1)
+            invalidate_library(user_id)
+
+
+@receiver(pre_delete, sender=Song)
+def song_deleted(sender, instance, **kwargs):
+    for user_id in instance.users.values_list('id', flat=True):
+        update_genre_profile(user_id, [instance.pk], sign=-1)
+        invalidate_library(user_id)
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    # The same wrapper object outlives reconnects, only add the hook once
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, record_query)
@@ -0,0 +1,163 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import environ
+from django.conf import settings
+from django.db import transaction
+from spotipy.cache_handler import MemoryCacheHandler
+from spotipy.oauth2 import SpotifyOAuth, SpotifyOauthError
+
+from .models import SpotifyToken
+from .spotify_client import TIMEOUT, build_spotify_client, session
+
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+env = environ.Env()
+environ.Env.read_env(os.path.join(settings.BASE_DIR, 'secret.env'))
+
+SCOPE = 'playlist-modify-private playlist-modify-public user-library-read user-top-read user-read-recently-played playlist-read-private'
+# Refresh an access token when it has less than this many seconds left
+REFRESH_MARGIN = 60
+# How many locks token refreshes are spread over, users that share one just take turns refreshing
+REFRESH_LOCK_STRIPES = 64
+
+
+class SharedSessionOAuth(SpotifyOAuth):
+    """SpotifyOAuth on the shared pooled session, which it must not close when it goes away."""
+
+    def __del__(self):
+        # spotipy closes its session when the manager is collected, that would drop every pooled connection
+        if getattr(self, '_session', None) is not session:
+            super().__del__()
+
+
+#Function that builds the OAuth helper for the login, callback and refresh steps, against SPOTIFY_ACCOUNTS_URL.
+#Its token cache lives only as long as the helper, tokens are stored per user in SpotifyToken instead.
+def oauth_manager():
+    manager = SharedSessionOAuth(
+        client_id=env('SPOTIPY_CLIENT_ID'),
+        client_secret=env('SPOTIPY_CLIENT_SECRET'),
+        redirect_uri=env('SPOTIPY_REDIRECT_URI'),
+        scope=SCOPE,
+        cache_handler=MemoryCacheHandler(),
+        requests_session=session,
+        requests_timeout=TIMEOUT,
+    )
+    accounts = settings.SPOTIFY_ACCOUNTS_URL.rstrip('/')
+    manager.OAUTH_AUTHORIZE_URL = f"{accounts}/authorize"
+    manager.OAUTH_TOKEN_URL = f"{accounts}/api/token"
+    return manager
+
+
+#Function that stores the token Spotify gave us for the user, replacing the one they had
+def save_token(user, token_info):
+    defaults = {
+        'access_token': token_info['access_token'],
+        'expires_at': token_info['expires_at'],
+        'scope': token_info.get('scope') or '',
+    }
+    # Spotify doesn't always send a new refresh token, the old one keeps working then
+    if token_info.get('refresh_token'):
+        defaults['refresh_token'] = token_info['refresh_token']
+    token, created = SpotifyToken.objects.update_or_create(user=user, defaults=defaults)
+    # A reconnect may be a different Spotify account, so don't keep using the old client
+    forget_client(user.id)
+    return token
+
+
+def _expiring(token):
+    return token.expires_at - time.time() < REFRESH_MARGIN
+
+
+# A fixed set of locks rather than one per user, so it doesn't grow with every user who ever signed in
+_refresh_locks = [threading.Lock() for _ in range(REFRESH_LOCK_STRIPES)]
+
+
+def _refresh_lock(user_id):
+    return _refresh_locks[user_id % REFRESH_LOCK_STRIPES]
+
+
+class UserTokenManager:
+    """spotipy auth manager that hands out one user's access token from SpotifyToken, refreshing it when due.
+
+    Refreshes are single-flight: callers wait on the user's lock stripe (and a row lock, on databases that
+    have them) and re-read the token, so only the first one calls Spotify and the rest use the token it saved.
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.token = None
+
+    def get_access_token(self, as_dict=False):
+        token = self.token
+        if token is None or _expiring(token):
+            with _refresh_lock(self.user_id):
+                with transaction.atomic():
+                    token = SpotifyToken.objects.select_for_update().get(user_id=self.user_id)
+                    if _expiring(token):
+                        token = self._refresh(token)
+                self.token = token
+        return token.access_token
+
+    def _refresh(self, token):
+        token_info = oauth_manager().refresh_access_token(token.refresh_token)
+        token.access_token = token_info['access_token']
+        token.expires_at = token_info['expires_at']
+        token.refresh_token = token_info.get('refresh_token') or token.refresh_token
+        token.save(update_fields=['access_token', 'expires_at', 'refresh_token', 'updated_at'])
+        logger.info(f"Refreshed the Spotify token for user {self.user_id}.")
+        return token
+
+
+# user ID -> (client, its UserTokenManager or None for a ready-made client from use_client), least recently used first
+_clients = OrderedDict()
+_clients_lock = threading.Lock()
+
+
+#Function that returns the user's Spotify client, or None if they haven't connected Spotify or have to connect again.
+#Clients are built once per user and process and kept in a bounded pool, all of them share one HTTP
+#connection pool, and the per-user response cache is keyed by the user's ID. A token that is due is refreshed
+#here, so when Spotify turns the refresh down (access revoked, refresh token no longer valid) the caller gets
+#None and sends the user to log in again, instead of the first API call failing.
+def client_for_user(user):
+    with _clients_lock:
+        entry = _clients.get(user.id)
+        if entry is not None:
+            _clients.move_to_end(user.id)
+
+    if entry is None:
+        if not SpotifyToken.objects.filter(user_id=user.id).exists():
+            return None
+        auth_manager = UserTokenManager(user.id)
+        entry = (build_spotify_client(user.id, auth_manager=auth_manager), auth_manager)
+        with _clients_lock:
+            entry = _clients.setdefault(user.id, entry)
+            _clients.move_to_end(user.id)
+            while len(_clients) > settings.SPOTIFY_CLIENT_POOL_SIZE:
+                _clients.popitem(last=False)
+
+    client, auth_manager = entry
+    if auth_manager is not None:
+        try:
+            auth_manager.get_access_token()
+        except (SpotifyOauthError, SpotifyToken.DoesNotExist) as e:
+            logger.warning(f"No usable Spotify token for user {user.id}, they need to connect again: {e}")
+            forget_client(user.id)
+            return None
+    return client
+
+
+#Function that drops the user's pooled client, the next client_for_user builds a fresh one
+def forget_client(user_id):
+    with _clients_lock:
+        _clients.pop(user_id, None)
+
+
+#Function that puts a ready-made client in the pool for the user, e.g. the benchmarks' stand-in for Spotify
+def use_client(user_id, client):
+    with _clients_lock:
+        _clients[user_id] = (client, None)
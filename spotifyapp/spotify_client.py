@@ -0,0 +1,324 @@
+import copy
+import inspect
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+import spotipy
+import urllib3
+from django.conf import settings
+
+from .metrics import record_cache, record_spotify_call, record_spotify_response
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+
+# Set the timeout value (in seconds)
+TIMEOUT = 5
+MAX_RETRIES = 3
+# Cap on the exponential backoff between retries of failed requests (seconds)
+MAX_BACKOFF = 8
+# Methods that are safe to send twice. A POST (creating a playlist, adding tracks) that failed after reaching
+# Spotify may already have been applied, so it's only retried when it certainly wasn't
+IDEMPOTENT_METHODS = {'GET', 'PUT', 'DELETE'}
+
+# Catalog endpoints give everyone the same answer, so their responses are shared between users (seconds to keep)
+CATALOG_TTLS = {
+    'search': 6 * 60 * 60,
+    'artist': 24 * 60 * 60,
+    'artists': 24 * 60 * 60,
+    'track': 24 * 60 * 60,
+    'tracks': 24 * 60 * 60,
+    'album_tracks': 24 * 60 * 60,
+}
+# Endpoints about the signed in user, cached per user and kept apart from the catalog entries
+USER_TTLS = {
+    'current_user_top_artists': 60 * 60,
+    'current_user_top_tracks': 60 * 60,
+    'current_user_recently_played': 30,
+}
+
+
+class ResponseCache:
+    """Thread-safe LRU cache of Spotify responses with a TTL per entry and hit/miss counters per endpoint."""
+
+    def __init__(self, name, max_entries):
+        self.name = name
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = {}
+        self.misses = {}
+
+    def get(self, endpoint, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits[endpoint] = self.hits.get(endpoint, 0) + 1
+                hit = True
+            else:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses[endpoint] = self.misses.get(endpoint, 0) + 1
+                hit = False
+        record_cache(f"spotify_{self.name}", 'hit' if hit else 'miss')
+        return (True, entry[1]) if hit else (False, None)
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits.clear()
+            self.misses.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': dict(self.hits),
+                'misses': dict(self.misses),
+            }
+
+
+catalog_cache = ResponseCache('catalog', settings.SPOTIFY_CATALOG_CACHE_ENTRIES)
+user_cache = ResponseCache('user', settings.SPOTIFY_USER_CACHE_ENTRIES)
+
+
+def cache_stats():
+    return {'catalog': catalog_cache.stats(), 'user': user_cache.stats()}
+
+
+def _normalize(name, value):
+    if isinstance(value, str):
+        value = value.strip()
+        # Spotify search is case-insensitive, so "Rap" and "rap" share an entry
+        return value.lower() if name == 'q' else value
+    if isinstance(value, (list, tuple)):
+        return tuple(_normalize(name, item) for item in value)
+    return value
+
+
+#Function that builds the cache key for a call: the endpoint plus every argument by name, defaults filled in
+def cache_key(method, endpoint, args, kwargs):
+    bound = inspect.signature(method).bind(*args, **kwargs)
+    bound.apply_defaults()
+    return (endpoint,) + tuple(sorted((name, _normalize(name, value)) for name, value in bound.arguments.items()))
+
+
+class CachedSpotify:
+    """Read-through cache in front of a spotipy.Spotify client.
+
+    Catalog calls (search, artist(s), track(s), album_tracks) are shared across every client, calls about
+    the signed in user are keyed by ``scope`` (the user ID) as well. Everything else goes straight through.
+    """
+
+    def __init__(self, client, scope):
+        self.client = client
+        self.scope = scope
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name in CATALOG_TTLS:
+            return self._cached(attr, name, catalog_cache, CATALOG_TTLS[name], ())
+        if name in USER_TTLS:
+            return self._cached(attr, name, user_cache, USER_TTLS[name], (self.scope,))
+        return attr
+
+    def _cached(self, method, endpoint, cache, ttl, prefix):
+        def call(*args, **kwargs):
+            key = prefix + cache_key(method, endpoint, args, kwargs)
+            hit, value = cache.get(endpoint, key)
+            if hit:
+                # Callers are free to mutate what they get back, so never hand out the cached object itself
+                return copy.deepcopy(value)
+            value = method(*args, **kwargs)
+            cache.set(key, copy.deepcopy(value), ttl)
+            return value
+        return call
+
+
+class _FileLock:
+    """Exclusive lock on a file, held across every worker process on this machine."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.file = os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT), 'r+')
+        if fcntl:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        else:
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+        return self.file
+
+    def __exit__(self, *exc_info):
+        if fcntl:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        else:
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        self.file.close()
+
+
+class TokenBucket:
+    """Token bucket kept in a small JSON file, so every worker process draws from the same budget.
+
+    ``rate`` tokens are added per second up to ``capacity``. ``pause()`` empties the bucket until a
+    given time, which is how a 429 from one worker slows all the others down too.
+    """
+
+    def __init__(self, path, rate, capacity):
+        self.path = path
+        self.rate = rate
+        self.capacity = capacity
+
+    def _read(self, file):
+        file.seek(0)
+        try:
+            state = json.loads(file.read() or '{}')
+        except ValueError:
+            state = {}
+        now = time.time()
+        tokens = state.get('tokens', self.capacity)
+        updated = state.get('updated', now)
+        blocked_until = state.get('blocked_until', 0)
+        tokens = min(self.capacity, tokens + max(0, now - max(updated, blocked_until)) * self.rate)
+        return tokens, blocked_until, now
+
+    def _write(self, file, tokens, blocked_until, now):
+        file.seek(0)
+        file.truncate()
+        file.write(json.dumps({'tokens': tokens, 'updated': now, 'blocked_until': blocked_until}))
+
+    def acquire(self):
+        while True:
+            with _FileLock(self.path) as file:
+                tokens, blocked_until, now = self._read(file)
+                if now >= blocked_until and tokens >= 1:
+                    self._write(file, tokens - 1, blocked_until, now)
+                    return
+                self._write(file, tokens, blocked_until, now)
+                wait = max(blocked_until - now, (1 - tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with _FileLock(self.path) as file:
+            tokens, blocked_until, now = self._read(file)
+            self._write(file, 0, max(blocked_until, now + seconds), now)
+
+
+rate_limiter = TokenBucket(
+    settings.SPOTIFY_RATE_LIMIT_FILE,
+    settings.SPOTIFY_RATE_LIMIT_PER_SECOND,
+    settings.SPOTIFY_RATE_LIMIT_BURST,
+)
+
+
+#Function that builds the HTTP session every Spotify client shares, so connections are pooled and kept alive
+def build_session():
+    http = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=settings.SPOTIFY_MAX_CONCURRENCY * 2,
+        max_retries=0,  # RateLimitedSpotify does the retrying
+    )
+    http.mount('https://', adapter)
+    http.mount('http://', adapter)
+    # Every Spotify response is counted and timed for /metrics
+    http.hooks['response'].append(record_spotify_response)
+    return http
+
+
+session = build_session()
+
+
+#Function that tells whether a connection error happened before the request went out (so it's safe to resend)
+def _not_sent(error):
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+def _retry_after(error):
+    try:
+        return float(error.headers.get('Retry-After', 1))
+    except (TypeError, ValueError):
+        return 1.0
+
+
+class RateLimitedSpotify(spotipy.Spotify):
+    """spotipy client that waits for the shared token bucket before every request.
+
+    A 429 pauses the bucket for everyone for the Retry-After period (plus jitter) and the request is
+    retried, as are 5xx responses and connection errors, with jittered exponential backoff. POSTs aren't
+    idempotent, they're only retried after a 429 or when the connection failed before they were sent.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('requests_session', session)
+        kwargs.setdefault('requests_timeout', TIMEOUT)
+        super().__init__(*args, **kwargs)
+        self.prefix = settings.SPOTIFY_API_URL
+
+    def __del__(self):
+        # spotipy closes its session when the client goes away, the shared one has to outlive every client
+        if getattr(self, '_session', None) is not session:
+            super().__del__()
+
+    def _internal_call(self, method, url, payload, params):
+        attempt = 0
+        while True:
+            rate_limiter.acquire()
+            started = time.monotonic()
+            try:
+                # spotipy pops content_type out of params, so every attempt gets its own copy
+                return super()._internal_call(method, url, payload, dict(params))
+            except spotipy.SpotifyException as e:
+                if attempt >= MAX_RETRIES or (e.http_status != 429 and e.http_status < 500):
+                    raise
+                if e.http_status != 429 and method not in IDEMPOTENT_METHODS:
+                    raise
+                if e.http_status == 429:
+                    wait = _retry_after(e)
+                    if wait > settings.SPOTIFY_MAX_RETRY_AFTER:
+                        rate_limiter.pause(wait)
+                        raise
+                    wait += random.uniform(0, 1)
+                    rate_limiter.pause(wait)
+                else:
+                    wait = random.uniform(0, min(MAX_BACKOFF, 2 ** attempt))
+                logger.warning(f"Spotify returned {e.http_status} for {url}, retrying in {wait:.1f}s")
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                # No response for the session hook to see, count the attempt here
+                record_spotify_call('error', time.monotonic() - started)
+                if attempt >= MAX_RETRIES or (method not in IDEMPOTENT_METHODS and not _not_sent(e)):
+                    raise
+                wait = random.uniform(0, min(MAX_BACKOFF, 2 ** attempt))
+                logger.warning(f"Request to Spotify failed ({e}), retrying in {wait:.1f}s")
+            attempt += 1
+            time.sleep(wait)
+
+
+#Function that builds the client the views use: rate limited, on the shared session, behind the response cache
+def build_spotify_client(scope, **kwargs):
+    return CachedSpotify(RateLimitedSpotify(**kwargs), scope=scope)
+
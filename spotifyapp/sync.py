@@ -0,0 +1,264 @@
+import logging
+import math
+from datetime import timedelta
+from functools import partial
+
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .concurrency import iter_pages
+from .ingestion import ingest_in_batches, unlink_songs_from_user
+from .models import LibraryTrackSource, PlaylistSyncState, SyncJob, UserSyncState
+
+logger = logging.getLogger(__name__)
+
+# Page sizes for the playlist listing / liked songs, and for a playlist's tracks (the most Spotify allows)
+PAGE_SIZE = 50
+PLAYLIST_PAGE_SIZE = 100
+# A running job whose worker hasn't checked in for this long is assumed dead and gets queued again
+STALE_AFTER = timedelta(minutes=5)
+
+
+#Function that queues a library sync for the user, or returns the one already queued or running
+def enqueue_library_sync(user):
+    with transaction.atomic():
+        job = SyncJob.objects.filter(user=user, status__in=[SyncJob.QUEUED, SyncJob.RUNNING]).order_by('created_at').first()
+        if job is None:
+            job = SyncJob.objects.create(user=user)
+            logger.info(f"Queued library sync {job.id} for user {user.username}.")
+    return job
+
+
+#Function that puts jobs from crashed workers back in the queue, they resume from their checkpoint
+def requeue_stale_jobs():
+    stale = SyncJob.objects.filter(status=SyncJob.RUNNING, heartbeat_at__lt=timezone.now() - STALE_AFTER)
+    requeued = stale.update(status=SyncJob.QUEUED)
+    if requeued:
+        logger.warning(f"Requeued {requeued} sync jobs from workers that stopped responding.")
+    return requeued
+
+
+#Function that hands the oldest queued job to this worker, or returns None when the queue is empty.
+#The conditional UPDATE means two workers can never claim the same job.
+def claim_next_job():
+    requeue_stale_jobs()
+    for job_id in SyncJob.objects.filter(status=SyncJob.QUEUED).order_by('created_at').values_list('id', flat=True)[:10]:
+        now = timezone.now()
+        claimed = SyncJob.objects.filter(id=job_id, status=SyncJob.QUEUED).update(status=SyncJob.RUNNING, heartbeat_at=now)
+        if claimed:
+            job = SyncJob.objects.select_related('user').get(id=job_id)
+            if job.started_at is None:
+                job.started_at = now
+            job.attempts += 1
+            job.save(update_fields=['started_at', 'attempts'])
+            return job
+    return None
+
+
+def _save_progress(job, **checkpoint):
+    job.checkpoint.update(checkpoint)
+    job.heartbeat_at = timezone.now()
+    job.save(update_fields=['checkpoint', 'heartbeat_at', 'pages_fetched', 'pages_total', 'tracks_ingested', 'errors', 'last_error'])
+
+
+def _record_error(job, message):
+    logger.error(f"Sync {job.id}: {message}")
+    job.errors += 1
+    job.last_error = message
+
+
+def _estimate_pages(job, playlists_total=None, saved_total=None):
+    checkpoint = job.checkpoint
+    if playlists_total is not None:
+        checkpoint['playlists_total'] = playlists_total
+    if saved_total is not None:
+        checkpoint['saved_total'] = saved_total
+    # Listing pages, plus the tracks pages of every playlist that changed, plus the liked songs pages
+    pages = math.ceil(checkpoint.get('playlists_total', 0) / PAGE_SIZE)
+    pages += checkpoint.get('playlist_pages', 0)
+    pages += math.ceil(checkpoint.get('saved_total', PAGE_SIZE) / PAGE_SIZE)
+    job.pages_total = max(pages, job.pages_fetched)
+
+
+#Function that records which songs a source (a playlist ID, or LibraryTrackSource.SAVED_TRACKS) currently has.
+#Songs the source dropped lose it, and songs left with no source at all are unlinked from the user.
+def replace_source_songs(user, source, song_ids):
+    song_ids = set(song_ids)
+    with transaction.atomic():
+        current = set(LibraryTrackSource.objects.filter(user=user, source=source).values_list('song_id', flat=True))
+        LibraryTrackSource.objects.bulk_create(
+            [LibraryTrackSource(user=user, source=source, song_id=song_id) for song_id in song_ids - current],
+            ignore_conflicts=True,
+            batch_size=500,
+        )
+        removed = current - song_ids
+        if removed:
+            LibraryTrackSource.objects.filter(user=user, source=source, song_id__in=removed).delete()
+            still_sourced = set(LibraryTrackSource.objects.filter(user=user, song_id__in=removed).values_list('song_id', flat=True))
+            unlink_songs_from_user(removed - still_sourced, user)
+    return removed
+
+
+#Function that adds songs to a source without touching the songs it already has
+def add_source_songs(user, source, song_ids):
+    LibraryTrackSource.objects.bulk_create(
+        [LibraryTrackSource(user=user, source=source, song_id=song_id) for song_id in song_ids],
+        ignore_conflicts=True,
+        batch_size=500,
+    )
+
+
+#Function that drops playlists that no longer show up in the user's playlist list, as if they had been emptied
+def drop_missing_playlists(user, seen_playlist_ids):
+    for state in PlaylistSyncState.objects.filter(user=user).exclude(playlist_id__in=seen_playlist_ids):
+        replace_source_songs(user, state.playlist_id, [])
+        state.delete()
+        logger.info(f"Playlist {state.playlist_id} is gone for user {user.username}, dropped its songs.")
+
+
+#Function that turns pages of playlist items or liked songs into a stream of (page offset, track),
+#dropping local files and removed tracks
+def iter_page_tracks(job, pages):
+    for offset, page in pages:
+        job.pages_fetched += 1
+        for item in page.get('items', []):
+            track = item.get('track')
+            if track and track.get('id') and not track.get('is_local'):
+                yield offset, track
+
+
+#Function that turns pages of liked songs into a stream of (page offset, track), newest first, stopping at
+#the first song added at or before seen_up_to. The newest added_at seen goes in the job's checkpoint.
+def iter_new_saved_tracks(job, pages, seen_up_to):
+    checkpoint = job.checkpoint
+    try:
+        for offset, page in pages:
+            job.pages_fetched += 1
+            if seen_up_to is None:
+                _estimate_pages(job, saved_total=page.get('total', 0))
+            for item in page.get('items', []):
+                added_at = parse_datetime(item['added_at'])
+                if seen_up_to is not None and added_at <= seen_up_to:
+                    return
+                if not checkpoint.get('saved_newest') or added_at > parse_datetime(checkpoint['saved_newest']):
+                    checkpoint['saved_newest'] = added_at.isoformat()
+                track = item.get('track')
+                if track and track.get('id') and not track.get('is_local'):
+                    yield offset, track
+    finally:
+        pages.close()
+
+
+#Function that crawls every page of one playlist into the database and records its songs and snapshot.
+#Pages are fetched ahead concurrently and written in fixed-size batches, only the song IDs are kept for the whole playlist.
+def sync_playlist(job, sp, playlist):
+    user = job.user
+    pages = iter_pages(partial(sp.playlist_tracks, playlist['id'], limit=PLAYLIST_PAGE_SIZE), PLAYLIST_PAGE_SIZE)
+    song_ids = set()
+    for offset, songs in ingest_in_batches(iter_page_tracks(job, pages), user, sp):
+        song_ids.update(song.id for song in songs.values())
+        job.tracks_ingested += len(songs)
+        _save_progress(job)
+
+    replace_source_songs(user, playlist['id'], song_ids)
+    PlaylistSyncState.objects.update_or_create(
+        user=user, playlist_id=playlist['id'], defaults={'snapshot_id': playlist.get('snapshot_id') or ''}
+    )
+
+
+#Function that brings the user's playlists and liked songs in the database up to date for a sync job.
+#Playlists whose snapshot_id hasn't changed since the last sync are skipped without fetching their tracks,
+#liked songs are read newest first until we reach ones we have already seen. Everything streams through
+#page fetcher -> track filter -> batch writer, so memory doesn't grow with the library. Progress and a
+#checkpoint are saved after every playlist and batch, so a job picked up again carries on where it stopped.
+def run_library_sync(job, sp):
+    user = job.user
+    checkpoint = job.checkpoint
+
+    if checkpoint.get('phase', 'playlists') == 'playlists':
+        snapshots = dict(PlaylistSyncState.objects.filter(user=user).values_list('playlist_id', 'snapshot_id'))
+        checkpoint.setdefault('seen_playlists', [])
+        checkpoint.setdefault('changed_playlists', [])
+        listing = iter_pages(
+            partial(sp.current_user_playlists, limit=PAGE_SIZE), PAGE_SIZE, start=checkpoint.get('playlist_offset', 0), depth=1
+        )
+        for offset, playlists in listing:
+            job.pages_fetched += 1
+            if offset != checkpoint.get('playlist_offset', 0):
+                _save_progress(job, playlist_offset=offset, playlist_index=0)
+
+            for index, playlist in enumerate(playlists.get('items', [])):
+                if index < checkpoint.get('playlist_index', 0):
+                    continue
+                if playlist['id'] not in checkpoint['seen_playlists']:
+                    checkpoint['seen_playlists'].append(playlist['id'])
+                if snapshots.get(playlist['id']) == playlist.get('snapshot_id'):
+                    continue
+                if playlist['id'] not in checkpoint['changed_playlists']:
+                    checkpoint['changed_playlists'].append(playlist['id'])
+                    tracks_total = (playlist.get('tracks') or {}).get('total') or 0
+                    checkpoint['playlist_pages'] = checkpoint.get('playlist_pages', 0) + max(1, math.ceil(tracks_total / PLAYLIST_PAGE_SIZE))
+                _estimate_pages(job, playlists_total=playlists.get('total', 0))
+                try:
+                    sync_playlist(job, sp, playlist)
+                except Exception as e:
+                    _record_error(job, f"playlist {playlist.get('id')}: {e}")
+                _save_progress(job, playlist_offset=offset, playlist_index=index + 1)
+
+            _estimate_pages(job, playlists_total=playlists.get('total', 0))
+
+        drop_missing_playlists(user, checkpoint['seen_playlists'])
+        _save_progress(job, phase='saved', saved_offset=0)
+
+    state, created = UserSyncState.objects.get_or_create(user=user)
+    seen_up_to = state.saved_tracks_added_at
+    # A first sync reads every liked song, so fetch ahead. Later ones usually stop on the first page.
+    pages = iter_pages(
+        partial(sp.current_user_saved_tracks, limit=PAGE_SIZE), PAGE_SIZE,
+        start=checkpoint.get('saved_offset', 0), depth=None if seen_up_to is None else 0,
+    )
+    tracks = iter_new_saved_tracks(job, pages, seen_up_to)
+    for offset, songs in ingest_in_batches(tracks, user, sp):
+        add_source_songs(user, LibraryTrackSource.SAVED_TRACKS, [song.id for song in songs.values()])
+        job.tracks_ingested += len(songs)
+        _save_progress(job, saved_offset=offset)
+
+    if checkpoint.get('saved_newest'):
+        state.saved_tracks_added_at = max(filter(None, [seen_up_to, parse_datetime(checkpoint['saved_newest'])]))
+        state.save(update_fields=['saved_tracks_added_at'])
+
+
+#Function that runs one claimed job to the end and records how it went
+def run_job(job, sp):
+    logger.info(f"Starting sync {job.id} for user {job.user.username} (attempt {job.attempts}).")
+    try:
+        if sp is None:
+            raise ValueError("the user hasn't connected their Spotify account")
+        run_library_sync(job, sp)
+    except Exception as e:
+        _record_error(job, str(e))
+        job.status = SyncJob.FAILED
+    else:
+        job.status = SyncJob.DONE
+    job.finished_at = timezone.now()
+    job.save()
+    logger.info(f"Sync {job.id} finished as {job.status}: {job.tracks_ingested} tracks, {job.errors} errors.")
+    return job
+
+
+#Function that turns a job into the JSON the progress endpoint returns
+def job_progress(job):
+    return {
+        'job_id': job.id,
+        'status': job.status,
+        'pages_fetched': job.pages_fetched,
+        'pages_total': job.pages_total,
+        'tracks_ingested': job.tracks_ingested,
+        'errors': job.errors,
+        'last_error': job.last_error,
+        'eta_seconds': job.eta_seconds(),
+        'created_at': job.created_at.isoformat(),
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
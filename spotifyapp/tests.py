@@ -1,3 +1,1057 @@
-from django.test import TestCase
+import gc
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from functools import partial
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import requests
+import spotipy
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from spotipy.oauth2 import SpotifyOauthError
+
+from . import spotify_client
+from .api import encode_cursor
+from .artists import ARTIST_TTL, refresh_artists, resolve_artists
+from .benchmarks import FakeSpotify, SyntheticCatalog, synthetic_library
+from .benchmarks.collage import legacy_genre_collages
+from .benchmarks.server import FakeSpotifyServer
+from .caching import bump_user_cache_version, user_cache_version
+from .concurrency import fetch_concurrently
+from .genre_graph import build_genre_graph, neighboring_genres, songs_in_genres
+from .genres import build_genre_collage_index, check_genre_profile, link_song_genres, rebuild_genre_profile, split_genres, top_genres_for_user
+from .history import RECENTLY_PLAYED_LIMIT, ingest_recently_played
+from .ingestion import hydrate_tracks, ingest_tracks, link_songs_to_user, unlink_songs_from_user
+from .library import library_track_ids
+from .metrics import NO_VIEW, RequestMetrics, _current, record_spotify_call, render_metrics
+from .models import (
+    Artist, Genre, GenreEdge, ListeningHistory, ListeningRollup, Song, SpotifyToken, SyncJob, TrackNeighbor, UserGenreProfile, UserSyncState,
+)
+from .neighbors import build_track_neighbors, link_matrix, similarity_blocks
+from .recommendations import Candidate
+from .rollups import DIMENSIONS, WINDOWS, period_start, rebuild_listening_rollups, update_listening_rollups, window_rollups
+from .scoring import WEIGHT_GENRES, WEIGHT_NEIGHBORS, Affinity, rank_candidates, score_candidates, top_k
+from .spotify_auth import REFRESH_LOCK_STRIPES, _refresh_lock, client_for_user, forget_client, oauth_manager, use_client
+from .spotify_client import (
+    MAX_RETRIES, CachedSpotify, RateLimitedSpotify, ResponseCache, TokenBucket, catalog_cache, user_cache,
+)
+from .sync import STALE_AFTER, claim_next_job, enqueue_library_sync, run_job, run_library_sync
+from .views import GENRE_PLAYLIST_NEIGHBORS, get_or_create_song
+
+
+#Function that gives a test a small synthetic catalog and the fake Spotify answering from it
+def fake_spotify(n_tracks=60, seed=0):
+    catalog = SyntheticCatalog(n_tracks, n_genres=8, n_artists=15, seed=seed)
+    return catalog, FakeSpotify(catalog)
+
+
+class IngestionTests(TestCase):
+    def setUp(self):
+        self.catalog, self.sp = fake_spotify()
+        self.user = User.objects.create_user('listener')
+
+    def test_ingest_dedupes_tracks(self):
+        tracks = self.catalog.tracks[:10]
+        page = tracks + tracks[:5] + [None, {**tracks[0], 'id': 'local', 'is_local': True}]
+
+        songs = ingest_tracks(page, self.user, self.sp)
+
+        self.assertEqual(set(songs), {track['id'] for track in tracks})
+        self.assertEqual(Song.objects.count(), 10)
+        self.assertEqual(Song.users.through.objects.filter(user=self.user).count(), 10)
+        self.assertEqual(check_genre_profile(self.user), {})
+
+    def test_ingest_again_creates_nothing(self):
+        ingest_tracks(self.catalog.tracks[:10], self.user, self.sp)
+        profile = dict(UserGenreProfile.objects.filter(user=self.user).values_list('genre_id', 'song_count'))
+
+        ingest_tracks(self.catalog.tracks[:10], self.user, self.sp)
+
+        self.assertEqual(Song.objects.count(), 10)
+        self.assertEqual(dict(UserGenreProfile.objects.filter(user=self.user).values_list('genre_id', 'song_count')), profile)
+
+    def test_link_returns_only_new_links(self):
+        songs = ingest_tracks(self.catalog.tracks[:10], None, self.sp)
+        song_ids = [song.id for song in songs.values()]
+
+        self.assertEqual(sorted(link_songs_to_user(song_ids[:4], self.user)), sorted(song_ids[:4]))
+        self.assertEqual(sorted(link_songs_to_user(song_ids, self.user)), sorted(song_ids[4:]))
+        self.assertEqual(link_songs_to_user(song_ids, self.user), [])
+        self.assertEqual(check_genre_profile(self.user), {})
+
+    def test_known_tracks_are_two_reads(self):
+        ingest_tracks(self.catalog.tracks[:50], self.user, self.sp)
+        calls = self.sp.total_calls()
+
+        # The song lookup and the link check, however many tracks there are
+        with self.assertNumQueries(2):
+            self.assertEqual(len(ingest_tracks(self.catalog.tracks[:50], self.user, self.sp)), 50)
+        with self.assertNumQueries(2):
+            self.assertEqual(get_or_create_song(self.catalog.tracks[0], self.user, self.sp).track_id, self.catalog.tracks[0]['id'])
+        self.assertEqual(self.sp.total_calls(), calls)
+
+    def test_hydrate_fetches_only_missing_tracks(self):
+        catalog, sp = fake_spotify(n_tracks=140)
+        known = [track['id'] for track in catalog.tracks[:10]]
+        ingest_tracks(catalog.tracks[:10], None, sp)
+        missing = [track['id'] for track in catalog.tracks[10:130]]
+        track_ids = missing[:60] + known + missing[60:]
+
+        with mock.patch.object(sp, 'tracks', wraps=sp.tracks) as tracks:
+            with mock.patch.object(Song.objects, 'bulk_create', wraps=Song.objects.bulk_create) as bulk_create:
+                songs = hydrate_tracks(track_ids + known[:3], self.user, sp)
+
+        self.assertEqual([song.track_id for song in songs], track_ids)
+        fetched = [call.args[0] for call in tracks.call_args_list]
+        self.assertEqual([len(chunk) for chunk in fetched], [50, 50, 20])
+        self.assertEqual(sorted(track_id for chunk in fetched for track_id in chunk), sorted(missing))
+        self.assertEqual(bulk_create.call_count, 1)
+        self.assertEqual(Song.users.through.objects.filter(user=self.user).count(), 130)
+
+
+class ArtistResolutionTests(TestCase):
+    def setUp(self):
+        self.catalog = SyntheticCatalog(200, n_genres=8, n_artists=120)
+        self.sp = FakeSpotify(self.catalog)
+        self.artist_ids = [artist['id'] for artist in self.catalog.artists]
+
+    def test_unknown_artists_are_fetched_50_at_a_time(self):
+        artists = resolve_artists(self.artist_ids + self.artist_ids[:10] + [None], self.sp)
+
+        self.assertEqual(set(artists), set(self.artist_ids))
+        self.assertEqual(Artist.objects.count(), 120)
+        self.assertEqual(self.sp.calls['artists'], 3)
+
+    def test_fresh_artists_come_from_the_database(self):
+        resolve_artists(self.artist_ids, self.sp)
+        calls = self.sp.total_calls()
+
+        with mock.patch('spotifyapp.artists.refresh_artists_in_background') as refresh, self.assertNumQueries(1):
+            self.assertEqual(len(resolve_artists(self.artist_ids, self.sp)), 120)
+        refresh.assert_not_called()
+        self.assertEqual(self.sp.total_calls(), calls)
+
+    def test_stale_artists_are_refreshed_once_the_caller_commits(self):
+        resolve_artists(self.artist_ids[:60], self.sp)
+        stale_ids = self.artist_ids[:5]
+        Artist.objects.filter(artist_id__in=stale_ids).update(fetched_at=timezone.now() - ARTIST_TTL - timedelta(hours=1), genres='')
+
+        with mock.patch('spotifyapp.artists.refresh_artists_in_background') as refresh:
+            with self.captureOnCommitCallbacks() as callbacks, transaction.atomic():
+                resolve_artists(self.artist_ids[:60], self.sp)
+            refresh.assert_not_called()
+            self.assertEqual(len(callbacks), 1)
+            callbacks[0]()
+        self.assertCountEqual(refresh.call_args.args[0], stale_ids)
+
+        calls = self.sp.calls['artists']
+        refresh_artists(stale_ids, self.sp)
+        self.assertEqual(self.sp.calls['artists'], calls + 1)
+        for artist in Artist.objects.filter(artist_id__in=stale_ids):
+            self.assertGreater(artist.fetched_at, timezone.now() - ARTIST_TTL)
+            self.assertEqual(artist.genre_list(), self.catalog.artists_by_id[artist.artist_id]['genres'])
+
+
+class FetchConcurrentlyTests(TestCase):
+    def test_results_keep_the_order_of_the_calls(self):
+        last_done = threading.Event()
+
+        def first():
+            # Only finishes after the last call, so the results arrive out of order
+            self.assertTrue(last_done.wait(5))
+            return 'first'
+
+        def last():
+            last_done.set()
+            return 'last'
+
+        self.assertEqual(fetch_concurrently([first, lambda: 'middle', last], max_workers=3), ['first', 'middle', 'last'])
+
+    def test_a_failed_call_gives_none(self):
+        def fails():
+            raise requests.exceptions.ConnectionError('down')
+
+        for max_workers in [1, 4]:
+            with self.subTest(max_workers=max_workers):
+                self.assertEqual(fetch_concurrently([lambda: 1, fails, lambda: 3], max_workers=max_workers), [1, None, 3])
+
+    def test_pool_threads_close_their_connections(self):
+        with mock.patch('spotifyapp.concurrency.close_old_connections') as close:
+            fetch_concurrently([lambda: User.objects.count()] * 3, max_workers=3)
+        self.assertEqual(close.call_count, 3)
+
+
+class GenreProfileTests(TestCase):
+    def setUp(self):
+        self.catalog, self.sp = fake_spotify()
+        self.user = User.objects.create_user('listener')
+        self.songs = list(ingest_tracks(self.catalog.tracks[:20], None, self.sp).values())
+
+    def assertConsistent(self):
+        self.assertEqual(check_genre_profile(self.user), {})
+
+    def test_m2m_add_remove_clear(self):
+        self.user.songs.add(*self.songs[:10])
+        self.assertConsistent()
+        self.songs[0].users.add(self.user)  # already linked, must not count twice
+        self.assertConsistent()
+        self.songs[15].users.add(self.user)
+        self.assertConsistent()
+
+        self.user.songs.remove(*self.songs[:3])
+        self.assertConsistent()
+        self.songs[15].users.remove(self.user)
+        self.user.songs.remove(self.songs[19])  # never linked
+        self.assertConsistent()
+
+        self.user.songs.clear()
+        self.assertConsistent()
+        self.assertFalse(UserGenreProfile.objects.filter(user=self.user, song_count__gt=0).exists())
+
+    def test_song_deleted(self):
+        self.user.songs.add(*self.songs[:5])
+        self.songs[0].delete()
+        self.assertConsistent()
+
+    def test_link_and_unlink(self):
+        song_ids = [song.id for song in self.songs]
+        link_songs_to_user(song_ids[:12], self.user)
+        self.assertConsistent()
+        link_songs_to_user(song_ids[8:], self.user)
+        self.assertConsistent()
+
+        self.assertEqual(sorted(unlink_songs_from_user(song_ids[:5] + [max(song_ids) + 1], self.user)), sorted(song_ids[:5]))
+        self.assertConsistent()
+        self.assertEqual(unlink_songs_from_user(song_ids[:5], self.user), [])
+        self.assertConsistent()
+
+    def test_rebuild_matches_incremental(self):
+        link_songs_to_user([song.id for song in self.songs], self.user)
+        incremental = top_genres_for_user(self.user)
+        rebuild_genre_profile(self.user)
+        self.assertEqual(top_genres_for_user(self.user), incremental)
+
+
+class GenreCollageTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('listener')
+
+    def add_songs(self, rows):
+        songs = Song.objects.bulk_create([
+            Song(track_id=f"t{i}", track_name=f"Song {i}", artist_names=artist, album_art=art, genres=genres, popularity=popularity)
+            for i, (artist, art, genres, popularity) in enumerate(rows)
+        ])
+        link_songs_to_user([song.id for song in Song.objects.filter(track_id__in=[song.track_id for song in songs])], self.user)
+
+    def assertMatchesLegacy(self, genres):
+        self.assertEqual(build_genre_collage_index(self.user, genres), legacy_genre_collages(self.user, genres))
+
+    def test_one_artist_with_many_covers_doesnt_crowd_out_the_rest(self):
+        rows = [('Artist A', f"https://example.com/a/{i}.jpg", 'pop, rock', 100 - i) for i in range(40)]
+        rows += [(f"Artist {i}", f"https://example.com/{i}.jpg", 'pop, rock', 10 - i) for i in range(3)]
+        self.add_songs(rows)
+
+        collages = build_genre_collage_index(self.user, ['rock'])
+        self.assertEqual(collages['rock'][1], ['Artist A', 'Artist 0', 'Artist 1', 'Artist 2'])
+        self.assertMatchesLegacy(['rock', 'pop'])
+
+    def test_shared_covers_and_first_pass(self):
+        rows = [
+            ('Artist A', 'https://example.com/shared.jpg', 'rock', 90),
+            ('Artist B', 'https://example.com/shared.jpg', 'pop, rock', 80),
+            ('Artist B', 'https://example.com/b.jpg', 'pop, rock', 70),
+            ('Artist C', 'https://example.com/c.jpg', 'rock', 60),
+            ('Artist A', 'https://example.com/a2.jpg', 'jazz, rock', 50),
+            ('Artist D', 'https://example.com/d.jpg', 'jazz, rock', 40),
+            ('Artist E', 'https://example.com/e.jpg', 'jazz, rock', 30),
+        ]
+        self.add_songs(rows)
+        self.assertMatchesLegacy(['rock', 'pop', 'jazz'])
+
+    def test_matches_legacy_on_a_synthetic_library(self):
+        synthetic_library(self.user, 2000, n_genres=40, n_artists=300)
+        self.assertMatchesLegacy([genre for genre, count in top_genres_for_user(self.user)])
+
+
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        for response_cache in (catalog_cache, user_cache):
+            response_cache.clear()
+            self.addCleanup(response_cache.clear)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        response_cache = ResponseCache('test', max_entries=2)
+        response_cache.set('a', 1, 60)
+        response_cache.set('b', 2, 60)
+        self.assertEqual(response_cache.get('test', 'a'), (True, 1))
+
+        response_cache.set('c', 3, 60)
+
+        self.assertEqual(response_cache.get('test', 'b'), (False, None))
+        self.assertEqual(response_cache.get('test', 'a'), (True, 1))
+        self.assertEqual(response_cache.get('test', 'c'), (True, 3))
+        self.assertEqual(response_cache.stats()['entries'], 2)
+
+    def test_entries_expire_after_their_ttl(self):
+        response_cache = ResponseCache('test', max_entries=10)
+        with mock.patch('spotifyapp.spotify_client.time.monotonic', return_value=1000.0) as monotonic:
+            response_cache.set('a', 1, 30)
+            monotonic.return_value = 1029.0
+            self.assertEqual(response_cache.get('test', 'a'), (True, 1))
+            monotonic.return_value = 1031.0
+            self.assertEqual(response_cache.get('test', 'a'), (False, None))
+        self.assertEqual(response_cache.stats(), {'entries': 0, 'hits': {'test': 1}, 'misses': {'test': 1}})
+
+    def test_user_entries_are_kept_apart(self):
+        first_spotify, second_spotify = FakeSpotify(SyntheticCatalog(20, seed=1)), FakeSpotify(SyntheticCatalog(20, seed=2))
+        first, second = CachedSpotify(first_spotify, scope=1), CachedSpotify(second_spotify, scope=2)
+
+        first_top = [track['id'] for track in first.current_user_top_tracks(limit=5)['items']]
+        second_top = [track['id'] for track in second.current_user_top_tracks(limit=5)['items']]
+        self.assertEqual([track['id'] for track in first.current_user_top_tracks(limit=5)['items']], first_top)
+        self.assertEqual([track['id'] for track in second.current_user_top_tracks(limit=5)['items']], second_top)
+
+        self.assertNotEqual(first_top, second_top)
+        self.assertEqual(first_spotify.calls['current_user_top_tracks'], 1)
+        self.assertEqual(second_spotify.calls['current_user_top_tracks'], 1)
+
+    def test_catalog_entries_are_shared_and_never_handed_out(self):
+        first_spotify, second_spotify = FakeSpotify(SyntheticCatalog(20, seed=1)), FakeSpotify(SyntheticCatalog(20, seed=2))
+        first, second = CachedSpotify(first_spotify, scope=1), CachedSpotify(second_spotify, scope=2)
+
+        results = first.search(q='genre:"genre 1"', type='track', limit=5)
+        results['tracks']['items'].clear()
+        again = second.search(q=' GENRE:"Genre 1"', type='track', limit=5)
+
+        self.assertGreater(len(again['tracks']['items']), 0)
+        self.assertEqual(second_spotify.calls['search'], 0)
+
+
+class RateLimitedSpotifyTests(TestCase):
+    def setUp(self):
+        self.bucket = mock.Mock(spec=TokenBucket)
+        for patcher in [
+            mock.patch('spotifyapp.spotify_client.rate_limiter', self.bucket),
+            mock.patch('spotifyapp.spotify_client.time.sleep'),
+            mock.patch('spotifyapp.spotify_client.random.uniform', return_value=0.5),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.sp = RateLimitedSpotify(auth='token')
+
+    def call(self, method, responses):
+        with mock.patch('spotipy.Spotify._internal_call', side_effect=responses) as internal_call:
+            try:
+                return self.sp._internal_call(method, 'https://api.spotify.com/v1/me', None, {}), internal_call.call_count
+            except Exception as e:
+                e.call_count = internal_call.call_count
+                raise
+
+    def throttled(self, retry_after):
+        return spotipy.SpotifyException(429, -1, 'API rate limit exceeded', headers={'Retry-After': str(retry_after)})
+
+    def test_429_waits_for_retry_after_and_pauses_everyone(self):
+        result, calls = self.call('GET', [self.throttled(3), {'id': 'me'}])
+
+        self.assertEqual((result, calls), ({'id': 'me'}, 2))
+        self.bucket.pause.assert_called_once_with(3.5)
+        spotify_client.time.sleep.assert_called_once_with(3.5)
+        self.assertEqual(self.bucket.acquire.call_count, 2)
+
+    def test_long_retry_after_fails_instead_of_blocking(self):
+        with self.assertRaises(spotipy.SpotifyException) as raised:
+            self.call('GET', [self.throttled(settings.SPOTIFY_MAX_RETRY_AFTER + 1), {'id': 'me'}])
+        self.assertEqual(raised.exception.call_count, 1)
+        self.bucket.pause.assert_called_once_with(settings.SPOTIFY_MAX_RETRY_AFTER + 1)
+        spotify_client.time.sleep.assert_not_called()
+
+    def test_server_errors_are_retried_then_raised(self):
+        error = spotipy.SpotifyException(503, -1, 'Service unavailable')
+        with self.assertRaises(spotipy.SpotifyException) as raised:
+            self.call('GET', [error] * (MAX_RETRIES + 2))
+        self.assertEqual(raised.exception.call_count, MAX_RETRIES + 1)
+
+    def test_post_is_retried_after_429(self):
+        result, calls = self.call('POST', [self.throttled(1), {'id': 'playlist'}])
+        self.assertEqual((result, calls), ({'id': 'playlist'}, 2))
+
+    def test_post_is_not_retried_once_it_may_have_been_applied(self):
+        for error in [requests.exceptions.ReadTimeout(), spotipy.SpotifyException(502, -1, 'Bad gateway')]:
+            with self.assertRaises(type(error)) as raised:
+                self.call('POST', [error, {'id': 'playlist'}])
+            self.assertEqual(raised.exception.call_count, 1)
+
+    def test_post_is_retried_when_it_never_went_out(self):
+        result, calls = self.call('POST', [requests.exceptions.ConnectTimeout(), {'id': 'playlist'}])
+        self.assertEqual((result, calls), ({'id': 'playlist'}, 2))
+
+
+class _WorkerDied(Exception):
+    pass
+
+
+class LibrarySyncTests(TestCase):
+    def setUp(self):
+        self.catalog = SyntheticCatalog(100, n_genres=8, n_artists=15)
+        # Liked songs are tracks 0-49, playlist i holds tracks 20i to 20i+19
+        self.sp = FakeSpotify(self.catalog, saved_tracks=50, playlists=4, playlist_size=20)
+        self.user = User.objects.create_user('listener')
+        cache.clear()
+
+    def sync(self):
+        enqueue_library_sync(self.user)
+        # The library caches are dropped once the link changes commit
+        with self.captureOnCommitCallbacks(execute=True):
+            return run_job(claim_next_job(), self.sp)
+
+    def track_ids(self, start, end):
+        return {track['id'] for track in self.catalog.tracks[start:end]}
+
+    def test_full_sync(self):
+        job = self.sync()
+
+        self.assertEqual(job.status, SyncJob.DONE)
+        self.assertEqual(job.errors, 0)
+        self.assertEqual(library_track_ids(self.user), self.track_ids(0, 80))
+        self.assertEqual(check_genre_profile(self.user), {})
+
+    def test_unchanged_playlists_and_seen_liked_songs_are_skipped(self):
+        self.sync()
+        fetched = self.sp.calls['playlist_items']
+        newest = self.catalog.tracks[99]
+        self.sp.saved_tracks.insert(0, {'added_at': '2024-02-01T00:00:00Z', 'track': newest})
+
+        job = self.sync()
+
+        self.assertEqual(job.status, SyncJob.DONE)
+        self.assertEqual(self.sp.calls['playlist_items'], fetched)
+        self.assertEqual(self.sp.calls['current_user_saved_tracks'], 2)
+        self.assertIn(newest['id'], library_track_ids(self.user))
+
+    def test_changed_and_removed_playlists_unlink_their_songs(self):
+        self.sync()
+        playlist_ids = list(self.sp.playlists)
+        # Playlist 2 drops its last 10 tracks (not liked), playlist 3 is deleted
+        playlist, items = self.sp.playlists[playlist_ids[2]]
+        self.sp.playlists[playlist_ids[2]] = ({**playlist, 'snapshot_id': 'changed'}, items[:10])
+        del self.sp.playlists[playlist_ids[3]]
+
+        self.sync()
+
+        self.assertEqual(library_track_ids(self.user), self.track_ids(0, 50))
+        self.assertEqual(check_genre_profile(self.user), {})
+
+    def test_multi_page_library(self):
+        self.catalog = SyntheticCatalog(800, n_genres=8, n_artists=15)
+        # Two playlists of 350 tracks (4 pages each) and 620 liked songs (13 pages, 2 write batches)
+        self.sp = FakeSpotify(self.catalog, saved_tracks=620, playlists=2, playlist_size=350)
+
+        job = self.sync()
+
+        self.assertEqual((job.status, job.errors), (SyncJob.DONE, 0))
+        self.assertEqual(library_track_ids(self.user), self.track_ids(0, 700))
+        self.assertEqual(self.sp.calls['playlist_items'], 8)
+        self.assertEqual(self.sp.calls['current_user_saved_tracks'], 13)
+        self.assertEqual((job.pages_fetched, job.pages_total), (22, 22))
+        self.assertEqual(check_genre_profile(self.user), {})
+
+        # 60 songs liked since: the next sync reads two pages of liked songs and stops at the first one it has seen
+        self.sp.saved_tracks[:0] = [
+            {'added_at': f"2024-02-01T00:{59 - i:02d}:00Z", 'track': track} for i, track in enumerate(self.catalog.tracks[700:760])
+        ]
+        job = self.sync()
+
+        self.assertEqual(job.status, SyncJob.DONE)
+        self.assertEqual(self.sp.calls['playlist_items'], 8)
+        self.assertEqual(self.sp.calls['current_user_saved_tracks'], 15)
+        self.assertEqual(library_track_ids(self.user), self.track_ids(0, 760))
+
+    def test_resumes_from_checkpoint_after_a_worker_dies(self):
+        job = enqueue_library_sync(self.user)
+        claim_next_job()
+        job.refresh_from_db()
+        with mock.patch.object(self.sp, 'current_user_saved_tracks', side_effect=_WorkerDied):
+            with self.assertRaises(_WorkerDied):
+                run_library_sync(job, self.sp)
+        SyncJob.objects.filter(id=job.id).update(heartbeat_at=timezone.now() - STALE_AFTER * 2)
+        listed = self.sp.calls['current_user_playlists']
+
+        resumed = claim_next_job()
+        self.assertEqual((resumed.id, resumed.attempts, resumed.checkpoint['phase']), (job.id, 2, 'saved'))
+        run_job(resumed, self.sp)
+
+        self.assertEqual(resumed.status, SyncJob.DONE)
+        self.assertEqual(self.sp.calls['current_user_playlists'], listed)
+        self.assertEqual(library_track_ids(self.user), self.track_ids(0, 80))
+
+
+class RecentlyPlayedTests(TestCase):
+    def test_a_play_seen_twice_is_stored_once(self):
+        catalog, sp = fake_spotify()
+        user = User.objects.create_user('listener')
+
+        self.assertEqual(ingest_recently_played(user, sp), RECENTLY_PLAYED_LIMIT)
+        self.assertEqual(ingest_recently_played(user, sp), 0)
+        self.assertEqual(ListeningHistory.objects.filter(user=user).count(), RECENTLY_PLAYED_LIMIT)
+
+
+class ListeningRollupTests(TestCase):
+    def setUp(self):
+        self.catalog, self.sp = fake_spotify()
+        self.user = User.objects.create_user('listener')
+        self.songs = list(ingest_tracks(self.catalog.tracks[:6], None, self.sp).values())
+        self.start = datetime(2024, 3, 1, 12, tzinfo=dt_timezone.utc)
+
+    def play(self, song, hours, **fields):
+        return ListeningHistory.objects.create(user=self.user, song=song, played_at=self.start + timedelta(hours=hours), **fields)
+
+    def rollups(self):
+        return {
+            dimension: sorted(model.objects.filter(user=self.user).values_list('granularity', 'period_start', f"{field}_id", 'plays'))
+            for dimension, (model, field) in DIMENSIONS.items()
+        }
+
+    def test_incremental_updates_match_a_rebuild(self):
+        for i in range(40):
+            self.play(self.songs[i % 6], hours=i * 7, id=100 + i)
+        self.assertEqual(update_listening_rollups(self.user, chunk_size=9), 40)
+        for i in range(40, 50):
+            self.play(self.songs[i % 4], hours=i * 7)
+        # A play with a lower id than ones already counted, as when a backfill commits after the poller
+        self.play(self.songs[5], hours=-30, id=50)
+
+        self.assertEqual(update_listening_rollups(self.user, chunk_size=9), 11)
+        self.assertEqual(update_listening_rollups(self.user), 0)
+        incremental = self.rollups()
+
+        self.assertEqual(rebuild_listening_rollups(self.user), 51)
+        self.assertEqual(self.rollups(), incremental)
+        self.assertEqual(sum(plays for granularity, start, song_id, plays in incremental['song'] if granularity == ListeningRollup.ALL), 51)
+
+    def test_windows_start_on_a_period_boundary(self):
+        now = datetime(2024, 3, 20, 15, 30, tzinfo=dt_timezone.utc)
+        boundary = period_start(now - WINDOWS['short_term'], ListeningRollup.DAY)
+        ListeningHistory.objects.create(user=self.user, song=self.songs[0], played_at=boundary)
+        ListeningHistory.objects.create(user=self.user, song=self.songs[1], played_at=boundary - timedelta(seconds=1))
+        ListeningHistory.objects.create(user=self.user, song=self.songs[2], played_at=now - timedelta(days=200))
+        update_listening_rollups(self.user)
+
+        with mock.patch('django.utils.timezone.now', return_value=now):
+            windows = {
+                window: {row['song_id']: row['plays'] for row in window_rollups(self.user, 'song', window).values('song_id', 'plays')}
+                for window in WINDOWS
+            }
+        self.assertEqual(windows['short_term'], {self.songs[0].id: 1})
+        self.assertEqual(windows['medium_term'], {self.songs[0].id: 1, self.songs[1].id: 1})
+        self.assertEqual(windows['long_term'], {self.songs[0].id: 1, self.songs[1].id: 1, self.songs[2].id: 1})
+
+
+class SpotifyTokenTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('listener')
+        SpotifyToken.objects.create(user=self.user, access_token='old', refresh_token='refresh', expires_at=int(time.time()) - 10)
+        self.addCleanup(forget_client, self.user.id)
+        patcher = mock.patch('spotifyapp.spotify_auth.oauth_manager')
+        self.refresh = patcher.start().return_value.refresh_access_token
+        self.addCleanup(patcher.stop)
+
+    def test_due_token_is_refreshed_once(self):
+        self.refresh.return_value = {'access_token': 'new', 'expires_at': int(time.time()) + 3600}
+
+        client = client_for_user(self.user)
+
+        self.assertIs(client_for_user(self.user), client)
+        self.assertEqual(self.refresh.call_count, 1)
+        self.assertEqual(SpotifyToken.objects.get(user=self.user).access_token, 'new')
+
+    def test_refresh_locks_dont_grow_with_users(self):
+        self.assertIs(_refresh_lock(self.user.id), _refresh_lock(self.user.id + REFRESH_LOCK_STRIPES))
+        self.assertEqual(len({_refresh_lock(user_id) for user_id in range(10 * REFRESH_LOCK_STRIPES)}), REFRESH_LOCK_STRIPES)
+
+    def test_refused_refresh_sends_the_user_to_connect_again(self):
+        self.refresh.side_effect = SpotifyOauthError('invalid_grant', error='invalid_grant')
+        self.client.force_login(self.user)
+
+        for name in ['view_top_artists', 'view_top_songs']:
+            with self.subTest(name=name):
+                response = self.client.get(reverse(name))
+                self.assertRedirects(response, reverse('spotify_login'), fetch_redirect_response=False)
+        self.assertIsNone(client_for_user(self.user))
+
+
+class SharedSessionTests(TestCase):
+    def setUp(self):
+        # oauth_manager reads the app's credentials from the environment, any values do here
+        patcher = mock.patch.dict(os.environ, {
+            'SPOTIPY_CLIENT_ID': 'test-client', 'SPOTIPY_CLIENT_SECRET': 'test-secret', 'SPOTIPY_REDIRECT_URI': 'http://testserver/callback/',
+        })
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        catalog, sp = fake_spotify()
+        self.server = FakeSpotifyServer(('127.0.0.1', 0), spotify=sp)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/v1/me/"
+
+    def pools(self):
+        return len(spotify_client.session.get_adapter(self.url).poolmanager.pools)
+
+    def test_collected_oauth_manager_leaves_the_shared_session_open(self):
+        self.assertEqual(spotify_client.session.get(self.url).status_code, 200)
+        pools = self.pools()
+        self.assertGreater(pools, 0)
+
+        manager = oauth_manager()
+        self.assertIs(manager._session, spotify_client.session)
+        del manager
+        gc.collect()
+
+        self.assertEqual(self.pools(), pools)
+        self.assertEqual(spotify_client.session.get(self.url).status_code, 200)
+
+
+class LibraryCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.catalog, self.sp = fake_spotify()
+        self.user = User.objects.create_user('listener')
+        self.songs = ingest_tracks(self.catalog.tracks[:5], None, self.sp)
+
+    def test_library_cache_is_dropped_when_the_links_commit(self):
+        self.assertEqual(library_track_ids(self.user), frozenset())
+        version = user_cache_version(self.user.id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            link_songs_to_user([song.id for song in self.songs.values()], self.user)
+            # Until the commit, other requests must not rebuild from links they can't see yet
+            self.assertEqual(library_track_ids(self.user), frozenset())
+            self.assertEqual(user_cache_version(self.user.id), version)
+
+        self.assertEqual(library_track_ids(self.user), set(self.songs))
+        self.assertEqual(user_cache_version(self.user.id), version + 1)
+
+    def test_rolled_back_links_keep_the_cache(self):
+        library_track_ids(self.user)
+        with self.captureOnCommitCallbacks() as callbacks:
+            try:
+                with transaction.atomic():
+                    link_songs_to_user([song.id for song in self.songs.values()], self.user)
+                    raise _WorkerDied()
+            except _WorkerDied:
+                pass
+        self.assertEqual(callbacks, [])
+        self.assertEqual(library_track_ids(self.user), frozenset())
+
+    def test_links_changed_by_another_process_are_seen(self):
+        self.assertEqual(library_track_ids(self.user), frozenset())
+        # A sync worker has its own cache, all it shares with this process is the database
+        self.user.songs.add(*self.songs.values())
+        UserSyncState.objects.create(user=self.user, cache_version=user_cache_version(self.user.id) + 1)
+        self.assertEqual(library_track_ids(self.user), set(self.songs))
+
+    def test_evicted_cache_keeps_the_version(self):
+        bump_user_cache_version(self.user.id)
+        bump_user_cache_version(self.user.id)
+        cache.clear()
+        self.assertEqual(user_cache_version(self.user.id), 2)
+        bump_user_cache_version(self.user.id)
+        self.assertEqual(user_cache_version(self.user.id), 3)
+
+
+class TopItemsPageTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.catalog, self.spotify = fake_spotify()
+        self.user = User.objects.create_user('listener')
+        # No CachedSpotify in between, so every page rebuild shows up as a call to the fake
+        use_client(self.user.id, self.spotify)
+        self.addCleanup(forget_client, self.user.id)
+        self.client.force_login(self.user)
+
+    def get(self, name, **headers):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.get(reverse(name), **headers)
+
+    def test_library_changes_dont_throw_away_top_pages(self):
+        pages = [('view_top_songs', 'current_user_top_tracks', 50), ('view_top_artists', 'current_user_top_artists', 55)]
+        for name, endpoint, start in pages:
+            first = self.get(name)
+            self.assertEqual(self.spotify.calls[endpoint], 1)
+
+            # Building the top songs page links its tracks, and syncs link more songs all the time
+            version = user_cache_version(self.user.id)
+            with self.captureOnCommitCallbacks(execute=True):
+                ingest_tracks(self.catalog.tracks[start:start + 5], self.user, self.spotify)
+            self.assertNotEqual(user_cache_version(self.user.id), version)
+
+            again = self.get(name)
+            self.assertEqual(again.content, first.content)
+            self.assertEqual(self.get(name, HTTP_IF_NONE_MATCH=first['ETag']).status_code, 304)
+            self.assertEqual(self.spotify.calls[endpoint], 1)
+
+
+class ApiPaginationTests(TestCase):
+    def setUp(self):
+        self.catalog, self.sp = fake_spotify()
+        self.user = User.objects.create_user('listener')
+        ingest_tracks(self.catalog.tracks, self.user, self.sp)
+        ingest_recently_played(self.user, self.sp)
+        # Two plays at the same moment, only the id tells them apart
+        played_at = ListeningHistory.objects.filter(user=self.user).latest('played_at').played_at
+        ListeningHistory.objects.create(user=self.user, song=Song.objects.get(track_id=self.catalog.tracks[-1]['id']), played_at=played_at)
+        self.client.force_login(self.user)
+
+    #Method that follows next_cursor to the end, returns every result and the number of pages
+    def walk(self, name, limit, **params):
+        results, pages, cursor = [], 0, None
+        while True:
+            query = {**params, 'limit': limit, **({'cursor': cursor} if cursor else {})}
+            response = self.client.get(reverse(name), query)
+            self.assertEqual(response.status_code, 200)
+            results += response.json()['results']
+            pages += 1
+            cursor = response.json()['next_cursor']
+            if cursor is None:
+                return results, pages
+
+    def test_pages_cover_every_row_once_in_order(self):
+        library, pages = self.walk('api_library_songs', 7, fields='track_id')
+        expected = list(Song.objects.filter(users=self.user).order_by('id').values_list('track_id', flat=True))
+        self.assertEqual([result['track_id'] for result in library], expected)
+        self.assertEqual(pages, 9)
+
+        history, _ = self.walk('api_listening_history', 7, fields='track_id,played_at')
+        rows = ListeningHistory.objects.filter(user=self.user).order_by('-played_at', '-id')
+        self.assertEqual([result['track_id'] for result in history], [row.song.track_id for row in rows])
+
+        genres, _ = self.walk('api_top_genres', 3)
+        expected = UserGenreProfile.objects.filter(user=self.user, song_count__gt=0).order_by('-song_count', 'genre__name')
+        self.assertEqual([result['genre'] for result in genres], [profile.genre.name for profile in expected])
+
+    def test_bad_cursors_are_rejected(self):
+        cases = [
+            ('api_top_genres', [{'a': 1}, 2]),
+            ('api_top_genres', [3, 4]),
+            ('api_top_genres', ['3', 'rock']),
+            ('api_library_songs', ['1']),
+            ('api_library_songs', [True]),
+            ('api_library_songs', [1.5]),
+            ('api_library_songs', [2 ** 70]),
+            ('api_library_songs', [1, 2]),
+            ('api_listening_history', ['yesterday', 1]),
+            ('api_listening_history', ['2024-01-01T00:00:00', 1]),
+            ('api_listening_history', [1, 1]),
+            ('api_top_songs', [None, 1]),
+        ]
+        for name, values in cases:
+            with self.subTest(name=name, cursor=values):
+                response = self.client.get(reverse(name), {'cursor': encode_cursor(values)})
+                self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get(reverse('api_library_songs'), {'cursor': 'not a cursor'}).status_code, 400)
+
+
+#Function that makes a recommendation candidate with the given genres, artists and scores
+def candidate(track_id, genres=(), artist_ids=(), popularity=None, neighbor_score=0.0):
+    result = Candidate({'id': track_id, 'popularity': popularity, 'artists': [{'id': artist_id} for artist_id in artist_ids]})
+    result.genres = list(genres)
+    result.neighbor_score = neighbor_score
+    return result
+
+
+class ScoringTests(TestCase):
+    def setUp(self):
+        self.affinity = Affinity({'rock': 3, 'jazz': 1}, {'artist a': 1.0})
+        self.candidates = [
+            candidate('rock', genres=['rock'], popularity=10),
+            candidate('jazz', genres=['jazz'], popularity=20),
+            candidate('artist', artist_ids=['artist a'], popularity=30),
+            candidate('neighbor', popularity=None, neighbor_score=2.0),
+            candidate('other', genres=['polka'], artist_ids=['artist z'], popularity=100, neighbor_score=1.0),
+        ]
+
+    def scores(self, **weights):
+        weights = {'weight_genres': 0, 'weight_artists': 0, 'weight_popularity': 0, 'weight_neighbors': 0, **weights}
+        return score_candidates(self.candidates, self.affinity, **weights).tolist()
+
+    def test_top_k_matches_a_full_sort(self):
+        # Few distinct scores, so there are plenty of ties to break by position
+        scores = np.random.default_rng(0).integers(0, 20, 200).astype(float)
+        expected = sorted(range(len(scores)), key=lambda position: (-scores[position], position))
+        for k in (0, 1, 5, 50, 199, 200, 250):
+            with self.subTest(k=k):
+                self.assertEqual(top_k(scores, k).tolist(), expected[:k])
+        self.assertEqual(top_k(np.zeros(0), 5).tolist(), [])
+
+    def test_each_term_on_its_own(self):
+        self.assertEqual(self.scores(), [0.0] * 5)
+        genres = self.scores(weight_genres=10)
+        self.assertAlmostEqual(genres[0], 10 * 3 / np.sqrt(10))
+        self.assertAlmostEqual(genres[1], 10 * 1 / np.sqrt(10))
+        self.assertEqual(genres[2:], [0.0] * 3)
+        self.assertEqual(self.scores(weight_artists=10), [0.0, 0.0, 10.0, 0.0, 0.0])
+        # Candidates without a popularity count as DEFAULT_POPULARITY
+        self.assertEqual(self.scores(weight_popularity=10), [1.0, 2.0, 3.0, 5.0, 10.0])
+        # Neighbor scores are scaled so the best one is 1
+        self.assertEqual(self.scores(weight_neighbors=10), [0.0, 0.0, 0.0, 10.0, 5.0])
+
+    def test_zero_weights_drop_a_term(self):
+        full = score_candidates(self.candidates, self.affinity)
+        without_genres = score_candidates(self.candidates, self.affinity, weight_genres=0)
+        np.testing.assert_allclose(full - without_genres, np.array(self.scores(weight_genres=WEIGHT_GENRES)))
+        without_neighbors = score_candidates(self.candidates, self.affinity, weight_neighbors=0)
+        np.testing.assert_allclose(full - without_neighbors, np.array(self.scores(weight_neighbors=WEIGHT_NEIGHBORS)))
+
+    def test_weights_change_the_ranking(self):
+        # A user with no library or top artists, only popularity and neighbors can tell the candidates apart
+        user = User.objects.create_user('listener')
+        rank = partial(rank_candidates, user, self.candidates, [], 3, weight_genres=0, weight_artists=0)
+        self.assertEqual(rank(weight_popularity=10, weight_neighbors=0), ['other', 'neighbor', 'artist'])
+        self.assertEqual(rank(weight_popularity=0, weight_neighbors=10), ['neighbor', 'other', 'rock'])
+        self.assertEqual(rank(weight_popularity=1, weight_neighbors=10), ['neighbor', 'other', 'artist'])
+
+
+class TrackNeighborTests(TestCase):
+    def setUp(self):
+        #   listener 1: songs 1, 2, 3
+        #   listener 2: songs 1, 2
+        #   listener 3: songs 3, 4
+        self.users = [User.objects.create_user(f'listener{number}') for number in (1, 2, 3)]
+        self.songs = [Song.objects.create(track_id=f'track{number}', track_name=f'Track {number}') for number in (1, 2, 3, 4)]
+        for user, songs in zip(self.users, [(0, 1, 2), (0, 1), (2, 3)]):
+            user.songs.add(*[self.songs[position] for position in songs])
+        # Cosine similarity of the songs' user sets
+        pair = 1 / np.sqrt(2)
+        self.expected = {
+            ('track1', 'track2'): 1.0, ('track1', 'track3'): 0.5,
+            ('track2', 'track1'): 1.0, ('track2', 'track3'): 0.5,
+            ('track3', 'track4'): pair, ('track3', 'track1'): 0.5, ('track3', 'track2'): 0.5,
+            ('track4', 'track3'): pair,
+        }
+
+    def neighbors(self):
+        rows = TrackNeighbor.objects.values_list('song__track_id', 'neighbor__track_id', 'score')
+        return {(song, neighbor): score for song, neighbor, score in rows}
+
+    def assertNeighbors(self, expected):
+        neighbors = self.neighbors()
+        self.assertEqual(set(neighbors), set(expected))
+        for pair, score in expected.items():
+            self.assertAlmostEqual(neighbors[pair], score, msg=pair)
+
+    def test_link_matrix(self):
+        Link = Song.users.through
+        expected = [[1, 1, 0], [1, 1, 0], [1, 0, 1], [0, 0, 1]]
+        for chunk_size in (1, 3, 100):
+            with self.subTest(chunk_size=chunk_size):
+                matrix, song_ids = link_matrix(Link, 'song_id', 'user_id', chunk_size=chunk_size)
+                self.assertEqual(song_ids.tolist(), [song.id for song in self.songs])
+                self.assertEqual(matrix.toarray().tolist(), expected)
+
+        # Links to users outside the given columns are skipped
+        columns = np.array(sorted(user.id for user in self.users[1:]))
+        matrix, song_ids = link_matrix(Link, 'song_id', 'user_id', columns=columns, chunk_size=2)
+        self.assertEqual(song_ids.tolist(), [song.id for song in self.songs])
+        self.assertEqual(matrix.toarray().tolist(), [[1, 0], [1, 0], [0, 1], [0, 1]])
+
+    def test_similarity_blocks(self):
+        matrix, _ = link_matrix(Song.users.through, 'song_id', 'user_id')
+        # Each song's products are the library sizes of its users: 3 + 2, 3 + 2, 3 + 2 and 2
+        self.assertEqual(list(similarity_blocks(matrix, max_products=100)), [(0, 4)])
+        self.assertEqual(list(similarity_blocks(matrix, max_products=10)), [(0, 2), (2, 4)])
+        self.assertEqual(list(similarity_blocks(matrix, max_products=12)), [(0, 2), (2, 4)])
+        # A song over the limit still gets a block of its own
+        self.assertEqual(list(similarity_blocks(matrix, max_products=1)), [(0, 1), (1, 2), (2, 3), (3, 4)])
+
+    def test_build_track_neighbors(self):
+        # One chunk and one block, or a library read over many chunks and scored over many blocks
+        for chunk_size, max_products in [(100, 100), (2, 5), (1, 1)]:
+            with self.subTest(chunk_size=chunk_size, max_products=max_products):
+                self.assertEqual(build_track_neighbors(chunk_size=chunk_size, max_products=max_products), len(self.expected))
+                self.assertNeighbors(self.expected)
+
+        build_track_neighbors(k=1, chunk_size=2, max_products=5)
+        self.assertNeighbors({
+            ('track1', 'track2'): 1.0, ('track2', 'track1'): 1.0, ('track3', 'track4'): 1 / np.sqrt(2), ('track4', 'track3'): 1 / np.sqrt(2),
+        })
+        build_track_neighbors(min_shared=2)
+        self.assertNeighbors({('track1', 'track2'): 1.0, ('track2', 'track1'): 1.0})
+
+    def test_songs_nobody_has_lose_their_neighbors(self):
+        build_track_neighbors()
+        self.users[2].songs.remove(self.songs[3])
+        build_track_neighbors(chunk_size=2, max_products=5)
+        self.assertNeighbors({
+            ('track1', 'track2'): 1.0, ('track1', 'track3'): 0.5,
+            ('track2', 'track1'): 1.0, ('track2', 'track3'): 0.5,
+            ('track3', 'track1'): 0.5, ('track3', 'track2'): 0.5,
+        })
+
+
+class GenreGraphTests(TestCase):
+    def setUp(self):
+        # Each process keeps the graph it loaded, don't leave this test's graph behind for the others
+        patcher = mock.patch('spotifyapp.genre_graph._graph', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.user = User.objects.create_user('listener')
+        songs = [
+            Song.objects.create(track_id=f'track{number}', track_name=f'Track {number}', genres=genres, popularity=popularity)
+            for number, (genres, popularity) in enumerate([('a, b', 10), ('a, b', 30), ('b, c', 20), ('c', 90), ('a', 50)], 1)
+        ]
+        link_song_genres(songs)
+        self.user.songs.add(songs[4])
+        # 'd' isn't on any song, so it isn't a Genre and the graph leaves it out
+        Artist.objects.create(artist_id='artist1', name='Artist 1', genres='c, d')
+        Artist.objects.create(artist_id='artist2', name='Artist 2', genres='a')
+
+    def test_build_genre_graph(self):
+        # Genre sets: the songs {a, b} {a, b} {b, c} {c} {a} and the artists {c} {a}, so a is in 4, b in 3 and c in 3
+        self.assertEqual(build_genre_graph(), 4)
+        edges = {(edge.genre.name, edge.neighbor.name): edge.weight for edge in GenreEdge.objects.select_related('genre', 'neighbor')}
+        self.assertEqual(set(edges), {('a', 'b'), ('b', 'a'), ('b', 'c'), ('c', 'b')})
+        self.assertAlmostEqual(edges['a', 'b'], 2 / np.sqrt(12))
+        self.assertAlmostEqual(edges['b', 'c'], 1 / 3)
+
+        neighbors = neighboring_genres('b')
+        self.assertEqual([name for name, weight in neighbors], ['a', 'c'])
+        self.assertEqual(neighboring_genres('b', limit=1), neighbors[:1])
+        self.assertEqual(neighboring_genres('d'), [])
+
+        # A rebuild replaces every edge and reloads the graph
+        self.assertEqual(build_genre_graph(k=1), 3)
+        self.assertEqual([name for name, weight in neighboring_genres('b')], ['a'])
+
+    def test_songs_in_genres(self):
+        def track_ids(*args, **kwargs):
+            return [row['track_id'] for row in songs_in_genres(self.user, *args, **kwargs)]
+
+        # The user's own songs are left out, the most weighted genre comes first, then popularity
+        self.assertEqual(track_ids({'a': 1.0}, 10), ['track2', 'track1'])
+        self.assertEqual(track_ids({'a': 0.5, 'c': 1.0}, 10), ['track4', 'track3', 'track2', 'track1'])
+        self.assertEqual(track_ids({'a': 0.5, 'c': 1.0}, 10, least_popular_first=True), ['track3', 'track4', 'track1', 'track2'])
+        # A song in several of the genres counts with its best one
+        self.assertEqual(track_ids({'a': 1.0, 'b': 0.5}, 2), ['track2', 'track1'])
+        self.assertEqual(songs_in_genres(self.user, {}, 10), [])
+        row = songs_in_genres(self.user, {'b': 0.25}, 1)[0]
+        self.assertEqual(row, {'track_id': 'track2', 'popularity': 30, 'genres': 'a, b', 'affinity': 0.25})
+
+
+class GenrePlaylistTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch('spotifyapp.genre_graph._graph', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.catalog, self.sp = fake_spotify()
+        # Our catalog only has half of Spotify's tracks
+        ingest_tracks(self.catalog.tracks[:30], User.objects.create_user('someone else'), self.sp)
+        build_genre_graph()
+        self.user = User.objects.create_user('listener')
+        use_client(self.user.id, self.sp)
+        self.addCleanup(forget_client, self.user.id)
+        self.client.force_login(self.user)
+
+    #Method that asks for a playlist of the genre, returns the response and the track IDs put in the playlist
+    def create(self, genre, num_songs):
+        with mock.patch.object(self.sp, 'playlist_add_items', wraps=self.sp.playlist_add_items) as add_items:
+            response = self.client.post(reverse('create_genre_playlist'), {'explore_a_genre': genre, 'num_songs': num_songs})
+        return response, [track_id for call in add_items.call_args_list for track_id in call.args[1]]
+
+    def genre_track_ids(self, genre):
+        return {track['id'] for track in self.catalog.tracks_by_genre[genre]}
+
+    def test_the_genre_comes_before_its_neighbors(self):
+        # A mid-sized genre of the fixture, half of its songs are in our catalog and most of our songs aren't in it
+        genre = 'genre 4'
+        owned = self.catalog.tracks_by_genre[genre][0]
+        ingest_tracks([owned], self.user, self.sp)
+        expected = self.genre_track_ids(genre) - {owned['id']}
+
+        # Spotify's songs in the genre come before our songs in the neighboring genres
+        response, track_ids = self.create(genre, len(expected))
+        self.assertRedirects(response, reverse('index'), fetch_redirect_response=False)
+        self.assertEqual(sorted(track_ids), sorted(expected))
+
+        # Neighbors only top the playlist up
+        response, track_ids = self.create(genre, len(expected) + 3)
+        self.assertEqual(len(track_ids), len(set(track_ids)))
+        self.assertEqual(set(track_ids) & expected, expected)
+        extra = set(track_ids) - expected
+        self.assertEqual(len(extra), 3)
+        neighbors = {name for name, weight in neighboring_genres(genre, GENRE_PLAYLIST_NEIGHBORS)}
+        for song in Song.objects.filter(track_id__in=extra):
+            self.assertTrue(neighbors & set(split_genres(song.genres)), song.track_id)
+
+    def test_genre_without_songs(self):
+        # The user already has every song of the genre, so the genre's neighbors mustn't make up a playlist for it
+        genre = min(
+            (name for name in self.catalog.tracks_by_genre if neighboring_genres(name, GENRE_PLAYLIST_NEIGHBORS)),
+            key=lambda name: len(self.catalog.tracks_by_genre[name]),
+        )
+        ingest_tracks(self.catalog.tracks_by_genre[genre], self.user, self.sp)
+
+        for name in (genre, 'no such genre'):
+            with self.subTest(genre=name):
+                response, track_ids = self.create(name, 10)
+                self.assertEqual(response.content, b"No tracks found for the specified genre.")
+        self.assertEqual(self.sp.calls['user_playlist_create'], 0)
+
+
+class MetricsTests(TestCase):
+    def test_spotify_statuses_and_errors_render_together(self):
+        # Outside a request
+        record_spotify_call(429, 0.5)
+        record_spotify_call('error', 0.1)
+        # And inside one
+        metrics = RequestMetrics()
+        metrics.view = 'metrics test'
+        token = _current.set(metrics)
+        try:
+            record_spotify_call(200, 0.2)
+            record_spotify_call('error', 0.3)
+        finally:
+            _current.reset(token)
+        metrics.publish()
+        self.assertEqual(metrics.spotify_statuses, {'200': 1, 'error': 1})
+
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        for view, status in [(NO_VIEW, '429'), (NO_VIEW, 'error'), ('metrics test', '200'), ('metrics test', 'error')]:
+            self.assertRegex(response.content.decode(), rf'(?m)^spotify_requests_total{{view="{view}",status="{status}"}} \d+$')
+
+    def test_requests_are_labelled_by_view(self):
+        self.client.force_login(User.objects.create_user('listener'))
+        with override_settings(METRICS_SERVER_TIMING=True):
+            response = self.client.get(reverse('api_library_songs'))
+        self.assertEqual(response.status_code, 200)
+        timing = response['Server-Timing']
+        for name in ('db', 'spotify', 'app', 'metrics', 'total'):
+            self.assertRegex(timing, rf'(^|, ){name};dur=[\d.]+')
+        self.assertRegex(timing, r'db;dur=[\d.]+;desc="[1-9]\d* queries"')
+        self.assertIn('spotify;dur=0.0;desc="0 calls"', timing)
+        self.assertIn('cache;desc="', timing)
+
+        rendered = render_metrics()
+        self.assertRegex(rendered, r'(?m)^django_request_duration_seconds_count{view="api_library_songs",method="GET",status="200"} \d+$')
+        self.assertRegex(rendered, r'(?m)^django_db_queries_total{view="api_library_songs"} \d+$')
+
+        with override_settings(METRICS_SERVER_TIMING=False):
+            self.assertNotIn('Server-Timing', self.client.get(reverse('api_library_songs')))
+
+    def test_only_allowed_addresses_read_the_metrics(self):
+        with override_settings(METRICS_ALLOWED_IPS=['127.0.0.1']):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 200)
+            self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.1').status_code, 403)
+        with override_settings(METRICS_ALLOWED_IPS=None):
+            self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.1').status_code, 200)
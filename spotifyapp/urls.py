@@ -1,5 +1,5 @@
 from django.urls import path
-from . import views
+from . import api, metrics, views
 from django.conf import settings
 from django.conf.urls.static import static
 
@@ -15,6 +15,7 @@ urlpatterns = [
     
     
     path('add_all_songs_to_database/', views.add_all_songs_to_database, name='add_all_songs_to_database'),
+    path('sync_progress/<int:job_id>/', views.sync_progress, name='sync_progress'),
     path('view_top_artists/', views.view_top_artists, name='view_top_artists'),
     path('view_top_artists/<str:time_range>/', views.view_top_artists, name='view_top_artists_time'),
     path('view_top_genres/', views.view_top_genres, name='view_top_genres'),
@@ -24,4 +25,13 @@ urlpatterns = [
     path('last_50_played/', views.view_last_50_listens, name='view_last_50_songs'),
     path('view_top_songs/<str:time_range>/', views.view_top_songs, name='view_top_songs_time'),
     path('create_genre_playlist/', views.create_genre_playlist, name='create_genre_playlist'),
+
+    # Read-only JSON API, cursor paginated
+    path('api/genres/', api.top_genres, name='api_top_genres'),
+    path('api/genres/neighbors/', api.genre_neighbors, name='api_genre_neighbors'),
+    path('api/top_songs/', api.top_songs, name='api_top_songs'),
+    path('api/library/', api.library_songs, name='api_library_songs'),
+    path('api/history/', api.listening_history, name='api_listening_history'),
+    # Prometheus scrape target
+    path('metrics', metrics.metrics_view, name='metrics'),
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
\ No newline at end of file
@@ -1,24 +1,29 @@
 import random
 import spotipy
-from spotipy.oauth2 import SpotifyOAuth, SpotifyOauthError
-from django.shortcuts import render, redirect
+from spotipy.oauth2 import SpotifyOauthError
+from django.shortcuts import get_object_or_404, render, redirect
+from django.urls import reverse
 from django.http import HttpResponse, JsonResponse
 from django.core.paginator import Paginator
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.forms import UserCreationForm
 from django.views.decorators.csrf import csrf_exempt
-import environ
-import os
-import requests
 import logging
-from myspotifyproject.settings import BASE_DIR
-from .models import Song, ListeningHistory
+from .models import Song, ListeningHistory, SyncJob
+from .ingestion import hydrate_tracks, ingest_tracks
+from .recommendations import add_neighbor_candidates, adjacent_genre_candidates, gather_candidates, merge_candidates
+from .scoring import WEIGHT_ARTISTS, WEIGHT_GENRES, WEIGHT_NEIGHBORS, WEIGHT_POPULARITY, rank_candidates
+from .spotify_auth import client_for_user, oauth_manager, save_token
+from .library import library_track_ids
+from .caching import cached_for_user, cached_page_response
+from .sync import enqueue_library_sync, job_progress
+from .genre_graph import neighboring_genres, songs_in_genres
+from .genres import build_genre_collage_index, link_song_genres, top_genres_for_user
 from django.db.models import Avg, Count
 import time
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 import time
-from django.core.cache import cache
 
 
 
@@ -29,91 +34,45 @@ from django.core.cache import cache
 
 logger = logging.getLogger(__name__)
 
-# Set the timeout value (in seconds)
-TIMEOUT = 5
-MAX_RETRIES = 3
-
-# Load environment variables
-env = environ.Env()
-environ.Env.read_env(os.path.join(BASE_DIR, 'secret.env'))
-
-# Configure the Spotipy client to use a session with a timeout
-session = requests.Session()
-adapter = requests.adapters.HTTPAdapter(max_retries=MAX_RETRIES)
-session.mount('https://', adapter)
-sp = spotipy.Spotify(auth_manager=SpotifyOAuth(
-        client_id= env('SPOTIPY_CLIENT_ID'),
-        client_secret=env('SPOTIPY_CLIENT_SECRET'),
-        redirect_uri='http://localhost:8888/callback',
-        scope='playlist-modify-private playlist-modify-public user-library-read user-top-read user-read-recently-played playlist-read-private'
-    ))
+# Spotify's top artists/tracks only change a few times a day, so their pages are kept this long (seconds)
+TOP_ITEMS_TIMEOUT = 60 * 60
+# How many of the explored genre's closest genres a genre playlist is topped up from
+GENRE_PLAYLIST_NEIGHBORS = 5
 
 def spotify_callback(request):
-    sp_oauth = spotipy.Spotify(auth_manager = SpotifyOAuth(
-        client_id= env('SPOTIPY_CLIENT_ID'),
-        client_secret=env('SPOTIPY_CLIENT_SECRET'),
-        redirect_uri=env('SPOTIPY_REDIRECT_URI'),
-        scope='playlist-modify-private playlist-modify-public user-library-read user-top-read user-read-recently-played'
-    ))
-
     code = request.GET.get('code')
     if not code:
-        print("No authorization code found in request.")
-        return redirect('login')
-
-    token_info = sp_oauth.get_access_token(code)
+        logger.warning("No authorization code found in Spotify callback.")
+        return redirect('login_view')
 
-    print("DEBUG: token_info received from Spotify:", token_info)
+    try:
+        token_info = oauth_manager().get_access_token(code, as_dict=True, check_cache=False)
+    except SpotifyOauthError as e:
+        logger.error(f"Could not get a Spotify token: {e}")
+        return redirect('spotify_login')
 
-    if token_info and 'access_token' in token_info:
-        # Force session to be stored explicitly
-        request.session['token_info'] = token_info
-        request.session.save()  # 👈 Explicitly save session
-        print("token_info successfully stored in session:", request.session['token_info'])
+    if request.user.is_authenticated:
+        save_token(request.user, token_info)
     else:
-        print("Failed to retrieve token_info from Spotify.")
-
+        # Held in the session until they log in, get_spotify_client moves it to their account
+        request.session['token_info'] = token_info
+    logger.info("Spotify account connected.")
     return redirect('view_top_artists')
 
 def spotify_login(request):
     logger.info("Spotify login requested.")
-    sp_oauth = SpotifyOAuth(client_id= env('SPOTIPY_CLIENT_ID'),
-                            client_secret=env('SPOTIPY_CLIENT_SECRET'),
-                            redirect_uri='http://localhost:8888/callback',
-                            scope='playlist-modify-private playlist-modify-public user-library-read user-top-read user-read-recently-played')
-    auth_url = sp_oauth.get_authorize_url()
-    return redirect(auth_url)
+    return redirect(oauth_manager().get_authorize_url())
 
+#Function that returns the logged in user's pooled Spotify client, or None if they need to connect Spotify first
 def get_spotify_client(request):
-    logger.info("Checking for Spotify client in session...")
-
-    # Debug: Log session contents
-    logger.info(f"Current session contents: {dict(request.session.items())}")
-
-    token_info = request.session.get('token_info', None)
-    if not token_info:
-        logger.warning("No token info found in session.")
+    if not request.user.is_authenticated:
         return None
+    token_info = request.session.pop('token_info', None)
+    if token_info:
+        save_token(request.user, token_info)
+    return client_for_user(request.user)
 
-    # Refresh the token if it's expired
-    if token_info['expires_at'] - time.time() < 60:
-        sp = spotipy.Spotify(auth_manager=SpotifyOAuth(
-                client_id= env('SPOTIPY_CLIENT_ID'),
-                client_secret=env('SPOTIPY_CLIENT_SECRET'),
-                redirect_uri='http://localhost:8888/callback'))
-        try:
-            logger.info("Refreshing expired token...")
-            token_info = sp.refresh_access_token(token_info['refresh_token'])
-            request.session['token_info'] = token_info
-            request.session.modified = True
-            logger.info("Token refreshed successfully!")
-        except SpotifyOauthError as e:
-            logger.error(f"Error refreshing token: {e}")
-            return redirect('spotify_login')
-
-    logger.info(f"Using access token: {token_info['access_token']}")
-    return spotipy.Spotify(auth=token_info['access_token'])
-
+@login_required
 def test_spotify_connection(request):
     logger.info("Testing Spotify connection...")
 
@@ -176,242 +135,135 @@ def extract_playlist_id(playlist_link):
         return None
 
 #Function that will add a track to my database, so that I don't have to rely as heavily on API calls
-def get_or_create_song(track, user):
+def get_or_create_song(track, user, sp):
     try:
         track_id = track.get('id')
         if not track_id:
             logger.warning("Track ID is missing.")
             return None
 
-        # Check if the song already exists
-        song, created = Song.objects.get_or_create(track_id=track_id)
-
-        if created:
-            # Populate song fields with available track data
-            song.track_name = track.get('name', 'Unknown')
-            song.artist_names = ', '.join([artist.get('name', 'Unknown') for artist in track.get('artists', [])])
-            song.album_art = track.get('album', {}).get('images', [{}])[0].get('url', '')
-            song.popularity = track.get('popularity')
-            song.release_date = track.get('album', {}).get('release_date', 'Unknown')
-            
-            logger.info(f"Audio features are deprecated, storing only available metadata for {track_id}.")
-            
-            # Fetch and save genres
-            genres = []
-            for artist in track.get('artists', []):
-                artist_id = artist.get('id')
-                if artist_id:
-                    try:
-                        artist_info = sp.artist(artist_id)
-                        genres.extend(artist_info.get('genres', []))
-                    except Exception as e:
-                        logger.warning(f"Failed to fetch genres for artist {artist_id}: {e}")
-            song.genres = ', '.join(genres)
-            
-            # Save the song to the database
-            song.save()
-
-        # Associate the user with this song if not already associated
-        if not song.users.filter(id=user.id).exists():
-            song.users.add(user)
-            song.save()
-            logger.info(f"User {user.username} added song {track_id} to their list.")
-
-        return song
+        # Goes through the same bulk path as library syncs, so single tracks and whole pages behave the same. A track
+        # we already have (and the user already has) costs two reads, many tracks should go to ingest_tracks together
+        return ingest_tracks([track], user, sp).get(track_id)
     except Exception as e:
         logger.error(f"Error in get_or_create_song: {e}")
         return None
 
 #Function that will show you your top artists
+#The rendered page is cached per user and time range, and repeat visits are answered from it (or with a 304).
+#It only shows Spotify data, so it isn't tied to the library version and songs being linked don't throw it away.
+@login_required
 def view_top_artists(request, time_range='short_term'):
-    top_artists = sp.current_user_top_artists(limit=50, time_range=time_range)['items']
+    sp = get_spotify_client(request)
+    if sp is None:
+        return redirect('spotify_login')
+
+    def build():
+        top_artists = sp.current_user_top_artists(limit=50, time_range=time_range)['items']
+
+        artists = []
+        #Adds all desired info to each artist
+        for i, artist in enumerate(top_artists):
+            artist_name = artist.get('name', 'Unknown')
+            artist_photo = artist['images'][0]['url'] if artist.get('images') else ''
+            popularity = artist.get('popularity', 0)
+            artists.append((i + 1, artist_name, artist_photo, popularity))
+
+        context = {'artists': artists, 'time_range': time_range}
+        return 'spotifyapp/view_top_artists.html', context, [artist['id'] for artist in top_artists]
+
+    return cached_page_response(request, f"top_artists_{time_range}", build, timeout=TOP_ITEMS_TIMEOUT, versioned=False)
+
+#Function that builds the rows of the top genres page: (rank, genre, song count, 4 album covers, 4 artists)
+def build_top_genres(user, sp):
+    # Genre counts come straight out of the database, most listened first
+    sorted_genres = top_genres_for_user(user)
+    genre_list = []
+
+    # One walk over the user's songs builds every genre's collage, the loop below is just lookups
+    collages = build_genre_collage_index(user, [genre for genre, count in sorted_genres])
+
+    for i, (genre, count) in enumerate(sorted_genres):
+        unique_images, unique_artists = collages[genre]
+        seen_artists = set(unique_artists)
+        seen_album_arts = set(unique_images)
+
+        # Fallback to Spotify if needed
+        if len(unique_images) < 4 and sp is not None:
+            try:
+                results = sp.search(q=f'genre:"{genre}"', type='track', limit=20)
+                for item in results['tracks']['items']:
+                    track_id = item['id']
+                    track_name = item['name']
+                    popularity = item['popularity']
+                    album_art = item['album']['images'][0]['url'] if item['album']['images'] else None
+                    genres_list = [genre]  # You can’t get genre from track in Spotify API directly
+
+                    artist_names_list = [artist['name'] for artist in item['artists']]
+                    if artist_names_list[0] == "Tyler, The Creator":
+                        display_artist = "Tyler, The Creator"
+                    else:
+                        display_artist = artist_names_list[0].split(',')[0].strip()
+
+                    if album_art and album_art not in seen_album_arts and display_artist not in seen_artists:
+                        unique_images.append(album_art)
+                        unique_artists.append(display_artist)
+                        seen_artists.add(display_artist)
+                        seen_album_arts.add(album_art)
+
+                        # Check if song exists
+                        if not Song.objects.filter(track_id=track_id).exists():
+                            new_song = Song.objects.create(
+                                track_id=track_id,
+                                track_name=track_name,
+                                artist_names=", ".join(artist_names_list),
+                                album_art=album_art,
+                                genres=", ".join(genres_list),
+                                popularity=popularity
+                                # users left blank
+                            )
+                            link_song_genres([new_song])
 
-    artists = []
-    #Adds all desired info to each artist
-    for i, artist in enumerate(top_artists):
-        artist_name = artist.get('name', 'Unknown')
-        artist_photo = artist['images'][0]['url'] if artist.get('images') else ''
-        popularity = artist.get('popularity', 0)
-        artists.append((i + 1, artist_name, artist_photo, popularity))
+                    if len(unique_images) >= 4:
+                        break
+            except Exception as e:
+                print(f"Spotify fallback failed for genre {genre}: {e}")
+
+        while len(unique_images) < 4:
+            unique_images.append("https://via.placeholder.com/150?text=No+Image")
+            unique_artists.append("Unknown Artist")
 
-    return render(request, 'spotifyapp/view_top_artists.html', {'artists': artists, 'time_range': time_range})
+        genre_list.append((i + 1, genre, count, unique_images, unique_artists))
+
+    return genre_list
 
 #Function that will show you your top genres, Later I plan to add some artists images into each genre as well
+#The list is cached per user, rebuilt by one request at a time, and invalidated when the user's songs change.
 @login_required
 def view_top_genres(request):
     user = request.user
-    cache_key = f"user_top_genres_{user.id}"
-    page_number = request.GET.get('page', 1)
-
-    cached_genre_list = cache.get(cache_key)
-    if not cached_genre_list:
-        user_songs = Song.objects.filter(users=user)
-
-        # Build a dictionary of genre counts
-        genres = {}
-        for song in user_songs:
-            for genre in song.genres.split(', '):
-                genre = genre.strip()
-                if genre:
-                    genres[genre] = genres.get(genre, 0) + 1
-
-        # Sort genres by count (most listened first)
-        sorted_genres = sorted(genres.items(), key=lambda item: item[1], reverse=True)
-        genre_list = []
-
-        for i, (genre, count) in enumerate(sorted_genres):
-            songs_with_art = user_songs.filter(
-                album_art__isnull=False
-            ).exclude(album_art__exact='').order_by('-popularity')
-
-            seen_artists = set()
-            seen_album_arts = set()
-            unique_images = []
-            unique_artists = []
-
-            def process_song(song, exact=True):
-                song_genres = [g.strip() for g in song.genres.split(',') if g.strip()]
-                if not song_genres:
-                    return False
-
-                first_genre = song_genres[0].lower()
-                if exact and first_genre != genre.lower():
-                    return False
-                if not exact and genre.lower() not in [g.lower() for g in song_genres]:
-                    return False
-
-                if not song.artist_names:
-                    return False
-                if song.artist_names.startswith("Tyler, The Creator"):
-                    artist = "Tyler, The Creator"
-                else:
-                    artist = song.artist_names.split(',')[0].strip()
-
-                album_art = song.album_art.strip()
-                if not album_art or album_art in seen_album_arts or artist in seen_artists:
-                    return False
-
-                unique_images.append(album_art)
-                unique_artists.append(artist)
-                seen_artists.add(artist)
-                seen_album_arts.add(album_art)
-                return True
-
-            # First pass
-            for song in songs_with_art:
-                if len(unique_images) >= 4:
-                    break
-                process_song(song, exact=True)
-
-            # Second pass
-            if len(unique_images) < 4:
-                for song in songs_with_art:
-                    if len(unique_images) >= 4:
-                        break
-                    process_song(song, exact=False)
-
-            # Fallback to Spotify if needed
-            if len(unique_images) < 4:
-                try:
-                    results = sp.search(q=f'genre:"{genre}"', type='track', limit=20)
-                    for item in results['tracks']['items']:
-                        track_id = item['id']
-                        track_name = item['name']
-                        popularity = item['popularity']
-                        album_art = item['album']['images'][0]['url'] if item['album']['images'] else None
-                        genres_list = [genre]  # You can’t get genre from track in Spotify API directly
-
-                        artist_names_list = [artist['name'] for artist in item['artists']]
-                        if artist_names_list[0] == "Tyler, The Creator":
-                            display_artist = "Tyler, The Creator"
-                        else:
-                            display_artist = artist_names_list[0].split(',')[0].strip()
-
-                        if album_art and album_art not in seen_album_arts and display_artist not in seen_artists:
-                            unique_images.append(album_art)
-                            unique_artists.append(display_artist)
-                            seen_artists.add(display_artist)
-                            seen_album_arts.add(album_art)
-
-                            # Check if song exists
-                            if not Song.objects.filter(track_id=track_id).exists():
-                                Song.objects.create(
-                                    track_id=track_id,
-                                    track_name=track_name,
-                                    artist_names=", ".join(artist_names_list),
-                                    album_art=album_art,
-                                    genres=", ".join(genres_list),
-                                    popularity=popularity
-                                    # users left blank
-                                )
-
-                        if len(unique_images) >= 4:
-                            break
-                except Exception as e:
-                    print(f"Spotify fallback failed for genre {genre}: {e}")
-
-            while len(unique_images) < 4:
-                unique_images.append("https://via.placeholder.com/150?text=No+Image")
-                unique_artists.append("Unknown Artist")
-
-            genre_list.append((i + 1, genre, count, unique_images, unique_artists))
-    else:
-        genre_list = cached_genre_list
-
+    genre_list = cached_for_user(user, 'top_genres', lambda: build_top_genres(user, get_spotify_client(request)))
 
     # Paginate results (50 genres per page)
     paginator = Paginator(genre_list, 50)
     page_number = request.GET.get('page')
     page_obj = paginator.get_page(page_number)
-    cache.set(cache_key, genre_list, timeout=60 * 15)  # cache for 15 minutes
 
     return render(request, 'spotifyapp/view_top_genres.html', {'genres': page_obj})
 
-#Function that will add all songs that are in your library to the database, for easier use later
+#Function that will add all songs that are in your library to the database, for easier use later.
+#The crawl itself runs in the run_sync_worker command, this just queues it and points at the progress endpoint.
 @login_required
 def add_all_songs_to_database(request):
-    try:
-        # Initialize variables to track pagination
-        all_tracks = []
-        offset = 0
-        limit = 50
-        
-        # Fetch all tracks from playlists
-        while True:
-            playlists = sp.current_user_playlists(offset=offset, limit=limit)
-            if not playlists.get('items', []):
-                return HttpResponse("No playlists found for this user.")
-            for playlist in playlists['items']:
-                results = sp.playlist_tracks(playlist['id'], limit=100)
-                for item in results['items']:
-                    track = item.get('track')
-                    if track and track.get('id'):
-                        all_tracks.append(track)
-            if not playlists['next']:
-                break
-            offset += limit
-
-        # Fetch all liked songs
-        offset = 0
-        while True:
-            liked_tracks = sp.current_user_saved_tracks(offset=offset, limit=limit)
-            for item in liked_tracks['items']:
-                track = item['track']
-                if track and track.get('id'):
-                    all_tracks.append(track)
-            if not liked_tracks['next']:
-                break
-            offset += limit
-
-        # Add all tracks to the database
-        user = request.user
-        for track in all_tracks:
-            get_or_create_song(track, user)
+    job = enqueue_library_sync(request.user)
+    progress_url = reverse('sync_progress', args=[job.id])
+    return JsonResponse({'job_id': job.id, 'status': job.status, 'progress_url': progress_url}, status=202)
 
-        return HttpResponse(f"Added {len(all_tracks)} songs to the database.")
-    except Exception as e:
-        logger.error(f"Error adding songs to database: {e}")
-        return HttpResponse("Failed to add songs to the database.")
+#Function that reports how far along a library sync is
+@login_required
+def sync_progress(request, job_id):
+    job = get_object_or_404(SyncJob, id=job_id, user=request.user)
+    return JsonResponse(job_progress(job))
 
 #Function that allows you to view your top songs
 
@@ -419,31 +271,20 @@ def add_all_songs_to_database(request):
 def view_last_50_listens(request):
     try:
         user = request.user
-        # Fetch the last 50 recently played tracks from Spotify
-        recent_items = sp.current_user_recently_played(limit=50).get('items', [])
-        
+        # History is kept current by the poll_recently_played command, the page only reads what we stored
+        plays = ListeningHistory.objects.filter(user=user).select_related('song').order_by('-played_at')[:50]
+
         songs = []
-        for i, item in enumerate(recent_items):
-            # Each item from recently played has a 'track' key.
-            track = item.get('track')
-            if not track:
-                continue
-
-            # Save or update the song in the database
-            song = get_or_create_song(track, user)
-            
-            if song:
-                # Record the listening event (if you wish to record every fetch)
-                ListeningHistory.objects.create(user=user, song=song)
-                
-                songs.append({
-                    'index': i + 1,
-                    'track_name': song.track_name,
-                    'artist_names': song.artist_names,
-                    'album_art': song.album_art,
-                    'popularity': song.popularity,
-                })
-        
+        for i, play in enumerate(plays):
+            songs.append({
+                'index': i + 1,
+                'track_name': play.song.track_name,
+                'artist_names': play.song.artist_names,
+                'album_art': play.song.album_art,
+                'popularity': play.song.popularity,
+                'played_at': play.played_at,
+            })
+
         return render(request, 'spotifyapp/view_last_50_songs.html', {
             'songs': songs,
             'time_range': 'Recent Listens'
@@ -454,20 +295,24 @@ def view_last_50_listens(request):
             'songs': []
         })
 
+#Function that will show you your top songs, cached the same way as the top artists
 @login_required
 def view_top_songs(request, time_range='short_term'):
-    try:
+    sp = get_spotify_client(request)
+    if sp is None:
+        return redirect('spotify_login')
+
+    def build():
         # Fetch the current user's top tracks from Spotify
         top_tracks = sp.current_user_top_tracks(limit=50, time_range=time_range).get('items', [])
         if not top_tracks:
             logger.warning("No top tracks found.")
-            return render(request, 'spotifyapp/view_top_songs.html', {'songs': [], 'time_range': time_range})
 
+        # All 50 go through the bulk path in one go
+        saved = ingest_tracks(top_tracks, request.user, sp)
         songs = []
-        user = request.user  # This is the currently logged in user
-        
         for i, track in enumerate(top_tracks):
-            song = get_or_create_song(track, user)
+            song = saved.get(track.get('id'))
             if song:
                 songs.append({
                     'index': i + 1,
@@ -477,37 +322,18 @@ def view_top_songs(request, time_range='short_term'):
                     'popularity': song.popularity,
                 })
 
-        return render(request, 'spotifyapp/view_top_songs.html', {'songs': songs, 'time_range': time_range})
+        context = {'songs': songs, 'time_range': time_range}
+        return 'spotifyapp/view_top_songs.html', context, [track['id'] for track in top_tracks if track.get('id') in saved]
+
+    try:
+        # Building the page links its top tracks to the user, keyed on the library version it would throw itself away
+        return cached_page_response(request, f"top_songs_{time_range}", build, timeout=TOP_ITEMS_TIMEOUT, versioned=False)
     except Exception as e:
         logger.error(f"Error in view_top_songs: {e}")
         return render(request, 'spotifyapp/view_top_songs.html', {'songs': [], 'time_range': time_range})
 
 
-#Function that gets all user tracks (Mostly used to make sure that songs added to new playlists don't already
-#exist in your library somewhere, goal it to add all new tracks.
-def get_all_user_tracks():
-    user_tracks = []
-    playlists = sp.current_user_playlists()
-
-    for playlist in playlists['items']:
-        results = sp.playlist_tracks(playlist['id'])
-        for item in results['items']:
-            track = item.get('track')
-            if track and track.get('id') and not track.get('is_local'):
-                user_tracks.append(track['id'])  # Store only the track ID
-
-    # Fetch liked songs and add their IDs to user_tracks
-    results = sp.current_user_saved_tracks(limit=50)
-    while results:
-        for item in results['items']:
-            track = item['track']
-            if track and track.get('id') and not track.get('is_local'):
-                user_tracks.append(track['id'])
-        results = sp.next(results) if results['next'] else None
-
-    return user_tracks
-
-def create_playlist(name):
+def create_playlist(sp, name):
     try:
         playlist = sp.user_playlist_create(sp.current_user()['id'], name, public=False)
         return playlist['id']
@@ -518,7 +344,7 @@ def create_playlist(name):
         logger.error(f"Error creating playlist: {e}")
         return None
 
-def add_tracks_to_playlist(playlist_id, track_ids):
+def add_tracks_to_playlist(sp, playlist_id, track_ids):
     try:
         sp.playlist_add_items(playlist_id, track_ids)
     except spotipy.SpotifyException as e:
@@ -526,9 +352,13 @@ def add_tracks_to_playlist(playlist_id, track_ids):
     except Exception as e:
         logger.error(f"Error adding tracks to playlist: {e}")
 
+@login_required
 def create_genre_playlist(request):
     user = request.user
     if request.method == 'POST':
+        sp = get_spotify_client(request)
+        if sp is None:
+            return redirect('spotify_login')
         genre = request.POST.get('explore_a_genre')
         # Retrieve and convert the number of songs; default to 50 if conversion fails.
         try:
@@ -536,175 +366,118 @@ def create_genre_playlist(request):
         except ValueError:
             num_songs = 50
 
-#        user_track_ids = get_all_user_tracks()
-
-        genre_tracks = []
+        library = library_track_ids(user)
+        # Songs we already know in the genre first, Spotify is searched for the rest
+        genre_track_ids = [row['track_id'] for row in songs_in_genres(user, {genre: 1.0}, num_songs)]
         offset = 0
         # Use the num_songs value instead of hardcoding 50
-        while len(genre_tracks) < num_songs and offset < 500:  # Limit search to first 500 tracks
+        while len(genre_track_ids) < num_songs and offset < 500:  # Limit search to first 500 tracks
             results = sp.search(q=f'genre:"{genre}"', type='track', limit=50, offset=offset)
             tracks = results['tracks']['items']
+            if not tracks:
+                break
             for track in tracks:
-                track_id = track['id']
-                if Song.objects.filter(track_id=track_id, users=request.user).exists():
-                    continue                    
-                genre_tracks.append(track)
-                if len(genre_tracks) >= num_songs:
+                if track['id'] in library or track['id'] in genre_track_ids:
+                    continue
+                genre_track_ids.append(track['id'])
+                if len(genre_track_ids) >= num_songs:
                     break
             offset += 50
 
-        if not genre_tracks:
+        if not genre_track_ids:
             # Handle case where no tracks were found for the genre
-            print(f"No tracks found for genre: {genre}")
+            logger.info(f"No tracks found for genre: {genre}")
             return HttpResponse("No tracks found for the specified genre.")
 
-        genre_track_ids = [track['id'] for track in genre_tracks]
+        # Only a genre with too few songs of its own gets songs from the genres closest to it
+        if len(genre_track_ids) < num_songs:
+            neighbors = dict(neighboring_genres(genre, GENRE_PLAYLIST_NEIGHBORS))
+            chosen = set(genre_track_ids)
+            for row in songs_in_genres(user, neighbors, num_songs):
+                if len(genre_track_ids) >= num_songs:
+                    break
+                if row['track_id'] not in chosen:
+                    genre_track_ids.append(row['track_id'])
+
         random.shuffle(genre_track_ids)
         playlist_name = f"{genre} Playlist"
-        new_playlist_id = create_playlist(playlist_name)
+        new_playlist_id = create_playlist(sp, playlist_name)
         if new_playlist_id:
             # Add up to num_songs tracks instead of 50
-            add_tracks_to_playlist(new_playlist_id, genre_track_ids[:num_songs])
+            add_tracks_to_playlist(sp, new_playlist_id, genre_track_ids[:num_songs])
             return redirect('index')
         else:
             return HttpResponse("Failed to create playlist.")
 
     return render(request, 'spotifyapp/view_top_genres.html')
 
-#Function that will get the recently played tracks
-def get_recently_played_tracks():
-    try:
-        results = sp.current_user_recently_played(limit=50)
-        tracks = results['items']
-        while results['next']:
-            results = sp.next(results)
-            tracks.extend(results['items'])
-
-        # Store or update recently played tracks in the database
-        for item in tracks:
-            track = item['track']
-            if track is not None:
-                get_or_create_song(track)
-
-        return tracks
-    except spotipy.SpotifyException as e:
-        print(f"Spotify API Error: {e}")
-        return []
-    except requests.exceptions.RequestException as e:
-        print(f"Request error: {e}")
-        return []
-    except Exception as e:
-        print(f"Error fetching recently played tracks: {e}")
-        return []
-
 def index(request):
     return render(request, 'spotifyapp/index.html')
 
-def combine_candidates(candidates):
-    """Given a dict mapping track_id to a score, return a sorted list of track_ids."""
-    sorted_items = sorted(candidates.items(), key=lambda item: item[1], reverse=True)
-    return [track_id for track_id, score in sorted_items]
-
 @login_required
 def get_recommendations(request):
     if request.method == "POST":
+        sp = get_spotify_client(request)
+        if sp is None:
+            return redirect('spotify_login')
         try:
-            weight_genres   = int(request.POST.get("weight_genres", 25))
-            weight_artists  = int(request.POST.get("weight_artists", 25))
+            weight_genres   = int(request.POST.get("weight_genres", WEIGHT_GENRES))
+            weight_artists  = int(request.POST.get("weight_artists", WEIGHT_ARTISTS))
+            weight_popularity = int(request.POST.get("weight_popularity", WEIGHT_POPULARITY))
+            weight_neighbors = int(request.POST.get("weight_neighbors", WEIGHT_NEIGHBORS))
             num_songs       = int(request.POST.get("num_songs", 20))
             playlist_name   = request.POST.get("playlist_name", "Recommended Playlist")
 
             year_filter = request.POST.get("year_filter", "").strip()
             hipster_mode = request.POST.get("hipster_mode", "off") == "on"
             year_query = f' year:{year_filter}' if year_filter else ''
-
-            candidate_scores = {}
-
-            # 1. User's Songs and Top Genres
-            user_songs = Song.objects.filter(users=request.user)
-            genres = {}
-            for song in user_songs:
-                for genre in song.genres.split(', '):
-                    g = genre.strip()
-                    if g:
-                        genres[g] = genres.get(g, 0) + 1
-            sorted_genres = sorted(genres.items(), key=lambda item: item[1], reverse=True)
-            top_genres = [genre for genre, count in sorted_genres[:30]]
-
-            for genre in top_genres:
-                query = f'genre:"{genre}"{year_query}'
-                if hipster_mode:
-                    query = f'tag:hipster album:"{genre}"{year_query}'
-                    albums = sp.search(q=query, type='album', limit=20).get('albums', {}).get('items', [])
-                    for album in albums:
-                        tracks = sp.album_tracks(album.get('id')).get('items', [])
-                        for track in tracks:
-                            track_id = track.get('id')
-                            candidate_scores[track_id] = candidate_scores.get(track_id, 0) + weight_genres
-                else:
-                    results = sp.search(q=query, type='track', limit=20)
-                    for track in results.get('tracks', {}).get('items', []):
-                        track_id = track.get('id')
-                        candidate_scores[track_id] = candidate_scores.get(track_id, 0) + weight_genres
-
-            # 2. Top Artists
-            top_artists = sp.current_user_top_artists(limit=30, time_range='medium_term').get('items', [])
-            for artist in top_artists:
-                artist_name = artist.get('name')
-                query = f'artist:"{artist_name}"{year_query}'
-                if hipster_mode:
-                    query = f'tag:hipster album:"{artist_name}"{year_query}'
-                    albums = sp.search(q=query, type='album', limit=10).get('albums', {}).get('items', [])
-                    for album in albums:
-                        tracks = sp.album_tracks(album.get('id')).get('items', [])
-                        for track in tracks:
-                            track_id = track.get('id')
-                            candidate_scores[track_id] = candidate_scores.get(track_id, 0) + weight_artists
-                else:
-                    results = sp.search(q=query, type='track', limit=10)
-                    for track in results.get('tracks', {}).get('items', []):
-                        track_id = track.get('id')
-                        candidate_scores[track_id] = candidate_scores.get(track_id, 0) + weight_artists
-
-            # Combine and sort candidates
-            recommended_track_ids = combine_candidates(candidate_scores)
-
-            # Filter out tracks already in the user's library
-            overfetch = num_songs * 10  # Overfetch to ensure we get enough unique tracks to add to a playlist
-            filtered_track_ids = []
-            for track_id in recommended_track_ids[:overfetch]:
-                if not Song.objects.filter(track_id=track_id, users=request.user).exists():
-                    filtered_track_ids.append(track_id)
-                if len(filtered_track_ids) >= num_songs:
-                    break
-
+            if hipster_mode:
+                # Less known tracks first
+                weight_popularity = -weight_popularity
+
+            # 1. User's Top Genres, 2. Top Artists, searched concurrently
+            top_genres = [genre for genre, count in top_genres_for_user(request.user, limit=30)]
+            search_genres, local = top_genres, {}
+            if hipster_mode:
+                # Tracks we know from the genres next to the user's, Spotify is only searched for genres the graph
+                # found nothing around
+                local, covered = adjacent_genre_candidates(request.user, top_genres, least_popular_first=True)
+                search_genres = [genre for genre in top_genres if genre not in covered]
+            candidates, top_artists = gather_candidates(sp, search_genres, year_query=year_query, hipster_mode=hipster_mode)
+            merge_candidates(candidates, local)
+            # 3. What listeners with a similar library have, from the local neighbor index
+            add_neighbor_candidates(candidates, request.user)
+
+            # Filter out tracks already in the user's library, then score the rest in one batch and keep the best
+            library = library_track_ids(request.user)
+            filtered_track_ids = rank_candidates(
+                request.user,
+                [candidate for track_id, candidate in candidates.items() if track_id not in library],
+                top_artists,
+                num_songs,
+                weight_genres=weight_genres,
+                weight_artists=weight_artists,
+                weight_popularity=weight_popularity,
+                weight_neighbors=weight_neighbors,
+            )
+
+            # Local catalog first, then the rest from Spotify 50 at a time
             recommended_tracks = []
-
-            for idx, track_id in enumerate(filtered_track_ids):
-                try:
-                    track = sp.track(track_id)
-                    song_obj = get_or_create_song(track, request.user)
-                    if song_obj:
-                        recommended_tracks.append({
-                            'index': idx + 1,
-                            'track_name': song_obj.track_name,
-                            'artist_names': song_obj.artist_names,
-                            'album_art': song_obj.album_art,
-                            'popularity': song_obj.popularity,
-                        })
-                except Exception as e:
-                    logger.error(f"Error fetching details for track {track_id}: {e}")
-                    continue
-
-                if len(recommended_tracks) >= num_songs:
-                    break
+            for idx, song_obj in enumerate(hydrate_tracks(filtered_track_ids, request.user, sp)[:num_songs]):
+                recommended_tracks.append({
+                    'index': idx + 1,
+                    'track_name': song_obj.track_name,
+                    'artist_names': song_obj.artist_names,
+                    'album_art': song_obj.album_art,
+                    'popularity': song_obj.popularity,
+                })
 
             # Create the playlist and add songs only if we have some
             if filtered_track_ids:
-                new_playlist_id = create_playlist(playlist_name)
+                new_playlist_id = create_playlist(sp, playlist_name)
                 if new_playlist_id:
                     logger.debug(f"Adding {len(filtered_track_ids[:num_songs])} tracks to playlist {new_playlist_id}")
-                    add_tracks_to_playlist(new_playlist_id, filtered_track_ids[:num_songs])
+                    add_tracks_to_playlist(sp, new_playlist_id, filtered_track_ids[:num_songs])
                 else:
                     logger.warning("Playlist creation failed.")
                     return HttpResponse("Failed to create playlist.")